@@ -1,233 +1,488 @@
 import os
+import re
 import json
 import asyncio
+import weakref
+import tempfile
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import io
 from google.cloud import storage
 from alive_progress import alive_bar
 from logger_config import logger
-from gmailapi import fetch_unread_emails, fetch_email_content, draft_email, send_email, check_saved_access_token, start_oauth_and_server, get_events_for_next_10_days
+from http_pool import get_async_http_client
+from thread_sessions import ThreadSessionManager
+from ttl_cache import TTLCache, MISSING
+from tool_registry import ToolRegistry, Tool
+from quota_scheduler import scheduler
+from vector_ingest import ingest_files, stream_blobs_to_vector_store, summary_text
+from gcs_sync import list_blobs, sync_blobs, folder_prefix, SUB_FOLDERS
+from gmailapi import fetch_unread_emails, fetch_email_content, draft_email, send_email, start_oauth_and_server, current_account, get_events_for_next_10_days, search_emails, get_events_between
+from datetime import datetime
 # Load environment variables
 load_dotenv()
 assistant_id = "asst_9Ktnx0WWDOswzeL1FvDqOWRF"
-# Initialize OpenAI API client
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI API clients, one per event loop since their pooled connections are bound to the loop
+_clients = weakref.WeakKeyDictionary()
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=get_async_http_client())
+        _clients[loop] = client
+    return client
+
+# file_id -> file object for citations; knowledge-base files rarely change
+file_info_cache = TTLCache(max_entries=int(os.getenv("FILE_INFO_CACHE_MAX_ENTRIES", "1024")), default_ttl=3600)
+
+async def handle_fetch_unread_emails():
+    return await fetch_unread_emails(from_store=True)
+
+async def handle_search_emails(query=None, sort="date", descending=True, limit=15, offset=0):
+    return await search_emails(query=query, sort=sort, descending=descending, limit=limit, offset=offset)
+
+async def handle_get_events_between(start, end):
+    return await get_events_between(datetime.fromisoformat(start), datetime.fromisoformat(end))
+
+# Functions the assistant can call; the registry also produces the Assistant's function definitions
+tools = ToolRegistry(authorize=start_oauth_and_server, account=current_account)
+tools.register(Tool(
+    'fetch_unread_emails', handle_fetch_unread_emails,
+    "Lists the most recent unread inbox emails (ID and subject).",
+    cache_ttl=60, max_concurrency=2, requires_auth=True,
+))
+tools.register(Tool(
+    'fetch_email_content', fetch_email_content,
+    "Returns the sender, recipients, subject, date and snippet of one email.",
+    {"type": "object", "properties": {"email_id": {"type": "string", "description": "Gmail message ID."}}, "required": ["email_id"]},
+    timeout=30, max_concurrency=8, cache_ttl=600, requires_auth=True,
+))
+tools.register(Tool(
+    'search_emails', handle_search_emails,
+    "Searches the synced mailbox and returns one page of matching emails.",
+    {"type": "object", "properties": {
+        "query": {"type": "string", "description": "Words to match against subject, sender, recipients, date and snippet."},
+        "sort": {"type": "string", "enum": ["date", "subject", "from", "to", "relevance"]},
+        "descending": {"type": "boolean"},
+        "limit": {"type": "integer", "description": "Page size."},
+        "offset": {"type": "integer", "description": "Number of matches to skip."},
+    }},
+    timeout=30, max_concurrency=4, cache_ttl=60, requires_auth=True,
+    output_fields=['id', 'subject', 'from', 'date', 'snippet'],
+))
+tools.register(Tool(
+    'draft_email', draft_email,
+    "Creates a Gmail draft and returns its ID.",
+    {"type": "object", "properties": {
+        "to": {"type": "string"}, "subject": {"type": "string"}, "message_text": {"type": "string"},
+    }, "required": ["to", "subject", "message_text"]},
+    writes=True, timeout=30, max_concurrency=2, invalidates=['fetch_unread_emails', 'search_emails'], requires_auth=True,
+))
+tools.register(Tool(
+    'send_email', send_email,
+    "Sends a previously created draft.",
+    {"type": "object", "properties": {"draft_id": {"type": "string"}}, "required": ["draft_id"]},
+    writes=True, timeout=30, max_concurrency=2, invalidates=['fetch_unread_emails', 'search_emails'], requires_auth=True,
+))
+tools.register(Tool(
+    'get_events_for_next_10_days', get_events_for_next_10_days,
+    "Lists calendar events from now until ten days ahead.",
+    max_concurrency=2, cache_ttl=120, requires_auth=True,
+))
+tools.register(Tool(
+    'get_events_between', handle_get_events_between,
+    "Lists calendar events overlapping a time window.",
+    {"type": "object", "properties": {
+        "start": {"type": "string", "description": "Window start, ISO 8601."},
+        "end": {"type": "string", "description": "Window end, ISO 8601."},
+    }, "required": ["start", "end"]},
+    max_concurrency=4, cache_ttl=120, requires_auth=True,
+))
+
+tools.register(Tool(
+    'fetch_more_results', tools.fetch_more,
+    "Returns the remaining items of a tool result that was cut short, given its next_cursor.",
+    {"type": "object", "properties": {"cursor": {"type": "string"}}, "required": ["cursor"]},
+    timeout=5,
+))
 
 async def execute_function(function_name, arguments, from_user):
-    logger.debug(f"Executing function: {function_name} with arguments: {arguments} from user: {from_user}")
-    
-    if function_name in ['fetch_unread_emails', 'fetch_email_content', 'draft_email', 'send_email', 'get_events_for_next_10_days']:
-        logger.debug("Checking for saved access token...")
-        token = await check_saved_access_token()
-        if not token:
-            logger.info("No access token found. Initiating OAuth flow.")
-            await start_oauth_and_server()
-            logger.debug("OAuth flow initiated. Waiting for token...")
-            # Wait until the credentials file exists and has valid credentials
-            while not os.path.exists('gmail-api-credentials.json'):
-                logger.debug("Checking for existence of credentials file every 5 seconds.")
-                await asyncio.sleep(5)  # Check every 5 seconds if the token file is available
-            # After the file exists, check for valid credentials
-            token = await check_saved_access_token()
-            while not token:
-                logger.debug("Waiting for valid credentials...")
-                await asyncio.sleep(5)  # Check every 5 seconds for valid credentials
-                token = await check_saved_access_token()
-        
-        if token:
-            logger.debug("Valid access token found. Proceeding with API calls.")
-            if function_name == 'fetch_unread_emails':
-                logger.debug("Fetching unread emails...")
-                emails_info = await fetch_unread_emails()
-                logger.debug(f"Unread emails fetched: {emails_info}")
-                return emails_info  # Directly return the result without additional await
-            elif function_name == 'fetch_email_content':
-                email_id = arguments.get("email_id")
-                logger.debug(f"Fetching content for email ID: {email_id}")
-                email_content = await fetch_email_content(email_id)
-                logger.debug(f"Email content fetched: {email_content}")
-                return email_content
-            elif function_name == 'draft_email':
-                to = arguments.get("to")
-                subject = arguments.get("subject")
-                message_text = arguments.get("message_text")
-                logger.debug(f"Drafting email to: {to}, subject: {subject}")
-                draft_id = await draft_email(to, subject, message_text)
-                logger.debug(f"Email drafted with ID: {draft_id}")
-                return draft_id
-            elif function_name == 'send_email':
-                draft_id = arguments.get("draft_id")
-                logger.debug(f"Sending email with draft ID: {draft_id}")
-                sent_id = await send_email(draft_id)
-                logger.debug(f"Email sent with ID: {sent_id}")
-                return sent_id
-            elif function_name == 'get_events_for_next_10_days':
-                logger.debug("Fetching events for the next 10 days...")
-                events = await get_events_for_next_10_days()
-                logger.debug(f"Events fetched: {events}")
-                return events
-        else:
-            logger.error("Failed to obtain valid access token after waiting.")
-            return {"status": "error", "message": "Failed to obtain valid access token after waiting."}
-    else:
-        logger.error(f"Function not recognized: {function_name}")
-        return {"status": "error", "message": "Function not recognized"}
-    
-global_thread_id = None
-async def process_thread_with_assistant(query, assistant_id, model="gpt-3.5-turbo-1106", from_user=None):
-    global global_thread_id
-    response_texts = []
-    response_files = []
-    in_memory_files = []
-    try:
-        if not global_thread_id:
-            logger.debug("Creating a new thread for the user query...")
-            thread = await client.beta.threads.create()
-            global_thread_id = thread.id
-            logger.debug(f"New thread created with ID: {global_thread_id}")
-        
-        logger.debug("Adding the user query as a message to the thread...")
-        await client.beta.threads.messages.create(
-            thread_id=global_thread_id,
-            role="user",
-            content=query
-        )
-        logger.debug("User query added to the thread.")
-
-        logger.debug("Creating a run to process the thread with the assistant...")
-        run = await client.beta.threads.runs.create(
-            thread_id=global_thread_id,
-            assistant_id=assistant_id,
-            model=model
-        )
-        logger.debug(f"Run created with ID: {run.id}")
+    """Runs a registered tool; see ToolRegistry.call."""
+    return await tools.call(function_name, arguments, from_user)
 
-        while True:
-            logger.debug("Initiating status check for the run...")
-            try:
-                run_status = await client.beta.threads.runs.retrieve(
-                    thread_id=global_thread_id,
-                    run_id=run.id
+async def sync_assistant_tools(assistant_id):
+    """Replaces the assistant's function tools with the registry's definitions, keeping its other tools."""
+    try:
+        assistant = await get_client().beta.assistants.retrieve(assistant_id)
+        other_tools = [tool.model_dump() for tool in assistant.tools if tool.type != "function"]
+        await get_client().beta.assistants.update(assistant_id=assistant_id, tools=other_tools + tools.function_definitions())
+        logger.info(f"Assistant {assistant_id} now has {len(tools.function_definitions())} function tools.")
+    except Exception as e:
+        logger.error(f"Failed to sync assistant tools: {e}")
+
+async def create_thread():
+    logger.debug("Creating a new thread for the user query...")
+    return await get_client().beta.threads.create()
+
+# One assistant thread per session or user; ASSISTANT_SESSIONS_FILE keeps them across restarts
+thread_sessions = ThreadSessionManager(create_thread, persist_path=os.getenv("ASSISTANT_SESSIONS_FILE"))
+
+# Run states after which no further events arrive
+TERMINAL_RUN_STATUSES = ["completed", "failed", "cancelled", "expired"]
+# Run states in which a thread accepts no new run
+ACTIVE_RUN_STATUSES = ["queued", "in_progress", "requires_action", "cancelling"]
+
+# Assistant-generated files are streamed here and served to the UI from disk
+DOWNLOAD_DIR = os.getenv("ASSISTANT_DOWNLOAD_DIR", "downloads")
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("ASSISTANT_MAX_CONCURRENT_DOWNLOADS", "4"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Opt-in disk cache of the GCS blobs ingested by main(); unset streams them without touching disk
+INGEST_CACHE_DIR = os.getenv("INGEST_CACHE_DIR")
+
+# Determine file extension based on MIME type
+FILE_EXTENSIONS = {
+    "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
+    "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
+    "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
+    "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
+    "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
+    "application/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
+    "image/png": ".png", "application/x-tar": ".tar",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/xml": "text/xml", "application/zip": ".zip"
+}
+
+async def execute_tool_call(tool_call, from_user):
+    function_name = tool_call.function.name
+    try:
+        arguments = json.loads(tool_call.function.arguments or "{}")
+        logger.debug(f"Function to execute: {function_name} with arguments: {arguments}")
+        # Timeouts, concurrency limits and tool errors are handled by the registry
+        function_output = await execute_function(function_name, arguments, from_user)
+    except Exception as e:
+        logger.error(f"Error executing function {function_name}: {e}")
+        function_output = {"status": "error", "message": str(e)}
+    # Only the fields the assistant needs, within TOOL_OUTPUT_MAX_BYTES
+    function_output_str = tools.format_output(function_name, function_output)
+    logger.debug(f"Function {function_name} executed. Output: {function_output_str}")
+    return {"tool_call_id": tool_call.id, "output": function_output_str}
+
+async def execute_tool_calls(tool_calls, from_user):
+    """Runs every tool call of a requires_action run concurrently and returns all tool_outputs to submit together."""
+    logger.debug(f"Executing {len(tool_calls)} tool calls concurrently.")
+    return list(await asyncio.gather(*(execute_tool_call(tool_call, from_user) for tool_call in tool_calls)))
+
+async def stream_run(thread_id, assistant_id, model, from_user, run_state):
+    """
+    Drives a run through the Assistants event stream, answering requires_action as soon as it arrives.
+    The run ID, and any tool outputs not yet submitted, are recorded in run_state so a caller can
+    fall back to polling the same run without running the tools again.
+    Returns the completed assistant message, or None.
+    """
+    latest_assistant_message = None
+    stream = await get_client().beta.threads.runs.create(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        model=model,
+        stream=True
+    )
+    while stream is not None:
+        next_stream = None
+        async for event in stream:
+            logger.debug(f"Run event: {event.event}")
+            if event.event == "thread.run.created":
+                run_state["run_id"] = event.data.id
+                logger.debug(f"Run created with ID: {event.data.id}")
+            elif event.event == "thread.message.completed" and event.data.role == "assistant":
+                latest_assistant_message = event.data
+            elif event.event == "thread.run.requires_action":
+                logger.debug("Run requires action. Preparing to execute the specified function...")
+                run_state["run_id"] = event.data.id
+                tool_outputs = await execute_tool_calls(event.data.required_action.submit_tool_outputs.tool_calls, from_user)
+                run_state["tool_outputs"] = tool_outputs
+                logger.debug("Submitting tool outputs and resuming the event stream...")
+                next_stream = await get_client().beta.threads.runs.submit_tool_outputs(
+                    thread_id=thread_id,
+                    run_id=event.data.id,
+                    tool_outputs=tool_outputs,
+                    stream=True
                 )
-                logger.debug(f"API Call: Retrieve run status for run_id={run.id} in thread_id={global_thread_id}")
-                logger.debug(f"Response: Run status retrieved successfully with status: {run_status.status}")
-            except Exception as e:
-                logger.error(f"Failed to retrieve run status: {e}")
+                run_state["tool_outputs"] = None
                 break
-
-            if run_status.status == "requires_action":
+            elif event.event in ["thread.run.failed", "thread.run.cancelled", "thread.run.expired"]:
+                logger.error(f"Run ended with event {event.event}: {getattr(event.data, 'last_error', None)}")
+            elif event.event == "error":
+                logger.error(f"Run stream error: {event.data}")
+        await stream.close()
+        stream = next_stream
+    return latest_assistant_message
+
+async def active_run_id(thread_id):
+    """ID of the thread's latest run if it is still active, e.g. one a failed stream created before reporting it."""
+    runs = await get_client().beta.threads.runs.list(thread_id=thread_id, limit=1)
+    latest_run = runs.data[0] if runs.data else None
+    if latest_run and latest_run.status in ACTIVE_RUN_STATUSES:
+        logger.debug(f"Resuming active run {latest_run.id} ({latest_run.status})")
+        return latest_run.id
+    return None
+
+async def poll_run(thread_id, run_id, from_user, run_state=None):
+    """
+    Polls a run once a second until it finishes and returns the latest assistant message, or None.
+    Tool outputs left in run_state by an interrupted stream are submitted instead of running the tools again.
+    """
+    run_state = run_state if run_state is not None else {}
+    while True:
+        logger.debug("Initiating status check for the run...")
+        try:
+            run_status = await get_client().beta.threads.runs.retrieve(
+                thread_id=thread_id,
+                run_id=run_id
+            )
+            logger.debug(f"API Call: Retrieve run status for run_id={run_id} in thread_id={thread_id}")
+            logger.debug(f"Response: Run status retrieved successfully with status: {run_status.status}")
+        except Exception as e:
+            logger.error(f"Failed to retrieve run status: {e}")
+            return None
+
+        if run_status.status == "requires_action":
+            tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
+            tool_outputs = run_state.pop("tool_outputs", None)
+            if tool_outputs and {output["tool_call_id"] for output in tool_outputs} == {tool_call.id for tool_call in tool_calls}:
+                logger.debug("Run requires action. Resubmitting the tool outputs of the interrupted stream...")
+            else:
                 logger.debug("Run requires action. Preparing to execute the specified function...")
                 try:
-                    tool_call = run_status.required_action.submit_tool_outputs.tool_calls[0]
-                    function_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
-                    logger.debug(f"Function to execute: {function_name} with arguments: {arguments}")
+                    tool_outputs = await execute_tool_calls(tool_calls, from_user)
                 except Exception as e:
-                    logger.error(f"Error parsing required action details: {e}")
+                    logger.error(f"Error executing required action: {e}")
+                    await asyncio.sleep(1)
                     continue
 
-                try:
-                    function_output = await execute_function(function_name, arguments, from_user)
-                    function_output_str = json.dumps(function_output)
-                    logger.debug(f"Function {function_name} executed. Output: {function_output_str}")
-                except Exception as e:
-                    logger.error(f"Error executing function {function_name}: {e}")
+            try:
+                logger.debug("Preparing to submit tool outputs to the run...")
+                response = await get_client().beta.threads.runs.submit_tool_outputs(
+                    thread_id=thread_id,
+                    run_id=run_id,
+                    tool_outputs=tool_outputs
+                )
+                logger.debug(f"Tool outputs successfully submitted. Response: {response}")
+            except Exception as e:
+                logger.error(f"Failed to submit tool outputs: {e}")
+                logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
+
+        elif run_status.status in TERMINAL_RUN_STATUSES:
+            logger.debug(f"Run status is {run_status.status}. Initiating fetch for the latest assistant message...")
+            try:
+                messages_response = await get_client().beta.threads.messages.list(
+                    thread_id=thread_id,
+                    order="desc"
+                )
+                logger.debug(f"API Call: List messages for thread in descending order. Response: {messages_response}")
+                latest_assistant_message = next((message for message in messages_response.data if message.role == "assistant"), None)
+                if latest_assistant_message:
+                    logger.debug(f"Latest assistant message retrieved: {latest_assistant_message.content}")
+                else:
+                    logger.debug("No assistant messages found.")
+                return latest_assistant_message
+            except Exception as e:
+                logger.error(f"Failed to fetch messages: {e}")
+                logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
+                return None
+        await asyncio.sleep(1)
+
+def annotation_file_id(annotation):
+    if annotation.type == "file_citation":
+        return annotation.file_citation.file_id
+    if annotation.type == "file_path":
+        return annotation.file_path.file_id
+    return None
+
+async def retrieve_file_info(file_id):
+    """files.retrieve, memoized process-wide so repeat citations of the same file cost nothing."""
+    file_info = file_info_cache.get(file_id)
+    if file_info is MISSING:
+        file_info = await get_client().files.retrieve(file_id)
+        file_info_cache.set(file_id, file_info)
+    return file_info
+
+async def resolve_file_infos(file_ids):
+    """Retrieves several files' metadata concurrently; files that fail to resolve are left out."""
+    file_ids = list(dict.fromkeys(file_ids))
+    results = await asyncio.gather(*(retrieve_file_info(file_id) for file_id in file_ids), return_exceptions=True)
+    file_infos = {}
+    for file_id, result in zip(file_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to retrieve file {file_id}: {result}")
+        else:
+            file_infos[file_id] = result
+    return file_infos
+
+async def render_assistant_message(message):
+    """Replaces citation annotations in the message text and collects the files it references."""
+    response_texts = []
+    response_files = []
+    file_infos = await resolve_file_infos(
+        annotation_file_id(annotation)
+        for content in message.content if content.type == "text"
+        for annotation in content.text.annotations if annotation_file_id(annotation)
+    )
+    for content in message.content:
+        if content.type == "text":
+            text_value = content.text.value
+            # Check for annotations and replace them
+            for annotation in content.text.annotations:
+                file_info_response = file_infos.get(annotation_file_id(annotation))
+                if file_info_response is None:
                     continue
+                if annotation.type == "file_citation":
+                    citation_text = f"[Cited from {file_info_response.filename}]"
+                    text_value = text_value.replace(annotation.text, citation_text)
+                    logger.debug(f"File citation replaced in text. Original: {annotation.text}, New: {citation_text}")
+                elif annotation.type == "file_path":
+                    download_link = f"<https://platform.openai.com/files/{file_info_response.id}|Download {file_info_response.filename}>"
+                    text_value = text_value.replace(annotation.text, download_link)
+                    logger.debug(f"File path link replaced in text. Original: {annotation.text}, New: {download_link}")
+            response_texts.append(text_value)
+        elif content.type == "file":
+            file_id = content.file.file_id
+            file_mime_type = content.file.mime_type
+            response_files.append((file_id, file_mime_type))
+    return response_texts, response_files
+
+async def download_response_file(file_id, mime_type, semaphore):
+    """
+    Streams one assistant-generated file to DOWNLOAD_DIR in chunks, so large outputs never sit in memory.
+    A file already on disk with the size OpenAI reports is not downloaded again.
+
+    Returns:
+        dict: {"file_id", "filename", "mime_type", "path", "bytes"}, or None if the download failed.
+    """
+    try:
+        file_info = await retrieve_file_info(file_id)
+        # Fall back to the generated file's own extension, then .bin, for unknown MIME types
+        file_extension = FILE_EXTENSIONS.get(mime_type) or os.path.splitext(file_info.filename or "")[1] or ".bin"
+        local_file_path = os.path.join(DOWNLOAD_DIR, f"downloaded_file_{file_id}{file_extension}")
+        handle = {
+            "file_id": file_id,
+            "filename": os.path.basename(file_info.filename or local_file_path),
+            "mime_type": mime_type,
+            "path": local_file_path,
+            "bytes": file_info.bytes,
+        }
+        if os.path.exists(local_file_path) and os.path.getsize(local_file_path) == file_info.bytes:
+            logger.debug(f"File {file_id} already downloaded at {local_file_path}")
+            return handle
+
+        async with semaphore:
+            logger.debug(f"Streaming content for file ID: {file_id} with MIME type: {mime_type}")
+            # A unique partial file per request, so concurrent requests for one file_id never share it
+            fd, partial_path = tempfile.mkstemp(dir=DOWNLOAD_DIR, prefix=f".downloaded_file_{file_id}-", suffix=".part")
+            try:
+                async with get_client().files.with_streaming_response.content(file_id) as response:
+                    with os.fdopen(fd, "wb") as local_file:
+                        async for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            local_file.write(chunk)
+                os.replace(partial_path, local_file_path)
+            except BaseException:
+                if os.path.exists(partial_path):
+                    os.unlink(partial_path)
+                raise
+        handle["bytes"] = os.path.getsize(local_file_path)
+        logger.debug(f"File saved locally at {local_file_path} ({handle['bytes']} bytes)")
+        return handle
 
-                try:
-                    logger.debug("Preparing to submit tool outputs to the run...")
-                    response = await client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=global_thread_id,
-                        run_id=run.id,
-                        tool_outputs=[{
-                            "tool_call_id": tool_call.id,
-                            "output": function_output_str
-                        }]
-                    )
-                    logger.debug(f"Tool outputs successfully submitted. Response: {response}")
-                except Exception as e:
-                    logger.error(f"Failed to submit tool outputs: {e}")
-                    logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {e}")
+        logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
+        return None
 
-            elif run_status.status in ["completed", "failed", "cancelled"]:
-                logger.debug(f"Run status is {run_status.status}. Initiating fetch for the latest assistant message...")
+async def download_response_files(response_files):
+    """Downloads the files concurrently, at most MAX_CONCURRENT_DOWNLOADS at a time, and returns the handles of those that succeeded."""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    handles = await asyncio.gather(*(download_response_file(file_id, mime_type, semaphore) for file_id, mime_type in response_files))
+    return [handle for handle in handles if handle is not None]
+
+# Names download_response_file gives the files it writes; nothing else in DOWNLOAD_DIR is served
+DOWNLOAD_NAME_PATTERN = re.compile(r"downloaded_file_[A-Za-z0-9_-]+\.[A-Za-z0-9]+")
+
+def download_path(name):
+    """
+    Local path of a file download_response_file wrote to DOWNLOAD_DIR, or None for any other name.
+    Resolved from disk, so every worker process can serve files downloaded by any other.
+    """
+    if not DOWNLOAD_NAME_PATTERN.fullmatch(name):
+        return None
+    download_dir = os.path.realpath(DOWNLOAD_DIR)
+    path = os.path.realpath(os.path.join(download_dir, name))
+    if os.path.dirname(path) != download_dir or not os.path.isfile(path):
+        return None
+    return path
+
+async def process_thread_with_assistant(query, assistant_id, model="gpt-3.5-turbo-1106", from_user=None, stream=True, session_key=None):
+    """
+    Sends a query to the assistant thread and returns the assistant's reply.
+    Args:
+        query (str): The user's message.
+        assistant_id (str): ID of the assistant to run.
+        model (str): Model override for the run.
+        from_user: Identifier of the requesting user. Cached tool results are shared per signed-in
+            account, and otherwise kept per user, or per session_key when there is no user.
+        stream (bool): React to run events as they are streamed; when False, or if streaming
+            fails, the run status is polled once a second instead.
+        session_key (str): Conversation the query belongs to; defaults to from_user. Each key has
+            its own thread, and queries for the same key run one after another.
+
+    Returns:
+        dict: {"text": [...], "in_memory_files": [...]}, where in_memory_files holds a handle per
+            generated file (see download_response_file); the content itself stays on disk.
+    """
+    response_texts = []
+    in_memory_files = []
+    caller = from_user or session_key
+    try:
+        async with thread_sessions.session(session_key or from_user or "default") as thread_id:
+            logger.debug("Adding the user query as a message to the thread...")
+            await get_client().beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=query
+            )
+            logger.debug("User query added to the thread.")
+
+            latest_assistant_message = None
+            run_state = {"run_id": None, "tool_outputs": None}
+            if stream:
                 try:
-                    messages_response = await client.beta.threads.messages.list(
-                        thread_id=global_thread_id,
-                        order="desc"
-                    )
-                    logger.debug(f"API Call: List messages for thread in descending order. Response: {messages_response}")
-                    latest_assistant_message = next((message for message in messages_response.data if message.role == "assistant"), None)
-                    if latest_assistant_message:
-                        logger.debug(f"Latest assistant message retrieved: {latest_assistant_message.content}")
-                    else:
-                        logger.debug("No assistant messages found.")
+                    latest_assistant_message = await stream_run(thread_id, assistant_id, model, caller, run_state)
                 except Exception as e:
-                    logger.error(f"Failed to fetch messages: {e}")
-                    logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
-                    break
-                
-                if latest_assistant_message:
-                    for content in latest_assistant_message.content:
-                        if content.type == "text":
-                            text_value = content.text.value
-                            # Check for annotations and replace them
-                            for annotation in content.text.annotations:
-                                if annotation.type == "file_citation":
-                                    cited_file_response = await client.files.retrieve(annotation.file_citation.file_id)
-                                    citation_text = f"[Cited from {cited_file_response.filename}]"
-                                    text_value = text_value.replace(annotation.text, citation_text)
-                                    logger.debug(f"File citation replaced in text. Original: {annotation.text}, New: {citation_text}")
-                                elif annotation.type == "file_path":
-                                    file_info_response = await client.files.retrieve(annotation.file_path.file_id)
-                                    download_link = f"<https://platform.openai.com/files/{file_info_response.id}|Download {file_info_response.filename}>"
-                                    text_value = text_value.replace(annotation.text, download_link)
-                                    logger.debug(f"File path link replaced in text. Original: {annotation.text}, New: {download_link}")
-                            response_texts.append(text_value)
-                        elif content.type == "file":
-                            file_id = content.file.file_id
-                            file_mime_type = content.file.mime_type
-                            response_files.append((file_id, file_mime_type))
-
-                    for file_id, mime_type in response_files:
-                        try:
-                            logger.debug(f"Retrieving content for file ID: {file_id} with MIME type: {mime_type}")
-                            file_response = await client.files.content(file_id)
-                            file_content = file_response.content if hasattr(file_response, 'content') else file_response
-                            logger.debug(f"File content retrieved for file ID: {file_id}. Content length: {len(file_content)}")
-
-                            # Determine file extension based on MIME type
-                            extensions = {
-                                "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
-                                "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
-                                "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
-                                "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
-                                "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
-                                "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
-                                "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
-                                "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
-                                "application/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
-                                "image/png": ".png", "application/x-tar": ".tar",
-                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
-                                "application/xml": "text/xml", "application/zip": ".zip"
-                            }
-                            file_extension = extensions.get(mime_type, ".bin")  # Default to .bin if unknown
-                            logger.debug(f"File extension determined: {file_extension} for MIME type: {mime_type}")
-
-                            # Save the file locally
-                            local_file_path = f"./downloaded_file_{file_id}{file_extension}"
-                            with open(local_file_path, "wb") as local_file:
-                                local_file.write(file_content)
-                            logger.debug(f"File saved locally at {local_file_path}")
-
-                        except Exception as e:
-                            logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {e}")
-                            logger.debug(f"Exception details: {e.__class__.__name__}: {str(e)}")
+                    logger.warning(f"Streaming run failed, falling back to polling: {e}")
+                    stream = False
+            if not stream:
+                if run_state["run_id"] is None:
+                    run_state["run_id"] = await active_run_id(thread_id)
+                if run_state["run_id"] is None:
+                    logger.debug("Creating a run to process the thread with the assistant...")
+                    run = await get_client().beta.threads.runs.create(
+                        thread_id=thread_id,
+                        assistant_id=assistant_id,
+                        model=model
+                    )
+                    run_state["run_id"] = run.id
+                    logger.debug(f"Run created with ID: {run.id}")
+                latest_assistant_message = await poll_run(thread_id, run_state["run_id"], caller, run_state)
 
-                break
-            await asyncio.sleep(1)
+        if latest_assistant_message:
+            response_texts, response_files = await render_assistant_message(latest_assistant_message)
+            in_memory_files = await download_response_files(response_files)
 
+        logger.debug(f"Quota scheduler metrics: {scheduler.metrics()}, tool metrics: {tools.metrics()}, "
+                     f"cache stats: {{'tool_results': {tools.cache.stats()}, 'file_info': {file_info_cache.stats()}}}")
         return {"text": response_texts, "in_memory_files": in_memory_files}
 
     except Exception as e:
@@ -246,59 +501,36 @@ def authenticate_gcs(credentials_path):
         return None
 
 def download_pdfs_from_gcs(storage_client, bucket_name, sub_folder, local_dir):
+    """
+    Syncs drumbeatpdfs/<sub_folder> into local_dir with concurrent, resumable downloads that skip
+    unchanged files. Returns the local paths of every PDF in the folder, or [] on failure.
+    """
     logger.debug(f"Initiating download_pdfs_from_gcs with bucket_name: {bucket_name}, sub_folder: {sub_folder}, local_dir: {local_dir}")
     try:
-        bucket = storage_client.bucket(bucket_name)
-        logger.debug(f"Accessed bucket: {bucket_name}")
-    except Exception as e:
-        logger.error(f"Error accessing bucket {bucket_name}: {e}")
-        return
-
-    try:
-        blobs = bucket.list_blobs(prefix=f"drumbeatpdfs/{sub_folder}/")
-        blob_list = [blob for blob in blobs if blob.name.endswith(".pdf")]
-        logger.info(f"Found {len(blob_list)} PDFs in {sub_folder} to download.")
+        blob_list = list_blobs(storage_client, bucket_name, folder_prefix(sub_folder))
     except Exception as e:
         logger.error(f"Error listing blobs in {bucket_name}/{sub_folder}: {e}")
-        return
+        return []
 
     with alive_bar(len(blob_list), title='Downloading PDFs') as bar:
-        for blob in blob_list:
-            try:
-                destination_file = os.path.join(local_dir, blob.name.split("/")[-1])
-                logger.debug(f"Preparing to download {blob.name} to {destination_file}")
-                blob.download_to_filename(destination_file)
-                logger.info(f"Successfully downloaded {blob.name} to {destination_file}")
-                bar()
-            except Exception as e:
-                logger.error(f"Failed to download {blob.name} to {destination_file}: {e}")
+        result = sync_blobs(blob_list, local_dir, progress=bar, prefix=folder_prefix(sub_folder))
+    return result['downloaded'] + result['skipped']
 
 async def create_and_upload_to_vector_store(file_paths, vector_store_name):
     logger.debug(f"Initiating create_and_upload_to_vector_store with vector_store_name: {vector_store_name} and file_paths: {file_paths}")
     try:
-        vector_store = await client.beta.vector_stores.create(name=vector_store_name)
+        vector_store = await get_client().beta.vector_stores.create(name=vector_store_name)
         logger.info(f"Vector store created with ID: {vector_store.id}")
-
-        file_streams = [open(path, "rb") for path in file_paths]
-        try:
-            file_batch = await client.beta.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=vector_store.id, files=file_streams
-            )
-        finally:
-            for f in file_streams:
-                f.close()
-
-        logger.info(f"File batch status: {file_batch.status}")
-        logger.info(f"File counts in batch: {file_batch.file_counts}")
-
+        # Files uploaded before, e.g. for another store, are attached by file_id instead of uploaded again
+        await ingest_files(get_client(), file_paths, vector_store.id)
         return vector_store.id
-    except AttributeError as e:
+    except Exception as e:
         logger.error(f"Failed to create or upload to vector store: {e}")
         return None
 
 async def update_assistant_with_vector_store(assistant_id, vector_store_id):
     try:
-        await client.beta.assistants.update(
+        await get_client().beta.assistants.update(
             assistant_id=assistant_id,
             tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
         )
@@ -323,56 +555,34 @@ async def main():
     print("[2] Create new vector store")
     vector_store_choice = int(input("Enter your choice: "))
 
-    sub_folders = [
-        "Cobrand",
-        "Cohesive_Infrastructure",
-        "Data_Center_Transformation",
-        "Infrastructure",
-        "Next_Generation_Payments",
-        "Price_Value",
-        "Pricing",
-        "Shared_Services",
-        "Stores_Digital_Marketing_EPS_Customer_Service",
-        "Stores_Digital_Marketing_ETCC",
-        "Supply_Chain_Merch",
-        "Technical_Project_Management_Stores_and_Infra",
-    ]
-    logger.info("Sub-folders defined for processing")
     print("Select the folder to process documents for:")
-    for i, folder in enumerate(sub_folders, 1):
+    for i, folder in enumerate(SUB_FOLDERS, 1):
         print(f"[{i}] {folder.replace('_', ' ')}")
     folder_choice = int(input("Enter your choice: ")) - 1
-    selected_folder = sub_folders[folder_choice]
+    selected_folder = SUB_FOLDERS[folder_choice]
 
-    local_dir = "downloaded_pdfs"
-    os.makedirs(local_dir, exist_ok=True)
-    download_pdfs_from_gcs(storage_client, GCS_BUCKET_DOCS, selected_folder, local_dir)
-
-    file_paths = [os.path.join(local_dir, f) for f in os.listdir(local_dir) if f.endswith(".pdf")]
+    # PDFs are streamed from GCS to OpenAI; set INGEST_CACHE_DIR to also cache the downloaded blobs
+    blobs = list_blobs(storage_client, GCS_BUCKET_DOCS, folder_prefix(selected_folder))
 
     if vector_store_choice == 1:
         vector_store_id = "vs_7HNjrhDESus71F1VeUVHsVgB"
-        await add_files_to_existing_vector_store(file_paths, vector_store_id)
+        await stream_blobs_to_vector_store(get_client(), blobs, vector_store_id, cache_dir=INGEST_CACHE_DIR)
     elif vector_store_choice == 2:
         vector_store_name = f"drumbeat_{selected_folder}" 
-        vector_store_id = await create_and_upload_to_vector_store(file_paths, vector_store_name)
-        if vector_store_id:
-            await update_assistant_with_vector_store(assistant_id, vector_store_id)
+        vector_store = await get_client().beta.vector_stores.create(name=vector_store_name)
+        logger.info(f"Vector store created with ID: {vector_store.id}")
+        await stream_blobs_to_vector_store(get_client(), blobs, vector_store.id, cache_dir=INGEST_CACHE_DIR)
+        await update_assistant_with_vector_store(assistant_id, vector_store.id)
 
 async def add_files_to_existing_vector_store(file_paths, vector_store_id):
+    """Adds new or changed files to a vector store and returns a one-line summary of what was uploaded or skipped."""
     logger.debug(f"Adding files to existing vector store with ID: {vector_store_id}")
     try:
-        file_streams = [open(path, "rb") for path in file_paths]
-        try:
-            file_batch = await client.beta.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=vector_store_id, files=file_streams
-            )
-            logger.info(f"Files added to vector store ID: {vector_store_id}. Batch status: {file_batch.status}")
-        finally:
-            for f in file_streams:
-                f.close()
+        summary = await ingest_files(get_client(), file_paths, vector_store_id)
+        return summary_text(summary)
     except Exception as e:
         logger.error(f"Failed to add files to existing vector store: {e}")
+        return f"Failed to add files to vector store: {e}"
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from quota_scheduler import scheduler
+
+# Shared, bounded pool for the blocking Google API client calls made from the async wrappers
+MAX_WORKERS = int(os.getenv("GOOGLE_API_MAX_WORKERS", "16"))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="google-api")
+
+# Long-lived event loop for synchronous callers such as the Dash callbacks, so pooled
+# async connections survive from one request to the next
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+def get_background_loop():
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="async-background-loop", daemon=True).start()
+        return _background_loop
+
+def run_coroutine(coro):
+    """Runs a coroutine on the background loop and blocks the calling thread until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
+
+async def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+async def execute_async(request, units=None, **kwargs):
+    """
+    Runs a googleapiclient request on the shared executor instead of the event loop,
+    through the quota scheduler so it is rate limited and retried like every other Google call.
+    Args:
+        request: An HttpRequest returned by a service method.
+        units (int): Quota cost override; derived from the request's method by default.
+        **kwargs: Passed through to request.execute().
+
+    Returns:
+        The deserialized API response.
+    """
+    return await run_in_executor(scheduler.execute, request, units, **kwargs)
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+def write_atomic(path, data):
+    """
+    Replaces path with data (str or bytes) so readers see either the old or the new content in full.
+    The data is written to a temporary file in the same directory, flushed to disk, then renamed into place.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,128 @@
+import math
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from logger_config import logger
+
+CALENDAR_STORE_FILE = 'calendar-events.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE,
+    summary TEXT,
+    start TEXT,
+    end TEXT,
+    location TEXT,
+    description TEXT,
+    attendees TEXT,
+    start_ts REAL,
+    end_ts REAL
+);
+-- Coarse interval index in whole minutes; exact bounds are checked against events.start_ts/end_ts
+CREATE VIRTUAL TABLE IF NOT EXISTS event_intervals USING rtree_i32(rowid, start_minute, end_minute);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def to_timestamp(value):
+    """Converts an event's dateTime (RFC 3339) or all-day date to a UTC timestamp."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def event_details(event):
+    """Flattens a Calendar API event into the shape returned by gmailapi.get_events_for_next_10_days."""
+    return {
+        'id': event['id'],
+        'summary': event.get('summary', 'No Title'),
+        'start': event['start'].get('dateTime', event['start'].get('date')),
+        'end': event['end'].get('dateTime', event['end'].get('date')),
+        'location': event.get('location', 'No Location Specified'),
+        'description': event.get('description', 'No Description'),
+        'attendees': ', '.join([attendee['email'] for attendee in event.get('attendees', []) if 'email' in attendee]),
+    }
+
+class CalendarStore:
+    """Local copy of calendar events with an R*Tree interval index over their start/end times."""
+    def __init__(self, path=CALENDAR_STORE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+
+    def get_sync_token(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = 'sync_token'").fetchone()
+        return row['value'] if row else None
+
+    def set_sync_token(self, sync_token):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('sync_token', ?)", (sync_token,))
+
+    def get_sync_window(self):
+        """(start, end) timestamps of the window the sync token covers, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = 'sync_window'").fetchone()
+        return tuple(float(value) for value in row['value'].split(',')) if row else None
+
+    def set_sync_window(self, start_ts, end_ts):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('sync_window', ?)", (f"{start_ts},{end_ts}",))
+
+    def covers(self, start, end):
+        """True if [start, end) lies inside the synced window; naive datetimes are taken as UTC."""
+        window = self.get_sync_window()
+        return window is not None and window[0] <= to_timestamp(start.isoformat()) and to_timestamp(end.isoformat()) <= window[1]
+
+    def upsert_event(self, event):
+        details = event_details(event)
+        start_ts, end_ts = to_timestamp(details['start']), to_timestamp(details['end'])
+        with self._lock, self._conn:
+            self._delete(details['id'])
+            cursor = self._conn.execute(
+                "INSERT INTO events (id, summary, start, end, location, description, attendees, start_ts, end_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (details['id'], details['summary'], details['start'], details['end'], details['location'], details['description'], details['attendees'], start_ts, end_ts))
+            self._conn.execute("INSERT INTO event_intervals (rowid, start_minute, end_minute) VALUES (?, ?, ?)",
+                               (cursor.lastrowid, math.floor(start_ts / 60), math.ceil(max(start_ts, end_ts) / 60)))
+
+    def delete_event(self, event_id):
+        with self._lock, self._conn:
+            self._delete(event_id)
+
+    def reset(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM events")
+            self._conn.execute("DELETE FROM event_intervals")
+            self._conn.execute("DELETE FROM sync_state")
+
+    def events_between(self, start, end):
+        """
+        Returns events overlapping [start, end), ordered by start time.
+        Args:
+            start (datetime): Window start; naive values are taken as UTC.
+            end (datetime): Window end; naive values are taken as UTC.
+        """
+        start_ts = to_timestamp(start.isoformat())
+        end_ts = to_timestamp(end.isoformat())
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT events.* FROM event_intervals
+                JOIN events ON events.rowid = event_intervals.rowid
+                WHERE event_intervals.start_minute <= ? AND event_intervals.end_minute >= ?
+                  AND events.start_ts < ? AND events.end_ts > ?
+                ORDER BY events.start_ts
+            """, (math.ceil(end_ts / 60), math.floor(start_ts / 60), end_ts, start_ts)).fetchall()
+        logger.debug(f"{len(rows)} cached events between {start} and {end}.")
+        return [{'summary': row['summary'], 'start': row['start'], 'end': row['end'], 'location': row['location'],
+                 'description': row['description'], 'attendees': row['attendees']} for row in rows]
+
+    def _delete(self, event_id):
+        row = self._conn.execute("SELECT rowid FROM events WHERE id = ?", (event_id,)).fetchone()
+        if row:
+            self._conn.execute("DELETE FROM event_intervals WHERE rowid = ?", (row['rowid'],))
+            self._conn.execute("DELETE FROM events WHERE rowid = ?", (row['rowid'],))
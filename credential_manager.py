@@ -0,0 +1,214 @@
+import os
+import asyncio
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
+from logger_config import logger
+from http_pool import get_requests_session
+from async_executor import run_in_executor
+from atomic_write import write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+# Refresh this long before the token actually expires
+REFRESH_MARGIN_SECONDS = 300
+# Waiters also re-check the token file this often, to notice authorization completed by another process
+TOKEN_FILE_WATCH_SECONDS = 1
+
+class CredentialManager:
+    """
+    Keeps one token file's credentials in memory and refreshes them ahead of expiry.
+
+    Concurrent refreshes collapse into a single in-flight request, and the file is
+    rewritten atomically under an exclusive lock so several worker processes can
+    share it; a process that sees a newer file on disk adopts it instead of refreshing.
+    authorize() runs a single consent flow for any number of concurrent waiters and wakes
+    them as soon as the new credentials are stored.
+    """
+    def __init__(self, path, scopes, refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.path = path
+        self.scopes = scopes
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._credentials = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+        self._flow = None
+        self._waiters = set()  # (loop, asyncio.Event) per task waiting in authorize()
+
+    def get_credentials(self):
+        """Returns valid credentials, refreshing them if needed, or None when there are none."""
+        credentials = self._load()
+        if credentials is None:
+            return None
+        if credentials.valid and not self._expiring(credentials):
+            return credentials
+        if credentials.refresh_token:
+            return self.refresh(stale_token=credentials.token)
+        return credentials if credentials.valid else None
+
+    def refresh(self, stale_token=None):
+        """
+        Refreshes the access token, unless another caller or process already replaced stale_token.
+        Returns the refreshed credentials. If the refresh fails for another reason than a revoked or
+        invalid refresh token, the current credentials are returned while they have not yet expired;
+        otherwise None.
+        """
+        with self._refresh_lock:
+            with self._file_lock():
+                credentials = self._load()
+                if credentials is None:
+                    return None
+                if stale_token is not None and credentials.token != stale_token and credentials.valid and not self._expiring(credentials):
+                    logger.debug("Credentials already refreshed by another caller.")
+                    return credentials
+                logger.debug("Refreshing access token.")
+                try:
+                    credentials.refresh(Request(session=get_requests_session()))
+                except RefreshError as e:
+                    # The server rejected the refresh token: it was revoked or is invalid
+                    logger.error(f"Failed to refresh access token: {e}")
+                    return None
+                except Exception as e:
+                    if credentials.token and credentials.expiry is not None and credentials.expiry > datetime.utcnow():
+                        logger.warning(f"Failed to refresh access token, using the current one until it expires: {e}")
+                        return credentials
+                    logger.error(f"Failed to refresh access token: {e}")
+                    return None
+                self._write(credentials.to_json())
+            with self._lock:
+                self._credentials = credentials
+            self._schedule_refresh(credentials)
+            logger.debug("Credentials refreshed and saved.")
+            return credentials if credentials.valid else None
+
+    def store(self, credentials):
+        """Saves newly authorized credentials to the token file and drops the in-memory copy."""
+        with self._file_lock():
+            self._write(credentials.to_json())
+        with self._lock:
+            self._credentials = None
+            self._mtime = None
+        self._notify()
+
+    async def authorize(self, run_flow, timeout=None):
+        """
+        Returns valid credentials, running run_flow to obtain consent when there are none.
+        Args:
+            run_flow (callable): Blocking function that completes the OAuth flow and calls store().
+                Concurrent callers share one in-flight run.
+            timeout (float): Seconds to wait for the user; None waits until the flow ends.
+
+        Returns:
+            Credentials, or None if the flow ended or timed out without producing any.
+        """
+        credentials = await run_in_executor(self.get_credentials)
+        if credentials:
+            return credentials
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._lock:
+            self._waiters.add(waiter)
+            if self._flow is None:
+                logger.info("No valid credentials. Starting authorization flow.")
+                self._flow = threading.Thread(target=self._run_flow, args=(run_flow,), name="oauth-flow", daemon=True)
+                self._flow.start()
+            flow = self._flow
+        deadline = None if timeout is None else loop.time() + timeout
+        try:
+            while True:
+                credentials = await run_in_executor(self.get_credentials)
+                if credentials or not flow.is_alive():
+                    return credentials
+                wait = TOKEN_FILE_WATCH_SECONDS if deadline is None else min(TOKEN_FILE_WATCH_SECONDS, deadline - loop.time())
+                if wait <= 0:
+                    logger.error("Timed out waiting for authorization.")
+                    return None
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                waiter[1].clear()
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def _run_flow(self, run_flow):
+        try:
+            run_flow()
+        except Exception as e:
+            logger.error(f"Authorization flow failed: {e}")
+        finally:
+            with self._lock:
+                self._flow = None
+            self._notify()
+
+    def _notify(self):
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop already closed
+                pass
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._credentials = None
+                self._mtime = None
+            return None
+        with self._lock:
+            if self._credentials is not None and mtime == self._mtime:
+                return self._credentials
+        logger.debug("Loading credentials from disk.")
+        credentials = Credentials.from_authorized_user_file(self.path, self.scopes)
+        with self._lock:
+            self._credentials = credentials
+            self._mtime = mtime
+        self._schedule_refresh(credentials)
+        return credentials
+
+    def _write(self, content):
+        write_atomic(self.path, content)
+        with self._lock:
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _expiring(self, credentials):
+        return credentials.expiry is not None and credentials.expiry - datetime.utcnow() < self.refresh_margin
+
+    def _schedule_refresh(self, credentials):
+        if not credentials.refresh_token or credentials.expiry is None:
+            return
+        delay = (credentials.expiry - datetime.utcnow() - self.refresh_margin).total_seconds()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(max(delay, 0), self._background_refresh, args=(credentials.token,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_refresh(self, stale_token):
+        logger.debug("Refreshing access token ahead of expiry.")
+        self.refresh(stale_token=stale_token)
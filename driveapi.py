@@ -1,12 +1,10 @@
-import os
 import json
 import base64
 from logger_config import logger
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from concurrent.futures import ThreadPoolExecutor
-import asyncio
+from async_executor import run_in_executor, execute_async
+from quota_scheduler import scheduler
+from service_registry import get_service
+from credential_manager import CredentialManager
 import httplib2
 from email.message import EmailMessage
 import re
@@ -22,48 +20,28 @@ CREDENTIALS_STORAGE_FILE = 'drive-api-credentials.json'
 # Configure logging
 httplib2.debuglevel = 4
 
-executor = ThreadPoolExecutor()
-
-async def run_in_executor(func, *args):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(executor, func, *args)
+credential_manager = CredentialManager(CREDENTIALS_STORAGE_FILE, API_SCOPE)
 
 def start_oauth_flow():
-    credentials = None
-    if os.path.exists(CREDENTIALS_STORAGE_FILE):
-        credentials = Credentials.from_authorized_user_file(CREDENTIALS_STORAGE_FILE, API_SCOPE)
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-        else:
-            from oauth2client.client import flow_from_clientsecrets
-            flow = flow_from_clientsecrets(CLIENT_SECRET_FILE, scope=API_SCOPE, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
-            auth_uri = flow.step1_get_authorize_url()
-            logger.info(f"Please go to this URL and authorize the application: {auth_uri}")
-            auth_code = input('Enter the authorization code here: ')
-            credentials = flow.step2_exchange(auth_code)
-            with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-                token.write(credentials.to_json())
+    credentials = credential_manager.get_credentials()
+    if not credentials:
+        from oauth2client.client import flow_from_clientsecrets
+        flow = flow_from_clientsecrets(CLIENT_SECRET_FILE, scope=API_SCOPE, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+        auth_uri = flow.step1_get_authorize_url()
+        logger.info(f"Please go to this URL and authorize the application: {auth_uri}")
+        auth_code = input('Enter the authorization code here: ')
+        credentials = flow.step2_exchange(auth_code)
+        credential_manager.store(credentials)
     return credentials
 
-async def start_oauth_and_server():
-    return await run_in_executor(start_oauth_flow)
+async def start_oauth_and_server(timeout=None):
+    """Waits for valid credentials, sharing one OAuth flow between every concurrent caller."""
+    return await credential_manager.authorize(start_oauth_flow, timeout)
 
 def check_access_token():
-    logger.debug("Checking if credentials storage file exists.")
-    if os.path.exists(CREDENTIALS_STORAGE_FILE):
-        logger.debug("Credentials file found, loading credentials.")
-        credentials = Credentials.from_authorized_user_file(CREDENTIALS_STORAGE_FILE, API_SCOPE)
-        if credentials and credentials.valid:
-            logger.debug("Credentials are valid.")
-            return credentials
-        elif credentials and credentials.expired and credentials.refresh_token:
-            logger.debug("Credentials expired, refreshing token.")
-            credentials.refresh(Request())
-            with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-                token.write(credentials.to_json())
-                logger.debug("Credentials refreshed and saved.")
-            return credentials if credentials.valid else None
+    credentials = credential_manager.get_credentials()
+    if credentials:
+        return credentials
     logger.debug("Credentials file not found or credentials not valid.")
     return None
 
@@ -73,13 +51,8 @@ async def check_saved_access_token():
 
 def refresh_access_token_sync():
     logger.debug("Synchronously refreshing access token.")
-    credentials = check_access_token()
-    if credentials and credentials.expired:
-        logger.debug("Token expired, refreshing.")
-        credentials.refresh(Request())
-        with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-            token.write(credentials.to_json())
-            logger.debug("Token refreshed and saved.")
+    credentials = credential_manager.refresh()
+    if credentials:
         return credentials.token
     logger.debug("No valid credentials available for refresh.")
     return None
@@ -93,9 +66,9 @@ async def list_drive_files():
     if not credentials:
         logger.error("No valid credentials available for Google Drive access.")
         return []
-    service = build('drive', 'v3', credentials=credentials)
-    results = service.files().list(
-        pageSize=10, fields="nextPageToken, files(id, name)").execute()
+    service = await run_in_executor(get_service, 'drive', 'v3', credentials)
+    results = await execute_async(service.files().list(
+        pageSize=10, fields="nextPageToken, files(id, name)"))
     items = results.get('files', [])
     if not items:
         logger.info("No files found in Google Drive.")
@@ -107,9 +80,9 @@ async def download_drive_file(file_id, file_name):
     if not credentials:
         logger.error("No valid credentials available for downloading.")
         return None
-    service = build('drive', 'v3', credentials=credentials)
+    service = await run_in_executor(get_service, 'drive', 'v3', credentials)
     try:
-        file = service.files().get(fileId=file_id, fields='mimeType').execute()
+        file = await execute_async(service.files().get(fileId=file_id, fields='mimeType'))
     except googleapiclient.errors.HttpError as error:
         logger.error(f"Failed to retrieve file: {error}")
         return None
@@ -175,9 +148,12 @@ async def download_drive_file(file_id, file_name):
     downloader = MediaIoBaseDownload(fh, request)
     done = False
     while not done:
-        status, done = downloader.next_chunk()
+        status, done = await run_in_executor(scheduler.call, downloader.next_chunk, 'drive')
         logger.info("Download %d%%." % int(status.progress() * 100))
     file_name = file_name.replace('/', '_')  # Sanitize file_name to replace slashes with underscores
-    with open(file_name, 'wb') as f:
-        f.write(fh.getvalue())
+    await run_in_executor(write_file, file_name, fh.getvalue())
     return file_name
+
+def write_file(file_name, content):
+    with open(file_name, 'wb') as f:
+        f.write(content)
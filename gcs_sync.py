@@ -0,0 +1,161 @@
+import os
+import glob
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logger_config import logger
+
+try:
+    import google_crc32c
+except ImportError:  # fall back to MD5, which composite objects do not have
+    google_crc32c = None
+
+# Concurrent blob downloads per sync; transfers are latency-bound, so more than the CPU count helps
+GCS_DOWNLOAD_WORKERS = int(os.getenv("GCS_DOWNLOAD_WORKERS", "8"))
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# Drumbeat document folders, each under drumbeatpdfs/<folder>/ in the docs bucket
+PDF_ROOT = "drumbeatpdfs"
+SUB_FOLDERS = [
+    "Cobrand",
+    "Cohesive_Infrastructure",
+    "Data_Center_Transformation",
+    "Infrastructure",
+    "Next_Generation_Payments",
+    "Price_Value",
+    "Pricing",
+    "Shared_Services",
+    "Stores_Digital_Marketing_EPS_Customer_Service",
+    "Stores_Digital_Marketing_ETCC",
+    "Supply_Chain_Merch",
+    "Technical_Project_Management_Stores_and_Infra",
+]
+
+def folder_prefix(sub_folder):
+    return f"{PDF_ROOT}/{sub_folder}/"
+
+def local_checksums(path):
+    """Base64 CRC32C and MD5 of a local file, in the encoding GCS uses for blob metadata."""
+    md5 = hashlib.md5()
+    crc = google_crc32c.Checksum() if google_crc32c else None
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    return {
+        'crc32c': base64.b64encode(crc.digest()).decode() if crc is not None else None,
+        'md5': base64.b64encode(md5.digest()).decode(),
+    }
+
+def matches_blob(blob, path):
+    """True if the local file has the blob's size and checksum (CRC32C when available, else MD5)."""
+    if not os.path.exists(path) or os.path.getsize(path) != blob.size:
+        return False
+    checksums = local_checksums(path)
+    if blob.crc32c and checksums['crc32c']:
+        return checksums['crc32c'] == blob.crc32c
+    if blob.md5_hash:
+        return checksums['md5'] == blob.md5_hash
+    return True
+
+def download_blob(blob, destination):
+    """
+    Downloads a blob through a generation-specific .part file and renames it into place once
+    its checksum is verified. An interrupted download of the same generation resumes where it stopped.
+    """
+    partial = f"{destination}.{blob.generation}.part"
+    for stale in glob.glob(glob.escape(destination) + ".*.part"):
+        if stale != partial:
+            os.unlink(stale)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if offset >= blob.size:
+        offset = 0
+    if offset:
+        logger.debug(f"Resuming {blob.name} at byte {offset}")
+    with open(partial, "ab" if offset else "wb") as f:
+        blob.download_to_file(f, start=offset or None, checksum=None)
+    if not matches_blob(blob, partial):
+        os.unlink(partial)
+        raise IOError(f"Checksum mismatch for {blob.name}")
+    os.replace(partial, destination)
+
+def list_blobs(storage_client, bucket_name, prefix, suffix=".pdf"):
+    blobs = [blob for blob in storage_client.bucket(bucket_name).list_blobs(prefix=prefix) if blob.name.endswith(suffix)]
+    logger.info(f"Found {len(blobs)} files under {prefix} to sync.")
+    return blobs
+
+def local_path(blob, local_dir, prefix=""):
+    """Where a blob is mirrored: its name relative to prefix, so nested blobs keep their subdirectories."""
+    relative = blob.name[len(prefix):] if prefix and blob.name.startswith(prefix) else blob.name.split("/")[-1]
+    path = os.path.normpath(os.path.join(local_dir, *relative.split("/")))
+    if os.path.commonpath([os.path.abspath(path), os.path.abspath(local_dir)]) != os.path.abspath(local_dir):
+        raise ValueError(f"{blob.name} would be written outside {local_dir}")
+    return path
+
+def sync_blobs(blobs, local_dir, max_workers=GCS_DOWNLOAD_WORKERS, progress=None, prefix=""):
+    """
+    Mirrors blobs into local_dir using a bounded pool of concurrent transfers.
+    Files already present with a matching checksum are skipped.
+    Args:
+        blobs (list): Blobs from list_blobs.
+        local_dir (str): Destination directory.
+        max_workers (int): Concurrent downloads.
+        progress (callable): Called with no arguments as each blob finishes, e.g. an alive_bar.
+        prefix (str): The listed prefix; files keep their path below it. Without one they keep their
+            base names, and blobs whose base names collide fail instead of overwriting each other.
+
+    Returns:
+        dict: Local paths of the 'downloaded' and 'skipped' files, and blob names of the 'failed' ones.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    result = {'downloaded': [], 'skipped': [], 'failed': []}
+
+    # Two workers writing one destination would also delete each other's .part files
+    destinations = {}
+    for blob in blobs:
+        try:
+            destinations[blob.name] = local_path(blob, local_dir, prefix)
+        except ValueError as e:
+            logger.error(str(e))
+    claimed = {}
+    for name, destination in destinations.items():
+        claimed.setdefault(os.path.normcase(destination), []).append(name)
+    for names in claimed.values():
+        if len(names) > 1:
+            logger.error(f"Not downloading {', '.join(names)}: they map to the same local file.")
+            for name in names:
+                del destinations[name]
+
+    def sync_blob(blob):
+        destination = destinations[blob.name]
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if matches_blob(blob, destination):
+            return 'skipped', destination
+        download_blob(blob, destination)
+        return 'downloaded', destination
+
+    for blob in blobs:
+        if blob.name not in destinations:
+            result['failed'].append(blob.name)
+            if progress:
+                progress()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcs-download") as pool:
+        futures = {pool.submit(sync_blob, blob): blob for blob in blobs if blob.name in destinations}
+        for future in as_completed(futures):
+            blob = futures[future]
+            try:
+                outcome, destination = future.result()
+                result[outcome].append(destination)
+                logger.debug(f"{outcome.capitalize()} {blob.name}")
+            except Exception as e:
+                logger.error(f"Failed to download {blob.name}: {e}")
+                result['failed'].append(blob.name)
+            if progress:
+                progress()
+    logger.info(f"Synced {len(blobs)} files to {local_dir}: {len(result['downloaded'])} downloaded, {len(result['skipped'])} unchanged, {len(result['failed'])} failed.")
+    return result
+
+def sync_prefix(storage_client, bucket_name, prefix, local_dir, suffix=".pdf", max_workers=GCS_DOWNLOAD_WORKERS, progress=None):
+    """list_blobs followed by sync_blobs; returns its result."""
+    return sync_blobs(list_blobs(storage_client, bucket_name, prefix, suffix), local_dir, max_workers, progress, prefix)
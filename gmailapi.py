@@ -2,11 +2,17 @@ import os
 import json
 import base64
 from logger_config import logger
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from concurrent.futures import ThreadPoolExecutor
 import asyncio
+from async_executor import run_in_executor, execute_async
+from quota_scheduler import scheduler, is_retryable, METHOD_QUOTA_UNITS, MAX_RETRIES
+from http_pool import pool_stats
+from service_registry import get_service, credential_identity
+from credential_manager import CredentialManager
+from mailstore import MailStore, message_from_resource
+from calendarstore import CalendarStore, event_details
+from googleapiclient.errors import HttpError
+import threading
 import httplib2
 from email.message import EmailMessage
 import re
@@ -19,52 +25,69 @@ API_SCOPE = [
     'https://www.googleapis.com/auth/calendar'
 ]
 CREDENTIALS_STORAGE_FILE = 'gmail-api-credentials.json'
+# Gmail accepts up to 100 calls per batch request but recommends no more than 50
+GMAIL_BATCH_SIZE = 50
+RELEVANT_SENDER_DOMAINS = ['kohls.com', 'google.com']
+RELEVANT_SENDER_QUERY = '(' + ' OR '.join(f'from:*@{domain}' for domain in RELEVANT_SENDER_DOMAINS) + ')'
+SYNC_METADATA_HEADERS = ['subject', 'from', 'to', 'date']
+# Upper bound on how many inbox messages the initial full sync pulls into the local store; 0 for the whole inbox.
+# Mail from RELEVANT_SENDER_DOMAINS is listed separately, so fetch_relevant_emails sees as much of it as the API would.
+FULL_SYNC_MAX_MESSAGES = int(os.getenv("GMAIL_FULL_SYNC_MAX_MESSAGES", "500"))
+# Days before and after now that the local calendar cache holds; recurring events are expanded within them
+CALENDAR_SYNC_PAST_DAYS = int(os.getenv("CALENDAR_SYNC_PAST_DAYS", "30"))
+CALENDAR_SYNC_FUTURE_DAYS = int(os.getenv("CALENDAR_SYNC_FUTURE_DAYS", "365"))
 
 # Configure logging
 
 httplib2.debuglevel = 4
 
-executor = ThreadPoolExecutor()
+credential_manager = CredentialManager(CREDENTIALS_STORAGE_FILE, API_SCOPE)
 
-async def run_in_executor(func, *args):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(executor, func, *args)
+mail_store = None
+_mail_store_lock = threading.Lock()
+_sync_lock = threading.Lock()
+calendar_store = None
+_calendar_store_lock = threading.Lock()
+_calendar_sync_lock = threading.Lock()
+
+def get_mail_store():
+    global mail_store
+    with _mail_store_lock:
+        if mail_store is None:
+            mail_store = MailStore()
+        return mail_store
+
+def get_calendar_store():
+    global calendar_store
+    with _calendar_store_lock:
+        if calendar_store is None:
+            calendar_store = CalendarStore()
+        return calendar_store
 
 def start_oauth_flow():
-    credentials = None
-    if os.path.exists(CREDENTIALS_STORAGE_FILE):
-        credentials = Credentials.from_authorized_user_file(CREDENTIALS_STORAGE_FILE, API_SCOPE)
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-        else:
-            from oauth2client.client import flow_from_clientsecrets
-            flow = flow_from_clientsecrets(CLIENT_SECRET_FILE, scope=API_SCOPE, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
-            auth_uri = flow.step1_get_authorize_url()
-            logger.info(f"Please go to this URL and authorize the application: {auth_uri}")
-            auth_code = input('Enter the authorization code here: ')
-            credentials = flow.step2_exchange(auth_code)
-            with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-                token.write(credentials.to_json())
+    credentials = credential_manager.get_credentials()
+    if not credentials:
+        from oauth2client.client import flow_from_clientsecrets
+        flow = flow_from_clientsecrets(CLIENT_SECRET_FILE, scope=API_SCOPE, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+        auth_uri = flow.step1_get_authorize_url()
+        logger.info(f"Please go to this URL and authorize the application: {auth_uri}")
+        auth_code = input('Enter the authorization code here: ')
+        credentials = flow.step2_exchange(auth_code)
+        credential_manager.store(credentials)
     return credentials
-async def start_oauth_and_server():
-    return await run_in_executor(start_oauth_flow)
+async def start_oauth_and_server(timeout=None):
+    """Waits for valid credentials, sharing one OAuth flow between every concurrent caller."""
+    return await credential_manager.authorize(start_oauth_flow, timeout)
+
+async def current_account():
+    """Identity of the signed-in Google account, or None before sign-in; scopes cached tool results."""
+    credentials = await check_saved_access_token()
+    return credential_identity(credentials) if credentials else None
 
 def check_access_token():
-    logger.debug("Checking if credentials storage file exists.")
-    if os.path.exists(CREDENTIALS_STORAGE_FILE):
-        logger.debug("Credentials file found, loading credentials.")
-        credentials = Credentials.from_authorized_user_file(CREDENTIALS_STORAGE_FILE, API_SCOPE)
-        if credentials and credentials.valid:
-            logger.debug("Credentials are valid.")
-            return credentials
-        elif credentials and credentials.expired and credentials.refresh_token:
-            logger.debug("Credentials expired, refreshing token.")
-            credentials.refresh(Request())
-            with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-                token.write(credentials.to_json())
-                logger.debug("Credentials refreshed and saved.")
-            return credentials if credentials.valid else None
+    credentials = credential_manager.get_credentials()
+    if credentials:
+        return credentials
     logger.debug("Credentials file not found or credentials not valid.")
     return None
 
@@ -74,13 +97,8 @@ async def check_saved_access_token():
 
 def refresh_access_token_sync():
     logger.debug("Synchronously refreshing access token.")
-    credentials = check_access_token()
-    if credentials and credentials.expired:
-        logger.debug("Token expired, refreshing.")
-        credentials.refresh(Request())
-        with open(CREDENTIALS_STORAGE_FILE, 'w') as token:
-            token.write(credentials.to_json())
-            logger.debug("Token refreshed and saved.")
+    credentials = credential_manager.refresh()
+    if credentials:
         return credentials.token
     logger.debug("No valid credentials available for refresh.")
     return None
@@ -89,36 +107,68 @@ async def refresh_access_token():
     logger.debug("Asynchronously refreshing access token.")
     return await run_in_executor(refresh_access_token_sync)
 
-async def fetch_unread_emails():
+def fetch_message_metadata_batch(service, message_ids, metadata_headers, batch_size=GMAIL_BATCH_SIZE, failed_ids=None):
+    """
+    Fetches metadata for several messages using Gmail batch HTTP requests.
+    Args:
+        service: An authorized Gmail service instance.
+        message_ids (list): IDs of the messages to fetch.
+        metadata_headers (list): Headers to include in each message's payload.
+        batch_size (int): Maximum number of messages per batch request.
+        failed_ids (list): Receives the IDs that could not be fetched because of a transient error,
+            such as a failed batch or exhausted retries; deleted messages are not included.
+
+    Returns:
+        dict: Message ID -> message resource, for every message that was fetched successfully.
+    """
+    details = {}
+    retry_ids = []
+
+    def handle_response(request_id, response, exception):
+        if exception is not None:
+            if is_retryable(exception):
+                retry_ids.append(request_id)
+                return
+            logger.error(f"Error fetching details for message ID {request_id}: {exception}")
+            return
+        details[request_id] = response
+
+    for start in range(0, len(message_ids), batch_size):
+        pending = message_ids[start:start + batch_size]
+        # Items rate limited inside an otherwise successful batch are retried on their own
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                scheduler.backoff('gmail', attempt - 1)
+            retry_ids.clear()
+            batch = service.new_batch_http_request(callback=handle_response)
+            for message_id in pending:
+                batch.add(service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=metadata_headers), request_id=message_id)
+            try:
+                logger.debug(f"Sending batch request for {len(pending)} messages.")
+                scheduler.call(batch.execute, 'gmail', len(pending) * METHOD_QUOTA_UNITS['gmail.users.messages.get'])
+            except Exception as e:
+                logger.error(f"Batch request for {len(pending)} messages failed: {e}")
+                if failed_ids is not None:
+                    failed_ids.extend(message_id for message_id in pending if message_id not in details)
+                break
+            if not retry_ids:
+                break
+            pending = list(retry_ids)
+        else:
+            logger.error(f"Gave up fetching details for message IDs {retry_ids} after {MAX_RETRIES} retries.")
+            if failed_ids is not None:
+                failed_ids.extend(retry_ids)
+    return details
+
+async def fetch_unread_emails(batch_size=GMAIL_BATCH_SIZE, from_store=False):
     logger.debug("Starting the process to fetch priority emails.")
-    credentials = await check_saved_access_token()
-    if not credentials:
-        logger.error("Failed to retrieve valid credentials. Cannot proceed with fetching emails.")
-        return []
-    logger.debug(f"Credentials obtained: {credentials.token}")
-    service = build('gmail', 'v1', credentials=credentials)
-    logger.debug("Gmail service instance created successfully.")
-    try:
-        logger.debug("Attempting to list messages with API call.")
-        results = service.users().messages().list(userId='me', labelIds=['INBOX'], q='-in:replies', maxResults=5).execute()
-        logger.debug(f"API request sent. Received response: {results}")
-    except Exception as e:
-        logger.error(f"Failed to fetch messages due to an error: {e}")
-        return []
-    messages = results.get('messages', [])
-    emails_info = []
-    logger.debug(f"Total priority messages retrieved: {len(messages)}")
-    for msg in messages:
-        logger.debug(f"Processing message ID: {msg['id']}")
-        try:
-            msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='metadata', metadataHeaders=['subject']).execute()
-            logger.debug(f"Details fetched for message ID {msg['id']}: {msg_detail}")
-            subject_header = next((header['value'] for header in msg_detail['payload']['headers'] if header['name'].lower() == 'subject'), 'No Subject')
-            emails_info.append({'id': msg['id'], 'subject': subject_header})
-            logger.debug(f"Message ID: {msg['id']} has subject: {subject_header}")
-        except Exception as e:
-            logger.error(f"Error fetching details for message ID {msg['id']}: {e}")
-            continue
+    if from_store:
+        await sync_mailbox(batch_size)
+        emails = get_mail_store().query_messages(label_id='INBOX', exclude_replies=True, limit=5)
+        return [{'id': email['id'], 'subject': email['subject']} for email in emails]
+    emails_info = [{'id': email['id'], 'subject': email['subject']}
+                   async for email in iter_messages(query='-in:replies', label_ids=['INBOX'], limit=5, batch_size=batch_size)]
+    logger.debug(f"Total priority messages retrieved: {len(emails_info)}")
     return emails_info
 
 async def fetch_email_content(email_id):
@@ -126,11 +176,11 @@ async def fetch_email_content(email_id):
     if not credentials:
         logger.error("No valid credentials available.")
         return None
-    service = build('gmail', 'v1', credentials=credentials)
+    service = await run_in_executor(get_service, 'gmail', 'v1', credentials)
     try:
         # Fetching metadata with additional headers
         metadata_headers = ['From', 'To', 'Cc', 'Subject', 'Date']
-        message = service.users().messages().get(userId='me', id=email_id, format='metadata', metadataHeaders=metadata_headers).execute()
+        message = await execute_async(service.users().messages().get(userId='me', id=email_id, format='metadata', metadataHeaders=metadata_headers))
         
         # Extracting email details from headers
         headers = message.get('payload', {}).get('headers', [])
@@ -145,42 +195,202 @@ async def fetch_email_content(email_id):
         logger.error(f"Failed to fetch email content: {e}")
         return None
 
-async def fetch_relevant_emails(max_results=15, include_snippets=True):
+async def fetch_relevant_emails(max_results=15, include_snippets=True, batch_size=GMAIL_BATCH_SIZE, from_store=False):
     logger.debug("Starting the process to fetch relevant emails.")
+    if from_store:
+        await sync_mailbox(batch_size)
+        emails_info = get_mail_store().query_messages(label_id='INBOX', sender_domains=RELEVANT_SENDER_DOMAINS, limit=max_results)
+    else:
+        emails_info = [email async for email in iter_messages(query=RELEVANT_SENDER_QUERY, label_ids=['INBOX'], limit=max_results, batch_size=batch_size)]
+        logger.debug(f"Total relevant messages retrieved: {len(emails_info)}")
+    if not include_snippets:
+        for email in emails_info:
+            email['snippet'] = None
+    return emails_info
+
+async def iter_messages(query=None, page_size=100, limit=None, label_ids=None, batch_size=GMAIL_BATCH_SIZE):
+    """
+    Streams message summaries page by page, following nextPageToken.
+    The next page is listed and its metadata batch-fetched while the caller consumes the current one,
+    so at most two pages are held in memory. Messages whose metadata still cannot be fetched after a
+    second attempt are logged and left out.
+    Args:
+        query (str): Gmail search query, e.g. 'from:*@kohls.com'.
+        page_size (int): Messages per list call (Gmail allows up to 500).
+        limit (int): Stop after this many messages; None for all matches.
+        label_ids (list): Only list messages with all of these labels.
+        batch_size (int): Maximum number of messages per metadata batch request.
+
+    Yields:
+        dict: id, subject, snippet, from, to and date of each message, in list order.
+    """
     credentials = await check_saved_access_token()
     if not credentials:
-        logger.error("Failed to retrieve valid credentials. Cannot proceed with fetching emails.")
-        return []
-    logger.debug(f"Credentials obtained: {credentials.token}")
-    service = build('gmail', 'v1', credentials=credentials)
-    logger.debug("Gmail service instance created successfully.")
+        logger.error("Failed to retrieve valid credentials. Cannot proceed with listing emails.")
+        return
+    service = await run_in_executor(get_service, 'gmail', 'v1', credentials)
+
+    def fetch_page(page_token, max_results):
+        response = scheduler.execute(service.users().messages().list(userId='me', q=query, labelIds=label_ids, maxResults=max_results, pageToken=page_token))
+        message_ids = [msg['id'] for msg in response.get('messages', [])]
+        failed_ids = []
+        details = fetch_message_metadata_batch(service, message_ids, SYNC_METADATA_HEADERS, batch_size, failed_ids)
+        if failed_ids:
+            # One more pass for the messages lost to a failed batch or exhausted retries
+            retry_ids, failed_ids = failed_ids, []
+            details.update(fetch_message_metadata_batch(service, retry_ids, SYNC_METADATA_HEADERS, batch_size, failed_ids))
+            if failed_ids:
+                logger.error(f"Leaving out {len(failed_ids)} messages whose metadata could not be fetched: {failed_ids}")
+        return [message_from_resource(details[message_id]) for message_id in message_ids if message_id in details], response.get('nextPageToken')
+
+    def page_request(page_token):
+        max_results = page_size if remaining is None else min(page_size, remaining)
+        return asyncio.ensure_future(run_in_executor(fetch_page, page_token, max_results))
+
+    remaining = limit
+    next_page = page_request(None) if remaining is None or remaining > 0 else None
     try:
-        logger.debug("Attempting to list messages with API call.")
-        query = '(from:*@kohls.com OR from:*@google.com)'
-        results = service.users().messages().list(userId='me', labelIds=['INBOX'], q=query, maxResults=max_results).execute()
-        logger.debug(f"API request sent. Received response: {results}")
-    except Exception as e:
-        logger.error(f"Failed to fetch messages due to an error: {e}")
-        return []
-    messages = results.get('messages', [])
-    emails_info = []
-    logger.debug(f"Total relevant messages retrieved: {len(messages)}")
-    for msg in messages:
-        logger.debug(f"Processing message ID: {msg['id']}")
+        while next_page is not None:
+            try:
+                messages, page_token = await next_page
+            except Exception as e:
+                logger.error(f"Failed to fetch messages due to an error: {e}")
+                return
+            next_page = None
+            if remaining is not None:
+                messages = messages[:remaining]
+                remaining -= len(messages)
+            if page_token and (remaining is None or remaining > 0):
+                next_page = page_request(page_token)
+            for message in messages:
+                yield {'id': message['id'], 'subject': message['subject'], 'snippet': message['snippet'], 'from': message['from'], 'to': message['to'], 'date': message['date']}
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+def list_message_ids(service, max_messages, query=None):
+    """IDs of the newest inbox messages matching query, following nextPageToken; max_messages=0 lists them all."""
+    message_ids = []
+    page_token = None
+    while not max_messages or len(message_ids) < max_messages:
+        page_size = min(500, max_messages - len(message_ids)) if max_messages else 500
+        response = scheduler.execute(service.users().messages().list(userId='me', labelIds=['INBOX'], q=query, maxResults=page_size, pageToken=page_token))
+        message_ids.extend(msg['id'] for msg in response.get('messages', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    return message_ids
+
+def full_sync(service, store, max_messages=FULL_SYNC_MAX_MESSAGES, batch_size=GMAIL_BATCH_SIZE):
+    # Read the historyId first so changes made while listing are replayed by the next incremental sync
+    profile = scheduler.execute(service.users().getProfile(userId='me'))
+    message_ids = list_message_ids(service, max_messages)
+    listed = set(message_ids)
+    message_ids += [message_id for message_id in list_message_ids(service, max_messages, RELEVANT_SENDER_QUERY) if message_id not in listed]
+    failed_ids = []
+    details = fetch_message_metadata_batch(service, message_ids, SYNC_METADATA_HEADERS, batch_size, failed_ids)
+    store.reset()
+    store.upsert_messages([message_from_resource(detail) for detail in details.values()])
+    store.set_pending_ids(failed_ids)
+    store.set_history_id(profile['historyId'])
+    logger.info(f"Full mailbox sync stored {len(details)} messages at history ID {profile['historyId']}"
+                f"{f'; {len(failed_ids)} left for the next sync' if failed_ids else ''}.")
+
+def incremental_sync(service, store, history_id, batch_size=GMAIL_BATCH_SIZE):
+    added, deleted, labels = set(), set(), {}
+    page_token = None
+    while True:
+        response = scheduler.execute(service.users().history().list(userId='me', startHistoryId=history_id, pageToken=page_token,
+                                                                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']))
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                deleted.discard(message['id'])
+                if 'INBOX' in message.get('labelIds', []):
+                    added.add(message['id'])
+            for item in record.get('messagesDeleted', []):
+                message_id = item['message']['id']
+                added.discard(message_id)
+                labels.pop(message_id, None)
+                deleted.add(message_id)
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                message = item['message']
+                labels[message['id']] = message.get('labelIds', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            new_history_id = response.get('historyId', history_id)
+            break
+    # Messages moved into the inbox that were never stored are fetched like new ones
+    for message_id, label_ids in labels.items():
+        if 'INBOX' in label_ids and message_id not in added and not store.has_message(message_id):
+            added.add(message_id)
+    # As are those an earlier sync failed to fetch
+    added.update(message_id for message_id in store.get_pending_ids() if message_id not in deleted)
+    failed_ids = []
+    if added:
+        details = fetch_message_metadata_batch(service, list(added), SYNC_METADATA_HEADERS, batch_size, failed_ids)
+        store.upsert_messages([message_from_resource(detail) for detail in details.values()])
+    store.set_pending_ids(failed_ids)
+    for message_id, label_ids in labels.items():
+        if message_id not in added:
+            store.set_labels(message_id, label_ids)
+    if deleted:
+        store.delete_messages(list(deleted))
+    store.set_history_id(new_history_id)
+    logger.debug(f"Incremental sync applied {len(added)} added, {len(deleted)} deleted, {len(labels)} relabelled messages.")
+
+def sync_mailbox_sync(credentials, batch_size=GMAIL_BATCH_SIZE):
+    service = get_service('gmail', 'v1', credentials)
+    store = get_mail_store()
+    with _sync_lock:
+        history_id = store.get_history_id()
+        if history_id is None:
+            full_sync(service, store, batch_size=batch_size)
+            return
         try:
-            msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='metadata', metadataHeaders=['subject', 'snippet', 'from', 'to', 'date']).execute()
-            logger.debug(f"Details fetched for message ID {msg['id']}: {msg_detail}")
-            subject_header = next((header['value'] for header in msg_detail['payload']['headers'] if header['name'].lower() == 'subject'), 'No Subject')
-            snippet = msg_detail.get('snippet', 'No snippet available') if include_snippets else None
-            from_header = next((header['value'] for header in msg_detail['payload']['headers'] if header['name'].lower() == 'from'), 'Unknown Sender')
-            to_header = next((header['value'] for header in msg_detail['payload']['headers'] if header['name'].lower() == 'to'), 'Unknown Recipient')
-            date_header = next((header['value'] for header in msg_detail['payload']['headers'] if header['name'].lower() == 'date'), 'Unknown Date')
-            emails_info.append({'id': msg['id'], 'subject': subject_header, 'snippet': snippet, 'from': from_header, 'to': to_header, 'date': date_header})
-            logger.debug(f"Message ID: {msg['id']} has subject: {subject_header}, snippet: {snippet}, from: {from_header}, to: {to_header}, date: {date_header}")
-        except Exception as e:
-            logger.error(f"Error fetching details for message ID {msg['id']}: {e}")
-            continue
-    return emails_info
+            incremental_sync(service, store, history_id, batch_size)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logger.info("Stored history ID is too old, running a full sync.")
+            full_sync(service, store, batch_size=batch_size)
+
+async def sync_mailbox(batch_size=GMAIL_BATCH_SIZE):
+    """
+    Brings the local mail store up to date: a full sync the first time, history deltas afterwards.
+    Returns:
+        bool: True if the sync succeeded; the store keeps its last contents otherwise.
+    """
+    credentials = await check_saved_access_token()
+    if not credentials:
+        logger.error("Failed to retrieve valid credentials. Cannot sync mailbox.")
+        return False
+    try:
+        await run_in_executor(sync_mailbox_sync, credentials, batch_size)
+        logger.debug(f"Quota scheduler metrics: {scheduler.metrics()}, connection pools: {pool_stats()}")
+        return True
+    except Exception as e:
+        logger.error(f"Mailbox sync failed: {e}")
+        return False
+
+async def search_emails(query=None, label_id='INBOX', sort='date', descending=True, limit=15, offset=0, sync=True):
+    """
+    Searches the locally synced mailbox instead of running a remote Gmail search.
+    Args:
+        query (str): Words to match against subject, from, to, date and snippet.
+        label_id (str): Only return messages with this label; None for all synced messages.
+        sort (str): 'date', 'subject', 'from', 'to' or 'relevance'.
+        descending (bool): Sort order.
+        limit (int): Page size.
+        offset (int): Number of matches to skip, for paging.
+        sync (bool): Apply pending mailbox changes before searching.
+
+    Returns:
+        list: Matching emails with id, subject, snippet, from, to and date.
+    """
+    if sync:
+        await sync_mailbox()
+    return get_mail_store().search_messages(text=query, label_id=label_id, sort=sort, descending=descending, limit=limit, offset=offset)
 
 async def fetch_custom_email_content(email_id, metadata_headers=None):
     """
@@ -198,9 +408,9 @@ async def fetch_custom_email_content(email_id, metadata_headers=None):
     if not credentials:
         logger.error("No valid credentials available.")
         return None
-    service = build('gmail', 'v1', credentials=credentials)
+    service = await run_in_executor(get_service, 'gmail', 'v1', credentials)
     try:
-        message = service.users().messages().get(userId='me', id=email_id, format='metadata', metadataHeaders=metadata_headers).execute()
+        message = await execute_async(service.users().messages().get(userId='me', id=email_id, format='metadata', metadataHeaders=metadata_headers))
         headers = message.get('payload', {}).get('headers', [])
         email_details = {header['name']: header['value'] for header in headers if header['name'] in metadata_headers}
         email_details['snippet'] = message.get('snippet', 'No snippet available')
@@ -231,7 +441,7 @@ async def draft_email(to, subject, message_text):
         logger.error("No valid credentials available.")
         return {"status": "error", "message": "No valid credentials"}
 
-    service = build('gmail', 'v1', credentials=credentials)
+    service = await run_in_executor(get_service, 'gmail', 'v1', credentials)
     email_message = EmailMessage()
     email_message.set_content(message_text)
     email_message['To'] = to
@@ -240,7 +450,7 @@ async def draft_email(to, subject, message_text):
     encoded_message = base64.urlsafe_b64encode(email_message.as_bytes()).decode()
     draft_body = {'message': {'raw': encoded_message}}
     try:
-        draft = service.users().drafts().create(userId='me', body=draft_body).execute()
+        draft = await execute_async(service.users().drafts().create(userId='me', body=draft_body))
         return {"status": "success", "draft_id": draft['id']}
     except Exception as e:
         logger.error(f"Failed to create draft: {e}")
@@ -252,9 +462,9 @@ async def send_email(draft_id):
         logger.error("No valid credentials available.")
         return {"status": "error", "message": "No valid credentials"}
 
-    service = build('gmail', 'v1', credentials=credentials)
+    service = await run_in_executor(get_service, 'gmail', 'v1', credentials)
     try:
-        sent_message = service.users().drafts().send(userId='me', body={'id': draft_id}).execute()
+        sent_message = await execute_async(service.users().drafts().send(userId='me', body={'id': draft_id}))
         return {"status": "success", "sent_message_id": sent_message['id']}
     except Exception as e:
         logger.error(f"Failed to send email: {e}")
@@ -266,7 +476,7 @@ async def create_calendar_event(summary, location, start_time, end_time, attende
         logger.error("No valid credentials available for Google Calendar.")
         return None
 
-    service = build('calendar', 'v3', credentials=credentials)
+    service = await run_in_executor(get_service, 'calendar', 'v3', credentials)
 
     event = {
         'summary': summary,
@@ -283,52 +493,114 @@ async def create_calendar_event(summary, location, start_time, end_time, attende
     }
 
     try:
-        created_event = service.events().insert(calendarId='primary', body=event).execute()
+        created_event = await execute_async(service.events().insert(calendarId='primary', body=event))
         logger.info(f"Event created: {created_event.get('htmlLink')}")
         return created_event
     except Exception as e:
         logger.error(f"Failed to create calendar event: {e}")
         return None
     
-async def get_events_for_next_10_days():
+def calendar_sync_window(now=None):
+    now = now or datetime.now(pytz.utc)
+    return now - timedelta(days=CALENDAR_SYNC_PAST_DAYS), now + timedelta(days=CALENDAR_SYNC_FUTURE_DAYS)
+
+def sync_calendar_events(service, store, sync_token=None):
+    """
+    Applies event changes since sync_token, or without one fetches the events of calendar_sync_window().
+    Recurring events are expanded, so a full sync stays bounded to that window; the sync token
+    keeps the window of the full sync it came from.
+    """
+    page_token = None
+    changed = 0
+    window = None if sync_token else calendar_sync_window()
+    while True:
+        params = {'calendarId': 'primary', 'singleEvents': True, 'maxResults': 2500, 'pageToken': page_token}
+        if sync_token:
+            params['syncToken'] = sync_token
+        else:
+            params['timeMin'], params['timeMax'] = (bound.isoformat() for bound in window)
+        response = scheduler.execute(service.events().list(**params))
+        for event in response.get('items', []):
+            if event.get('status') == 'cancelled':
+                store.delete_event(event['id'])
+            else:
+                store.upsert_event(event)
+            changed += 1
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            store.set_sync_token(response.get('nextSyncToken'))
+            if window:
+                store.set_sync_window(*(bound.timestamp() for bound in window))
+            break
+    logger.debug(f"Calendar sync applied {changed} changed events.")
+
+def list_events_between(service, start, end):
+    """Events overlapping [start, end) straight from the API, for windows the local store does not cover."""
+    events = []
+    page_token = None
+    while True:
+        response = scheduler.execute(service.events().list(
+            calendarId='primary', singleEvents=True, orderBy='startTime', maxResults=2500, pageToken=page_token,
+            timeMin=(start if start.tzinfo else pytz.utc.localize(start)).isoformat(),
+            timeMax=(end if end.tzinfo else pytz.utc.localize(end)).isoformat(),
+        ))
+        events.extend(event for event in response.get('items', []) if event.get('status') != 'cancelled')
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return [{key: value for key, value in event_details(event).items() if key != 'id'} for event in events]
+
+def sync_calendar_sync(credentials):
+    service = get_service('calendar', 'v3', credentials)
+    store = get_calendar_store()
+    with _calendar_sync_lock:
+        sync_token = store.get_sync_token()
+        window = store.get_sync_window()
+        # Start a new window once half of the future part of the current one has passed
+        renew_at = datetime.now(pytz.utc) + timedelta(days=CALENDAR_SYNC_FUTURE_DAYS / 2)
+        if sync_token and (window is None or window[1] < renew_at.timestamp()):
+            logger.info("Calendar sync window is running out, running a full sync.")
+            store.reset()
+            sync_token = None
+        try:
+            sync_calendar_events(service, store, sync_token)
+        except HttpError as e:
+            # 410 Gone: the sync token expired and the calendar has to be fetched again in full
+            if e.resp.status != 410 or sync_token is None:
+                raise
+            logger.info("Calendar sync token expired, running a full sync.")
+            store.reset()
+            sync_calendar_events(service, store)
+
+async def get_events_between(start, end):
+    """
+    Returns calendar events overlapping a time window, answered from the local event cache
+    after applying the changes since the last sync. Windows reaching outside the cached
+    CALENDAR_SYNC_PAST_DAYS/CALENDAR_SYNC_FUTURE_DAYS range are listed from the API instead.
+    Args:
+        start (datetime): Window start; naive values are taken as UTC.
+        end (datetime): Window end; naive values are taken as UTC.
+
+    Returns:
+        list: Event details (summary, start, end, location, description, attendees), or None on failure.
+    """
     credentials = await check_saved_access_token()
     if not credentials:
         logger.error("No valid credentials available for Google Calendar.")
         return None
-
-    service = build('calendar', 'v3', credentials=credentials)
-    now = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-    ten_days_later = (datetime.utcnow() + timedelta(days=10)).isoformat() + 'Z'
-
     try:
-        events_result = service.events().list(calendarId='primary', timeMin=now, timeMax=ten_days_later,
-                                              singleEvents=True, orderBy='startTime').execute()
-        events = events_result.get('items', [])
-        if not events:
-            logger.info("No upcoming events found.")
-            return []
-
-        # Extracting details of each event
-        events_details = []
-        for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            end = event['end'].get('dateTime', event['end'].get('date'))
-            summary = event.get('summary', 'No Title')
-            location = event.get('location', 'No Location Specified')
-            description = event.get('description', 'No Description')
-            attendees = ', '.join([attendee['email'] for attendee in event.get('attendees', []) if 'email' in attendee])
-
-            event_detail = {
-                'summary': summary,
-                'start': start,
-                'end': end,
-                'location': location,
-                'description': description,
-                'attendees': attendees
-            }
-            events_details.append(event_detail)
-
-        return events_details
+        await run_in_executor(sync_calendar_sync, credentials)
+        store = get_calendar_store()
+        if not store.covers(start, end):
+            service = await run_in_executor(get_service, 'calendar', 'v3', credentials)
+            return await run_in_executor(list_events_between, service, start, end)
+        return store.events_between(start, end)
     except Exception as e:
         logger.error(f"Failed to fetch events: {e}")
-        return None
\ No newline at end of file
+        return None
+
+async def get_events_for_next_10_days():
+    now = datetime.utcnow()
+    events = await get_events_between(now, now + timedelta(days=10))
+    if events == []:
+        logger.info("No upcoming events found.")
+    return events
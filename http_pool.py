@@ -0,0 +1,166 @@
+import os
+import asyncio
+import threading
+import importlib.util
+import weakref
+from contextlib import contextmanager
+import httpx
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from logger_config import logger
+
+# Connection pool settings shared by every HTTP client in the app
+MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "30"))
+TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT", "60"))
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+# HTTP/2 needs the optional h2 package
+HTTP2_ENABLED = os.getenv("HTTP_POOL_HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+class PoolStats:
+    """Request and concurrency counters for one transport."""
+    def __init__(self, name, max_connections):
+        self.name = name
+        self.max_connections = max_connections
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.clients = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def client_created(self):
+        with self._lock:
+            self.clients += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'clients': self.clients,
+                'max_connections': self.max_connections,
+                'utilisation': self.in_flight / self.max_connections if self.max_connections else 0.0,
+                'peak_utilisation': self.peak_in_flight / self.max_connections if self.max_connections else 0.0,
+            }
+
+_stats = {
+    'httpx': PoolStats('httpx', MAX_CONNECTIONS),
+    'httpx_async': PoolStats('httpx_async', MAX_CONNECTIONS),
+    'requests': PoolStats('requests', MAX_CONNECTIONS),
+    # One keep-alive httplib2 connection per executor thread and API host
+    'httplib2': PoolStats('httplib2', int(os.getenv("GOOGLE_API_MAX_WORKERS", "16"))),
+}
+
+def pool_stats():
+    """Utilisation counters for every shared transport, keyed by transport name."""
+    return {name: stats.snapshot() for name, stats in _stats.items()}
+
+def limits():
+    return httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS)
+
+def timeout():
+    return httpx.Timeout(TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+
+class _CountingTransport(httpx.BaseTransport):
+    def __init__(self, transport, stats):
+        self._transport = transport
+        self._stats = stats
+
+    def handle_request(self, request):
+        with self._stats.track():
+            return self._transport.handle_request(request)
+
+    def close(self):
+        self._transport.close()
+
+class _AsyncCountingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport, stats):
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request):
+        with self._stats.track():
+            return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+class _CountingAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT_SECONDS, TIMEOUT_SECONDS))
+        with _stats['requests'].track():
+            return super().send(request, **kwargs)
+
+_lock = threading.Lock()
+_http_client = None
+_requests_session = None
+_async_http_clients = weakref.WeakKeyDictionary()
+
+def get_http_client():
+    """Process-wide httpx.Client, e.g. for openai.Client(http_client=...)."""
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            transport = httpx.HTTPTransport(limits=limits(), http2=HTTP2_ENABLED)
+            _http_client = httpx.Client(transport=_CountingTransport(transport, _stats['httpx']), timeout=timeout())
+            _stats['httpx'].client_created()
+            logger.debug(f"Created shared httpx client (HTTP/2: {HTTP2_ENABLED}).")
+        return _http_client
+
+def get_async_http_client():
+    """
+    httpx.AsyncClient shared by everything running on the current event loop.
+    Async connections are bound to the loop that opened them, so each loop gets its own pool.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            transport = httpx.AsyncHTTPTransport(limits=limits(), http2=HTTP2_ENABLED)
+            client = httpx.AsyncClient(transport=_AsyncCountingTransport(transport, _stats['httpx_async']), timeout=timeout())
+            _async_http_clients[loop] = client
+            _stats['httpx_async'].client_created()
+        return client
+
+def get_requests_session():
+    """Process-wide requests.Session, used for OAuth token calls."""
+    global _requests_session
+    with _lock:
+        if _requests_session is None:
+            session = requests.Session()
+            adapter = _CountingAdapter(pool_connections=MAX_KEEPALIVE_CONNECTIONS, pool_maxsize=MAX_CONNECTIONS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _requests_session = session
+        return _requests_session
+
+def new_httplib2_http():
+    """A keep-alive httplib2.Http for one executor thread, with the shared timeout."""
+    _stats['httplib2'].client_created()
+    return httplib2.Http(timeout=TIMEOUT_SECONDS)
+
+@contextmanager
+def track_httplib2():
+    with _stats['httplib2'].track():
+        yield
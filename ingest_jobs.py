@@ -0,0 +1,121 @@
+import os
+import time
+import sqlite3
+import threading
+from logger_config import logger
+
+INGEST_JOURNAL_FILE = os.getenv("INGEST_JOURNAL_FILE", "ingest-jobs.db")
+# Runs that may fail a file before it is left failed until its source changes
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+
+# A file's progress into one vector store, in order
+DISCOVERED = 'discovered'
+DOWNLOADED = 'downloaded'
+UPLOADED = 'uploaded'
+ATTACHED = 'attached'
+INDEXED = 'indexed'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    vector_store_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    version TEXT,
+    state TEXT NOT NULL,
+    sha256 TEXT,
+    file_id TEXT,
+    batch_id TEXT,
+    bytes INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (vector_store_id, source)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (vector_store_id, state);
+"""
+
+JOB_FIELDS = ('sha256', 'file_id', 'batch_id', 'bytes', 'error')
+
+class IngestJournal:
+    """
+    SQLite journal of ingestion jobs: one row per source file and vector store, moved through
+    discovered -> downloaded -> uploaded -> attached -> indexed as the work happens, so a run
+    that is killed part way resumes each file from its last recorded state.
+    """
+    def __init__(self, path=INGEST_JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def discover(self, vector_store_id, sources, max_attempts=INGEST_MAX_ATTEMPTS):
+        """
+        Registers (source, version) pairs for a vector store and returns their jobs by source.
+        A source whose version changed starts again from discovered, as does a failed job with
+        fewer than max_attempts failures; past that it stays failed until the source changes.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            for source, version in sources:
+                self._conn.execute(
+                    """
+                    INSERT INTO jobs (vector_store_id, source, version, state, updated_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (vector_store_id, source) DO UPDATE SET
+                        state = ?, version = excluded.version, sha256 = NULL, file_id = NULL, batch_id = NULL,
+                        error = NULL, updated_at = excluded.updated_at,
+                        attempts = CASE WHEN jobs.version IS NOT excluded.version THEN 0 ELSE jobs.attempts END
+                    WHERE jobs.version IS NOT excluded.version OR (jobs.state = ? AND jobs.attempts < ?)
+                    """,
+                    (vector_store_id, source, version, DISCOVERED, now, DISCOVERED, FAILED, max_attempts),
+                )
+            rows = self._conn.execute("SELECT * FROM jobs WHERE vector_store_id = ?", (vector_store_id,)).fetchall()
+        wanted = {source for source, _ in sources}
+        return {row['source']: dict(row) for row in rows if row['source'] in wanted}
+
+    def advance(self, job_ids, state, **fields):
+        """Moves jobs to state, setting any of sha256, file_id, batch_id, bytes and error."""
+        if isinstance(job_ids, int):
+            job_ids = [job_ids]
+        assignments = ''.join(f", {name} = ?" for name in fields if name in JOB_FIELDS)
+        values = [fields[name] for name in fields if name in JOB_FIELDS]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"UPDATE jobs SET state = ?, updated_at = ?{assignments} WHERE id = ?",
+                [(state, time.time(), *values, job_id) for job_id in job_ids],
+            )
+
+    def fail(self, job_id, error):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (FAILED, str(error), time.time(), job_id),
+            )
+
+    def counts(self, vector_store_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE vector_store_id = ? GROUP BY state", (vector_store_id,)
+            ).fetchall()
+        return {state: count for state, count in rows}
+
+    def jobs(self, vector_store_id, state=None):
+        query, params = "SELECT * FROM jobs WHERE vector_store_id = ?", [vector_store_id]
+        if state:
+            query += " AND state = ?"
+            params.append(state)
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(query, params).fetchall()]
+
+journal = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    global journal
+    with _journal_lock:
+        if journal is None:
+            journal = IngestJournal()
+            logger.debug(f"Opened ingestion journal {journal.path}")
+        return journal
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import threading
+from logger_config import logger
+from atomic_write import write_atomic
+
+MANIFEST_FILE = os.getenv("VECTOR_STORE_MANIFEST", "vector_store_manifest.json")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class IngestManifest:
+    """
+    Persistent record of what has been ingested: content hash -> OpenAI file_id and the vector
+    stores the file belongs to. Local paths remember their last hash by size and mtime, so
+    unchanged files are not re-read on every run, and GCS blobs remember theirs by generation
+    and checksum, so unchanged blobs are not even downloaded.
+    """
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = {}  # sha256 -> {'file_id', 'filename', 'bytes', 'vector_stores'}
+        self._paths = {}  # absolute path -> {'size', 'mtime_ns', 'sha256'}
+        self._blobs = {}  # gs://bucket/name#generation -> {'checksum', 'sha256'}
+        self._load()
+
+    def hash_file(self, path):
+        """sha256 of a local file, reusing the recorded hash while its size and mtime are unchanged."""
+        key = os.path.abspath(path)
+        stat = os.stat(key)
+        with self._lock:
+            known = self._paths.get(key)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        sha256 = file_sha256(key)
+        with self._lock:
+            self._paths[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        return sha256
+
+    def blob_hash(self, blob_key, checksum):
+        """sha256 recorded for a blob generation, if its checksum still matches."""
+        with self._lock:
+            known = self._blobs.get(blob_key)
+        return known['sha256'] if known and known['checksum'] == checksum else None
+
+    def record_blob(self, blob_key, checksum, sha256):
+        with self._lock:
+            self._blobs[blob_key] = {'checksum': checksum, 'sha256': sha256}
+
+    def lookup(self, sha256):
+        with self._lock:
+            entry = self._files.get(sha256)
+            return dict(entry, vector_stores=list(entry['vector_stores'])) if entry else None
+
+    def record_upload(self, sha256, file_id, filename, size):
+        with self._lock:
+            self._files[sha256] = {'file_id': file_id, 'filename': filename, 'bytes': size, 'vector_stores': []}
+
+    def record_membership(self, sha256, vector_store_id):
+        with self._lock:
+            stores = self._files[sha256]['vector_stores']
+            if vector_store_id not in stores:
+                stores.append(vector_store_id)
+
+    def forget(self, sha256):
+        """Drops a file whose OpenAI copy no longer exists, so it is uploaded again."""
+        with self._lock:
+            self._files.pop(sha256, None)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load vector store manifest: {e}")
+            return
+        self._files = data.get('files', {})
+        self._paths = data.get('paths', {})
+        self._blobs = data.get('blobs', {})
+        logger.debug(f"Loaded manifest with {len(self._files)} ingested files.")
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({'files': self._files, 'paths': self._paths, 'blobs': self._blobs}, indent=1)
+        try:
+            write_atomic(self.path, data)
+        except Exception as e:
+            logger.error(f"Failed to save vector store manifest: {e}")
+
+manifest = None
+_manifest_lock = threading.Lock()
+
+def get_manifest():
+    global manifest
+    with _manifest_lock:
+        if manifest is None:
+            manifest = IngestManifest()
+        return manifest
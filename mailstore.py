@@ -0,0 +1,189 @@
+import json
+import sqlite3
+import threading
+from logger_config import logger
+
+MAIL_STORE_FILE = 'gmail-mailstore.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    subject TEXT,
+    sender TEXT,
+    recipient TEXT,
+    date TEXT,
+    snippet TEXT,
+    internal_date INTEGER,
+    label_ids TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date DESC);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Full-text index over the searchable columns, kept in step with messages by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    subject, sender, recipient, date, snippet,
+    content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, subject, sender, recipient, date, snippet)
+    VALUES (new.rowid, new.subject, new.sender, new.recipient, new.date, new.snippet);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, subject, sender, recipient, date, snippet)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.date, old.snippet);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, subject, sender, recipient, date, snippet)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.date, old.snippet);
+    INSERT INTO messages_fts (rowid, subject, sender, recipient, date, snippet)
+    VALUES (new.rowid, new.subject, new.sender, new.recipient, new.date, new.snippet);
+END;
+"""
+
+SORT_COLUMNS = {
+    'date': 'messages.internal_date',
+    'subject': 'messages.subject',
+    'from': 'messages.sender',
+    'to': 'messages.recipient',
+}
+
+def message_from_resource(resource):
+    """Flattens a Gmail message resource fetched with format='metadata' into a store row."""
+    headers = {header['name'].lower(): header['value'] for header in resource.get('payload', {}).get('headers', [])}
+    return {
+        'id': resource['id'],
+        'thread_id': resource.get('threadId'),
+        'subject': headers.get('subject', 'No Subject'),
+        'from': headers.get('from', 'Unknown Sender'),
+        'to': headers.get('to', 'Unknown Recipient'),
+        'date': headers.get('date', 'Unknown Date'),
+        'snippet': resource.get('snippet', 'No snippet available'),
+        'internal_date': int(resource.get('internalDate', 0)),
+        'label_ids': resource.get('labelIds', []),
+    }
+
+class MailStore:
+    """Local SQLite copy of synced mailbox metadata plus the Gmail historyId it is current to."""
+    def __init__(self, path=MAIL_STORE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+        has_index = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        self._conn.executescript(FTS_SCHEMA)
+        if not has_index:
+            # Stores created before the index existed need their rows indexed once
+            with self._conn:
+                self._conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    def get_history_id(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = 'history_id'").fetchone()
+        return row['value'] if row else None
+
+    def set_history_id(self, history_id):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('history_id', ?)", (str(history_id),))
+
+    def get_pending_ids(self):
+        """IDs of messages a sync could not fetch, to be fetched again by the next one."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = 'pending_ids'").fetchone()
+        return json.loads(row['value']) if row else []
+
+    def set_pending_ids(self, message_ids):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('pending_ids', ?)", (json.dumps(sorted(message_ids)),))
+
+    def has_message(self, message_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone() is not None
+
+    def upsert_messages(self, messages):
+        rows = [(m['id'], m['thread_id'], m['subject'], m['from'], m['to'], m['date'], m['snippet'], m['internal_date'], json.dumps(m['label_ids'])) for m in messages]
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO messages (id, thread_id, subject, sender, recipient, date, snippet, internal_date, label_ids)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    thread_id = excluded.thread_id, subject = excluded.subject, sender = excluded.sender,
+                    recipient = excluded.recipient, date = excluded.date, snippet = excluded.snippet,
+                    internal_date = excluded.internal_date, label_ids = excluded.label_ids
+            """, rows)
+        logger.debug(f"Stored {len(rows)} messages.")
+
+    def delete_messages(self, message_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in message_ids])
+
+    def set_labels(self, message_id, label_ids):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE messages SET label_ids = ? WHERE id = ?", (json.dumps(label_ids), message_id))
+
+    def reset(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages")
+            self._conn.execute("DELETE FROM sync_state")
+
+    def load_fixture(self, path):
+        """Loads Gmail message resources (format='metadata') from a JSON file, for working offline."""
+        with open(path) as f:
+            resources = json.load(f)
+        self.upsert_messages([message_from_resource(resource) for resource in resources])
+
+    def query_messages(self, label_id=None, sender_domains=None, exclude_replies=False, limit=15):
+        """Returns the newest stored messages matching the filters; see search_messages."""
+        return self.search_messages(label_id=label_id, sender_domains=sender_domains, exclude_replies=exclude_replies, limit=limit)
+
+    def search_messages(self, text=None, label_id=None, sender_domains=None, exclude_replies=False, sort='date', descending=True, limit=15, offset=0):
+        """
+        Filters, sorts and pages stored messages, in the same shape as gmailapi.fetch_relevant_emails.
+        Args:
+            text (str): Words to match against subject, from, to, date and snippet; every word must match.
+            label_id (str): Only return messages carrying this label, e.g. 'INBOX'.
+            sender_domains (list): Only return messages sent from one of these domains.
+            exclude_replies (bool): Skip messages whose subject marks them as a reply.
+            sort (str): 'date', 'subject', 'from', 'to' or 'relevance' (only meaningful with text).
+            descending (bool): Sort order.
+            limit (int): Page size.
+            offset (int): Number of matching messages to skip.
+        """
+        clauses, params = [], []
+        joins = ""
+        if text and text.strip():
+            joins = "JOIN messages_fts ON messages_fts.rowid = messages.rowid"
+            clauses.append("messages_fts MATCH ?")
+            params.append(fts_query(text))
+        elif sort == 'relevance':
+            sort = 'date'
+        if label_id:
+            clauses.append("EXISTS (SELECT 1 FROM json_each(messages.label_ids) WHERE json_each.value = ?)")
+            params.append(label_id)
+        if sender_domains:
+            # Anchored at the end of the address, bare or in angle brackets, so kohls.com does not match kohls.com.example.org
+            clauses.append("(" + " OR ".join("trim(messages.sender) LIKE ? OR trim(messages.sender) LIKE ?" for _ in sender_domains) + ")")
+            for domain in sender_domains:
+                params.extend([f"%@{domain}", f"%@{domain}>"])
+        if exclude_replies:
+            clauses.append("messages.subject NOT LIKE 'Re:%'")
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        if sort == 'relevance':
+            # bm25() is lower for better matches
+            order = f"bm25(messages_fts) {'ASC' if descending else 'DESC'}"
+        else:
+            order = f"{SORT_COLUMNS.get(sort, SORT_COLUMNS['date'])} {'DESC' if descending else 'ASC'}"
+        params.extend([limit, offset])
+        with self._lock:
+            rows = self._conn.execute(f"SELECT messages.* FROM messages {joins} {where} ORDER BY {order} LIMIT ? OFFSET ?", params).fetchall()
+        return [{'id': row['id'], 'subject': row['subject'], 'snippet': row['snippet'], 'from': row['sender'], 'to': row['recipient'], 'date': row['date']} for row in rows]
+
+def fts_query(text):
+    """Quotes each word so user input is matched literally instead of parsed as FTS5 syntax."""
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
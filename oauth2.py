@@ -67,13 +67,13 @@ IMAPFE and pass it as the second argument to the AUTHENTICATE command.
 
 import base64
 import imaplib
-import json
 import optparse
 import smtplib
 import ssl
 import sys
 import urllib.parse
-import urllib.request
+
+from http_pool import get_requests_session
 
 
 def SetupOptionParser():
@@ -220,8 +220,9 @@ def AuthorizeTokens(client_id, client_secret, authorization_code):
   params['grant_type'] = 'authorization_code'
   request_url = AccountsUrl('o/oauth2/token')
 
-  response = urllib.request.urlopen(request_url, urllib.parse.urlencode(params).encode('utf-8')).read()
-  return json.loads(response)
+  response = get_requests_session().post(request_url, data=params)
+  response.raise_for_status()
+  return response.json()
 
 
 def RefreshToken(client_id, client_secret, refresh_token):
@@ -244,8 +245,9 @@ def RefreshToken(client_id, client_secret, refresh_token):
   params['grant_type'] = 'refresh_token'
   request_url = AccountsUrl('o/oauth2/token')
 
-  response = urllib.request.urlopen(request_url, urllib.parse.urlencode(params).encode('utf-8')).read()
-  return json.loads(response)
+  response = get_requests_session().post(request_url, data=params)
+  response.raise_for_status()
+  return response.json()
 
 
 def GenerateOAuth2String(username, access_token, base64_encode=True):
@@ -0,0 +1,182 @@
+import os
+import time
+import random
+import threading
+from googleapiclient.errors import HttpError
+from logger_config import logger
+
+# Per-user quota budgets in units per second
+QUOTA_UNITS_PER_SECOND = {
+    'gmail': float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250")),
+    'calendar': float(os.getenv("CALENDAR_QUOTA_UNITS_PER_SECOND", "10")),
+    'drive': float(os.getenv("DRIVE_QUOTA_UNITS_PER_SECOND", "20")),
+}
+
+# Gmail quota units per method; anything not listed (and every Calendar/Drive call) costs 1
+METHOD_QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.drafts.create': 10,
+    'gmail.users.drafts.send': 100,
+    'gmail.users.messages.send': 100,
+}
+
+MAX_RETRIES = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 32
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = int(os.getenv("GOOGLE_API_MAX_CONCURRENCY", "16"))
+# Successful calls needed before the concurrency limit is raised by one
+CONCURRENCY_INCREASE_AFTER = 20
+
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded', b'quotaExceeded')
+# 403 reasons that mean requests are arriving too fast, as opposed to a used-up daily quota
+RATE_EXCEEDED_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+def is_retryable(error):
+    """True for 429s, 5xx responses and 403s caused by rate limiting."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and any(reason in (error.content or b'') for reason in RATE_LIMIT_REASONS)
+
+def is_rate_limited(error):
+    """True for 429s and 403 rateLimitExceeded/userRateLimitExceeded, the errors that call for less concurrency."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status == 429:
+        return True
+    return status == 403 and any(reason in (error.content or b'') for reason in RATE_EXCEEDED_REASONS)
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units):
+        """Takes units from the bucket and returns how long the caller must wait before using them."""
+        units = min(units, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= units
+            return max(0.0, -self._tokens / self.rate)
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that grows additively on success and halves on rate-limit errors.
+    Other failures, such as 5xx responses, leave it unchanged.
+    """
+    def __init__(self, limit=MAX_CONCURRENCY // 2 or 1, min_limit=MIN_CONCURRENCY, max_limit=MAX_CONCURRENCY):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, rate_limited=False, succeeded=True):
+        with self._condition:
+            self._in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self._successes = 0
+            elif succeeded:
+                self._successes += 1
+                if self._successes >= CONCURRENCY_INCREASE_AFTER and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+class QuotaScheduler:
+    """
+    Runs every Google API call through a per-API quota token bucket and adaptive concurrency limit,
+    retrying rate-limited and server errors with jittered exponential backoff. Only rate-limit
+    errors lower the concurrency limit; server errors are just retried.
+    Calls block the calling thread, so they are made from the executor threads.
+    """
+    def __init__(self, budgets=QUOTA_UNITS_PER_SECOND):
+        self._buckets = {api: TokenBucket(rate) for api, rate in budgets.items()}
+        self._limiters = {api: AdaptiveLimiter() for api in budgets}
+        self._metrics = {api: {'calls': 0, 'units': 0, 'retries': 0, 'rate_limited': 0, 'failures': 0, 'throttled_seconds': 0.0} for api in budgets}
+        self._metrics_lock = threading.Lock()
+
+    def execute(self, request, units=None, **kwargs):
+        """Executes a googleapiclient HttpRequest, deriving the API and quota cost from its methodId."""
+        method_id = getattr(request, 'methodId', None) or ''
+        api = method_id.split('.', 1)[0] or 'gmail'
+        if units is None:
+            units = METHOD_QUOTA_UNITS.get(method_id, 1)
+        return self.call(request.execute, api, units, **kwargs)
+
+    def call(self, func, api, units=1, **kwargs):
+        """Calls func(**kwargs) once quota and concurrency allow, retrying retryable errors."""
+        bucket = self._buckets.get(api)
+        limiter = self._limiters.get(api)
+        if bucket is None:
+            return func(**kwargs)
+        for attempt in range(MAX_RETRIES + 1):
+            wait = bucket.reserve(units)
+            if wait:
+                time.sleep(wait)
+                self._record(api, throttled_seconds=wait)
+            limiter.acquire()
+            rate_limited = False
+            succeeded = False
+            try:
+                result = func(**kwargs)
+                self._record(api, calls=1, units=units)
+                succeeded = True
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt == MAX_RETRIES:
+                    self._record(api, calls=1, units=units, failures=1)
+                    raise
+                rate_limited = is_rate_limited(e)
+                delay = backoff_delay(attempt)
+                logger.warning(f"{api} call {'rate limited' if rate_limited else 'failed'} ({e}); retrying in {delay:.2f}s.")
+                self._record(api, calls=1, units=units, retries=1, rate_limited=int(rate_limited))
+            finally:
+                limiter.release(rate_limited, succeeded)
+            time.sleep(delay)
+            self._record(api, throttled_seconds=delay)
+
+    def backoff(self, api, attempt):
+        """Sleeps before retrying items of a batch request that were rate limited individually."""
+        delay = backoff_delay(attempt)
+        time.sleep(delay)
+        self._record(api, retries=1, throttled_seconds=delay)
+
+    def metrics(self):
+        """Per-API counters, including the time spent waiting on quota or backoff."""
+        with self._metrics_lock:
+            snapshot = {api: dict(values) for api, values in self._metrics.items()}
+        for api, values in snapshot.items():
+            values['concurrency_limit'] = self._limiters[api].limit
+        return snapshot
+
+    def _record(self, api, **counters):
+        with self._metrics_lock:
+            for name, value in counters.items():
+                self._metrics[api][name] += value
+
+scheduler = QuotaScheduler()
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import google_auth_httplib2
+from googleapiclient.discovery import build
+from logger_config import logger
+from http_pool import new_httplib2_http, track_httplib2
+
+# (api, version, credential identity) -> (access token the service was built with, service)
+_services = {}
+_services_lock = threading.Lock()
+
+class ThreadLocalAuthorizedHttp:
+    """
+    httplib2 is not thread-safe, so a service shared across the executor threads
+    gets one authorized, keep-alive connection per thread through this wrapper.
+    """
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=new_httplib2_http())
+            self._local.http = http
+        return http
+
+    def request(self, *args, **kwargs):
+        with track_httplib2():
+            return self._http().request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._http(), name)
+
+def credential_identity(credentials):
+    """Stable identity for the account behind a set of credentials, independent of the access token."""
+    raw = f"{getattr(credentials, 'client_id', '')}:{getattr(credentials, 'refresh_token', '')}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def get_service(api, version, credentials):
+    """
+    Returns a cached service object for the given API and credentials.
+    Args:
+        api (str): API name, e.g. 'gmail', 'calendar' or 'drive'.
+        version (str): API version, e.g. 'v1'.
+        credentials: google.oauth2.credentials.Credentials for the account.
+
+    Returns:
+        Resource: A service object that is rebuilt whenever the access token rotates.
+    """
+    key = (api, version, credential_identity(credentials))
+    with _services_lock:
+        entry = _services.get(key)
+        if entry and entry[0] == credentials.token:
+            return entry[1]
+    logger.debug(f"Building {api} {version} service.")
+    service = build(api, version, http=ThreadLocalAuthorizedHttp(credentials), cache_discovery=False)
+    with _services_lock:
+        _services[key] = (credentials.token, service)
+    return service
+
+def clear_services():
+    with _services_lock:
+        _services.clear()
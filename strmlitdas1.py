@@ -3,8 +3,7 @@ import openai
 import dash
 from dash import html, dcc, Input, Output, State, callback, dash_table
 import dash_bootstrap_components as dbc
-import asyncio
-from assistants import process_thread_with_assistant, add_files_to_existing_vector_store  # Importing the chat function and upload function from assistants.py
+from assistants import process_thread_with_assistant, add_files_to_existing_vector_store, sync_assistant_tools, download_path, DOWNLOAD_DIR  # Importing the chat function and upload function from assistants.py
 from driveapi import check_saved_access_token, start_oauth_and_server, download_drive_file  # Importing the download function from driveapi.py
 from loguru import logger
 import os
@@ -13,10 +12,13 @@ import base64
 import subprocess
 import json
 import gmailapi
+from async_executor import run_coroutine
 import requests
 import threading
+import uuid
 from dash.dependencies import Input, Output, State, MATCH, ALL, ALLSMALLER
 import pandas as pd  # Import pandas for handling dataframes
+from flask import send_file, abort
 
 # Load client secrets for OAuth for Gmail
 with open('client_secret.json') as f:
@@ -40,6 +42,16 @@ client = openai
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+# Serve files generated by the assistant straight from disk, and nothing else
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+@app.server.route('/downloads/<filename>')
+def serve_download(filename):
+    path = download_path(filename)
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=True)
+
 # Define the layout
 app.layout = html.Div([
     dbc.Row([
@@ -70,6 +82,7 @@ app.layout = html.Div([
         dbc.Col([
             html.H3("Chat Interface"),
             dcc.Store(id='chat-store'),
+            dcc.Store(id='session-id', storage_type='session'),
             html.Div([
                 dcc.Markdown('#### Chat History', style={'color': 'black'}),
                 html.Div(id='chat-messages', style={
@@ -84,6 +97,7 @@ app.layout = html.Div([
     dbc.Row([
         dbc.Col([
             html.H3("Email Dashboard"),
+            dcc.Input(id='email-search', type='text', placeholder='Search synced emails', debounce=True, style={'width': '50%'}),
             dash_table.DataTable(
                 id='email-table',
                 columns=[
@@ -108,20 +122,26 @@ app.layout = html.Div([
 @app.callback(
     Output('email-table', 'data'),
     Input('refresh-emails-btn', 'n_clicks'),
+    Input('email-search', 'value'),
     prevent_initial_call=True
 )
-def update_email_table(n_clicks):
+def update_email_table(n_clicks, search_text):
     logger.debug("Refreshing emails...")
-    token = asyncio.run(gmailapi.check_saved_access_token())
+    token = run_coroutine(gmailapi.check_saved_access_token())
     if not token:
         logger.info("No valid access token. Initiating OAuth flow.")
-        asyncio.run(gmailapi.start_oauth_and_server())
-        token = asyncio.run(gmailapi.check_saved_access_token())
+        run_coroutine(gmailapi.start_oauth_and_server())
+        token = run_coroutine(gmailapi.check_saved_access_token())
         if not token:
             logger.error("Failed to obtain valid access token after OAuth flow.")
             return []
 
-    emails = asyncio.run(gmailapi.fetch_relevant_emails(max_results=15, include_snippets=True))
+    if search_text:
+        # Searching runs against the local index; only the refresh button pulls new mail first
+        refresh_clicked = dash.callback_context.triggered[0]['prop_id'].startswith('refresh-emails-btn')
+        emails = run_coroutine(gmailapi.search_emails(query=search_text, limit=15, sync=refresh_clicked))
+    else:
+        emails = run_coroutine(gmailapi.fetch_relevant_emails(max_results=15, include_snippets=True, from_store=True))
     logger.debug(f"Emails fetched: {emails}")
 
     # Transform the data to match the DataTable column IDs and include 'id' column
@@ -153,49 +173,44 @@ def update_email_table(n_clicks):
 def display_email_content(active_cell, data):
     if active_cell:
         email_id = data[active_cell['row']]['id']
-        email_content = asyncio.run(gmailapi.fetch_custom_email_content(email_id, metadata_headers=['From', 'To', 'Cc', 'Subject', 'Date']))
+        email_content = run_coroutine(gmailapi.fetch_custom_email_content(email_id, metadata_headers=['From', 'To', 'Cc', 'Subject', 'Date']))
         formatted_content = f"From: {email_content['From']}\nTo: {email_content['To']}\nCc: {email_content.get('Cc', 'N/A')}\nSubject: {email_content['Subject']}\nDate: {email_content['Date']}\n\n{email_content['snippet']}"
         return formatted_content
 # Callbacks for chat interface
 @callback(
     Output('chat-messages', 'children'),
+    Output('session-id', 'data'),
     Input('send-btn', 'n_clicks'),
     State('chat-input', 'value'),
     State('chat-store', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def update_chat(n_clicks, message, chat_history):
+def update_chat(n_clicks, message, chat_history, session_id):
     if n_clicks is None:
-        return  # Do nothing if no clicks
+        return dash.no_update, dash.no_update  # Do nothing if no clicks
     if chat_history is None:
         chat_history = []
+    # Each browser session gets its own assistant thread
+    if session_id is None:
+        session_id = str(uuid.uuid4())
 
     async def process_message():
-        response = await process_thread_with_assistant(message, assistant_id)
+        response = await process_thread_with_assistant(message, assistant_id, session_key=session_id)
         response_text = response.get('text', ["No response from assistant."])[0]
         chat_history.append({'role': 'user', 'content': f"You: {message}", 'style': {'color': 'blue', 'fontWeight': 'bold'}})
         chat_history.append({'role': 'assistant', 'content': dcc.Markdown(f"Assistant: {response_text}")})
+        for handle in response.get('in_memory_files', []):
+            chat_history.append({'role': 'assistant', 'content': html.A(f"Download {handle['filename']}", href=f"/downloads/{os.path.basename(handle['path'])}", download=handle['filename'])})
         return [html.Div([html.Div(msg['content'], style=msg.get('style', {})) for msg in chat_history], style={'margin': '5px'})]
 
     if dash.callback_context.triggered[0]['prop_id'].startswith('send-btn'):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            result = loop.run_until_complete(process_message())
-            return result
-        finally:
-            loop.close()
+        return run_coroutine(process_message()), session_id
+    return dash.no_update, session_id
 
 # Helper function to manage the event loop for running asynchronous tasks
 def run_async_tasks(task, *args, **kwargs):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    result = None
-    try:
-        result = loop.run_until_complete(task(*args, **kwargs))
-    finally:
-        loop.close()
-    return result
+    return run_coroutine(task(*args, **kwargs))
 
 # Callbacks for file processing
 @callback(
@@ -265,4 +280,6 @@ def display_action(action):
 
 # Run the server
 if __name__ == '__main__':
+    # The assistant's function definitions come from the tool registry
+    run_coroutine(sync_assistant_tools(assistant_id))
     app.run_server(debug=True)
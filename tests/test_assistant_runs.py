@@ -0,0 +1,145 @@
+import json
+import time
+import asyncio
+import httpx
+import pytest
+from openai import AsyncOpenAI
+import assistants
+
+STEP_SECONDS = 0.2  # time the fake server spends in each run state
+
+class FakeAssistantsServer:
+    """
+    Serves the Assistants endpoints process_thread_with_assistant uses. A run spends STEP_SECONDS
+    in progress, then asks for one tool call, then completes STEP_SECONDS after the outputs arrive.
+    """
+    def __init__(self, fail_submit_stream=False, fail_create_stream=False):
+        self.fail_submit_stream = fail_submit_stream
+        self.fail_create_stream = fail_create_stream
+        self.runs = {}
+        self.submissions = []
+        self.runs_created = 0
+
+    def client(self):
+        transport = httpx.MockTransport(self.handle)
+        return AsyncOpenAI(api_key="test", base_url="http://fake/v1", max_retries=0, http_client=httpx.AsyncClient(transport=transport))
+
+    def run_object(self, run_id):
+        run = self.runs[run_id]
+        if run['submitted_at'] is None:
+            status = "in_progress" if time.monotonic() - run['created_at'] < STEP_SECONDS else "requires_action"
+        else:
+            status = "in_progress" if time.monotonic() - run['submitted_at'] < STEP_SECONDS else "completed"
+        data = {"id": run_id, "object": "thread.run", "thread_id": "thread_1", "status": status}
+        if status == "requires_action":
+            data["required_action"] = {"type": "submit_tool_outputs", "submit_tool_outputs": {"tool_calls": [
+                {"id": "call_1", "type": "function", "function": {"name": "lookup", "arguments": "{}"}},
+            ]}}
+        return data
+
+    def message_object(self):
+        return {"id": "msg_1", "object": "thread.message", "role": "assistant",
+                "content": [{"type": "text", "text": {"value": "done", "annotations": []}}]}
+
+    def create_run(self):
+        self.runs_created += 1
+        run_id = f"run_{self.runs_created}"
+        self.runs[run_id] = {'created_at': time.monotonic(), 'submitted_at': None}
+        return run_id
+
+    def events(self, *events, fail=False):
+        async def body():
+            for name, data in events:
+                if name == "sleep":
+                    await asyncio.sleep(data)
+                    continue
+                yield f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+            if fail:
+                raise httpx.ReadError("connection reset")
+            yield b"event: done\ndata: [DONE]\n\n"
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+    async def handle(self, request):
+        path = request.url.path.removeprefix("/v1")
+        body = json.loads(request.content) if request.content else {}
+        if request.method == "POST" and path == "/threads":
+            return httpx.Response(200, json={"id": "thread_1", "object": "thread"})
+        if request.method == "POST" and path == "/threads/thread_1/messages":
+            return httpx.Response(200, json={"id": "msg_0", "object": "thread.message", "role": "user", "content": []})
+        if request.method == "GET" and path == "/threads/thread_1/messages":
+            return httpx.Response(200, json={"object": "list", "data": [self.message_object()], "has_more": False})
+        if request.method == "GET" and path == "/threads/thread_1/runs":
+            data = [self.run_object(run_id) for run_id in reversed(list(self.runs))][:1]
+            return httpx.Response(200, json={"object": "list", "data": data, "has_more": False})
+        if request.method == "POST" and path == "/threads/thread_1/runs":
+            run_id = self.create_run()
+            if not body.get("stream"):
+                return httpx.Response(200, json=self.run_object(run_id))
+            if self.fail_create_stream:
+                return self.events(fail=True)
+            created = {"id": run_id, "object": "thread.run", "status": "queued"}
+            self.runs[run_id]['created_at'] -= STEP_SECONDS  # the stream waits out the step itself
+            return self.events(("thread.run.created", created), ("sleep", STEP_SECONDS),
+                               ("thread.run.requires_action", self.run_object(run_id)))
+        parts = path.split("/")
+        run_id = parts[4] if len(parts) > 4 else None
+        if request.method == "GET" and run_id in self.runs and len(parts) == 5:
+            return httpx.Response(200, json=self.run_object(run_id))
+        if request.method == "POST" and run_id in self.runs and parts[-1] == "submit_tool_outputs":
+            if body.get("stream") and self.fail_submit_stream:
+                raise httpx.ConnectError("connection refused", request=request)
+            self.submissions.append(body["tool_outputs"])
+            self.runs[run_id]['submitted_at'] = time.monotonic()
+            if not body.get("stream"):
+                return httpx.Response(200, json=self.run_object(run_id))
+            return self.events(("sleep", STEP_SECONDS), ("thread.message.completed", self.message_object()),
+                               ("thread.run.completed", dict(self.run_object(run_id), status="completed")))
+        return httpx.Response(404, json={"error": {"message": f"Unexpected {request.method} {path}"}})
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    def install(**options):
+        server = FakeAssistantsServer(**options)
+        client = server.client()
+        monkeypatch.setattr(assistants, "get_client", lambda: client)
+        monkeypatch.setattr(assistants, "execute_function", tool_counter)
+        tool_counter.calls = 0
+        return server
+    return install
+
+async def tool_counter(function_name, arguments, from_user):
+    tool_counter.calls += 1
+    return {"status": "ok"}
+
+def run_query(session_key, stream):
+    started = time.monotonic()
+    result = asyncio.run(assistants.process_thread_with_assistant("hello", "asst_1", stream=stream, session_key=session_key))
+    return result, time.monotonic() - started
+
+def test_streaming_beats_polling_latency(fake_server):
+    fake_server()
+    run_query("latency-warmup", stream=True)  # the SDK's first request pays for lazy imports
+    fake_server()
+    streamed, streamed_seconds = run_query("latency-stream", stream=True)
+    fake_server()
+    polled, polled_seconds = run_query("latency-poll", stream=False)
+    assert streamed["text"] == polled["text"] == ["done"]
+    timings = f"streaming {streamed_seconds:.2f}s, polling {polled_seconds:.2f}s"
+    # Streaming follows the server's two steps; polling adds up to a second at each state change
+    assert streamed_seconds < 3 * STEP_SECONDS + 0.3, timings
+    assert polled_seconds > streamed_seconds + 0.5, timings
+
+def test_interrupted_stream_resubmits_tool_outputs(fake_server):
+    server = fake_server(fail_submit_stream=True)
+    result, _ = run_query("resubmit", stream=True)
+    assert result["text"] == ["done"]
+    assert tool_counter.calls == 1
+    assert server.submissions == [[{"tool_call_id": "call_1", "output": '{"status": "ok"}'}]]
+    assert server.runs_created == 1
+
+def test_failed_stream_polls_the_active_run(fake_server):
+    server = fake_server(fail_create_stream=True)
+    result, _ = run_query("active-run", stream=True)
+    assert result["text"] == ["done"]
+    assert server.runs_created == 1
+    assert tool_counter.calls == 1
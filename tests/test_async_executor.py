@@ -0,0 +1,37 @@
+import time
+import asyncio
+import threading
+from async_executor import execute_async, MAX_WORKERS
+
+CALL_SECONDS = 0.1
+
+class BlockingRequest:
+    """Stands in for a googleapiclient HttpRequest whose execute() blocks on the network."""
+    methodId = 'test.ping'  # no quota bucket, so the scheduler calls straight through
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def execute(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.peak = max(cls.peak, cls.in_flight)
+        time.sleep(CALL_SECONDS)
+        with cls.lock:
+            cls.in_flight -= 1
+        return {'ok': True}
+
+def test_parallel_calls_overlap_within_the_worker_limit():
+    calls = MAX_WORKERS * 3
+
+    async def fetch_all():
+        return await asyncio.gather(*(execute_async(BlockingRequest()) for _ in range(calls)))
+
+    started = time.monotonic()
+    results = asyncio.run(fetch_all())
+    elapsed = time.monotonic() - started
+
+    assert results == [{'ok': True}] * calls
+    assert 1 < BlockingRequest.peak <= MAX_WORKERS
+    assert elapsed < calls * CALL_SECONDS / 2
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+import httplib2
+import pytest
+import pytz
+from googleapiclient.errors import HttpError
+import gmailapi
+from calendarstore import CalendarStore
+from quota_scheduler import QuotaScheduler
+
+NOW = datetime.now(pytz.utc)
+
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def execute(self):
+        return self.respond()
+
+class FakeCalendar:
+    """
+    The events().list part of a Calendar v3 service. Every change bumps a version number that
+    serves as the sync token; tokens in expired_tokens answer 410 Gone.
+    """
+    def __init__(self):
+        self.version = 0
+        self.changes = []  # (version, event)
+        self.expired_tokens = set()
+        self.calls = []
+
+    def put(self, event_id, start, status='confirmed'):
+        self.version += 1
+        event = {'id': event_id, 'status': status, 'summary': event_id,
+                 'start': {'dateTime': start.isoformat()}, 'end': {'dateTime': (start + timedelta(hours=1)).isoformat()}}
+        self.changes.append((self.version, event))
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self.calls.append(params)
+        return FakeRequest(lambda: self.respond(params))
+
+    def respond(self, params):
+        latest = {}
+        for version, event in self.changes:
+            latest[event['id']] = (version, event)
+        if params.get('syncToken'):
+            if params['syncToken'] in self.expired_tokens:
+                raise HttpError(httplib2.Response({'status': 410}), b'Sync token is no longer valid')
+            since = int(params['syncToken'])
+            items = [event for version, event in latest.values() if version > since]
+        else:
+            time_min = datetime.fromisoformat(params['timeMin'])
+            time_max = datetime.fromisoformat(params['timeMax'])
+            items = [event for _, event in latest.values() if event['status'] != 'cancelled'
+                     and time_min <= datetime.fromisoformat(event['start']['dateTime']) < time_max]
+        return {'items': items, 'nextSyncToken': str(self.version)}
+
+@pytest.fixture
+def calendar(tmp_path, monkeypatch):
+    fake = FakeCalendar()
+    monkeypatch.setattr(gmailapi, "calendar_store", CalendarStore(str(tmp_path / "calendar.db")))
+    monkeypatch.setattr(gmailapi, "get_service", lambda *args: fake)
+    monkeypatch.setattr(gmailapi, "scheduler", QuotaScheduler(budgets={}))
+    return fake
+
+def stored_summaries():
+    events = gmailapi.get_calendar_store().events_between(NOW - timedelta(days=400), NOW + timedelta(days=800))
+    return sorted(event['summary'] for event in events)
+
+def test_full_sync_is_bounded_to_the_window_then_applies_deltas(calendar):
+    calendar.put("tomorrow", NOW + timedelta(days=1))
+    calendar.put("far-future", NOW + timedelta(days=gmailapi.CALENDAR_SYNC_FUTURE_DAYS + 30))
+    gmailapi.sync_calendar_sync(None)
+    assert stored_summaries() == ["tomorrow"]
+    assert 'timeMin' in calendar.calls[-1] and 'syncToken' not in calendar.calls[-1]
+    assert gmailapi.get_calendar_store().covers(NOW, NOW + timedelta(days=10))
+
+    calendar.put("next-week", NOW + timedelta(days=7))
+    calendar.put("tomorrow", NOW + timedelta(days=1), status='cancelled')
+    gmailapi.sync_calendar_sync(None)
+    assert calendar.calls[-1]['syncToken'] == "2"
+    assert stored_summaries() == ["next-week"]
+
+def test_expired_sync_token_resets_the_store(calendar):
+    calendar.put("tomorrow", NOW + timedelta(days=1))
+    gmailapi.sync_calendar_sync(None)
+    # A deletion the client never hears about, because its token expired first
+    calendar.changes.clear()
+    calendar.put("next-week", NOW + timedelta(days=7))
+    calendar.expired_tokens.add("1")
+    gmailapi.sync_calendar_sync(None)
+    assert [call.get('syncToken') for call in calendar.calls] == [None, "1", None]
+    assert stored_summaries() == ["next-week"]
+    assert gmailapi.get_calendar_store().get_sync_token() == "2"
+
+def test_window_is_renewed_before_it_runs_out(calendar):
+    calendar.put("tomorrow", NOW + timedelta(days=1))
+    gmailapi.sync_calendar_sync(None)
+    store = gmailapi.get_calendar_store()
+    start, _ = store.get_sync_window()
+    # The window was synced long ago and ends in less than half of CALENDAR_SYNC_FUTURE_DAYS
+    store.set_sync_window(start, (NOW + timedelta(days=10)).timestamp())
+    gmailapi.sync_calendar_sync(None)
+    assert 'syncToken' not in calendar.calls[-1]
+    _, end = store.get_sync_window()
+    assert end >= (NOW + timedelta(days=gmailapi.CALENDAR_SYNC_FUTURE_DAYS - 1)).timestamp()
+    assert stored_summaries() == ["tomorrow"]
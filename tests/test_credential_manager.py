@@ -0,0 +1,86 @@
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+import pytest
+from google.auth.exceptions import RefreshError, TransportError
+from google.oauth2.credentials import Credentials
+from credential_manager import CredentialManager
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+
+def write_token(path, token, expires_in):
+    expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+    with open(path, "w") as f:
+        json.dump({"token": token, "refresh_token": "refresh", "client_id": "client", "client_secret": "secret",
+                   "token_uri": "https://oauth2.example.com/token", "scopes": SCOPES, "expiry": expiry.isoformat() + "Z"}, f)
+
+class FakeRefresh:
+    """Replaces Credentials.refresh: counts calls, takes a while, then issues the next token or raises error."""
+    def __init__(self, error=None, seconds=0.2):
+        self.error = error
+        self.seconds = seconds
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, credentials, request):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.seconds)
+        if self.error:
+            raise self.error
+        credentials.token = f"token-{calls}"
+        credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+def patch_refresh(monkeypatch, **kwargs):
+    refresh = FakeRefresh(**kwargs)
+    monkeypatch.setattr(Credentials, "refresh", lambda credentials, request: refresh(credentials, request))
+    return refresh
+
+@pytest.fixture(autouse=True)
+def no_background_refresh(monkeypatch):
+    # The timer would refresh an expiring token on its own thread, racing the calls under test
+    monkeypatch.setattr(CredentialManager, "_schedule_refresh", lambda self, credentials: None)
+
+@pytest.fixture
+def token_path(tmp_path):
+    path = str(tmp_path / "token.json")
+    write_token(path, "token-0", expires_in=60)  # inside the refresh margin
+    return path
+
+def test_concurrent_callers_share_one_refresh(token_path, monkeypatch):
+    refresh = patch_refresh(monkeypatch)
+    manager = CredentialManager(token_path, SCOPES)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get_credentials().token)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert refresh.calls == 1
+    assert results == ["token-1"] * 8
+    with open(token_path) as f:
+        assert json.load(f)["token"] == "token-1"
+
+def test_token_refreshed_by_another_process_is_adopted(token_path, monkeypatch):
+    refresh = patch_refresh(monkeypatch)
+    manager = CredentialManager(token_path, SCOPES)
+    stale = manager._load().token
+    write_token(token_path, "token-from-elsewhere", expires_in=3600)
+    assert manager.refresh(stale_token=stale).token == "token-from-elsewhere"
+    assert refresh.calls == 0
+
+def test_transient_refresh_failure_keeps_the_unexpired_token(token_path, monkeypatch):
+    patch_refresh(monkeypatch, error=TransportError("connection reset"), seconds=0)
+    assert CredentialManager(token_path, SCOPES).get_credentials().token == "token-0"
+
+def test_revoked_refresh_token_returns_none(token_path, monkeypatch):
+    patch_refresh(monkeypatch, error=RefreshError("invalid_grant"), seconds=0)
+    assert CredentialManager(token_path, SCOPES).get_credentials() is None
+
+def test_transient_failure_after_expiry_returns_none(tmp_path, monkeypatch):
+    path = str(tmp_path / "token.json")
+    write_token(path, "token-0", expires_in=-60)
+    patch_refresh(monkeypatch, error=TransportError("connection reset"), seconds=0)
+    assert CredentialManager(path, SCOPES).get_credentials() is None
@@ -0,0 +1,78 @@
+import os
+import base64
+import hashlib
+import pytest
+from gcs_sync import sync_blobs, folder_prefix
+
+PREFIX = folder_prefix("Pricing")
+
+class FakeBlob:
+    """A GCS blob whose download can be cut off after fail_after bytes, like a dropped connection."""
+    def __init__(self, name, data, generation=1, fail_after=None):
+        self.name = PREFIX + name
+        self.data = data
+        self.size = len(data)
+        self.generation = generation
+        self.crc32c = None  # MD5 alone keeps the fake independent of google_crc32c
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.fail_after = fail_after
+        self.starts = []
+
+    def download_to_file(self, f, start=None, checksum=None):
+        self.starts.append(start)
+        data = self.data[start or 0:]
+        if self.fail_after is not None:
+            f.write(data[:self.fail_after])
+            self.fail_after = None
+            raise ConnectionError("connection reset")
+        f.write(data)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def local_dir(tmp_path):
+    return str(tmp_path / "pdfs")
+
+def test_unchanged_files_are_skipped_by_checksum(local_dir):
+    a, b = FakeBlob("a.pdf", b"alpha"), FakeBlob("2024/b.pdf", b"bravo")
+    result = sync_blobs([a, b], local_dir, prefix=PREFIX)
+    assert sorted(result['downloaded']) == [os.path.join(local_dir, "2024", "b.pdf"), os.path.join(local_dir, "a.pdf")]
+
+    # Same size, different content: only the checksum tells them apart
+    changed = FakeBlob("a.pdf", b"ALPHA", generation=2)
+    result = sync_blobs([changed, b], local_dir, prefix=PREFIX)
+    assert result['downloaded'] == [os.path.join(local_dir, "a.pdf")]
+    assert result['skipped'] == [os.path.join(local_dir, "2024", "b.pdf")]
+    assert read(os.path.join(local_dir, "a.pdf")) == b"ALPHA"
+    assert b.starts == [None]
+
+def test_interrupted_download_resumes_from_its_part_file(local_dir):
+    blob = FakeBlob("a.pdf", b"0123456789" * 10, fail_after=40)
+    result = sync_blobs([blob], local_dir, prefix=PREFIX)
+    assert result['failed'] == [blob.name]
+    assert os.path.getsize(os.path.join(local_dir, "a.pdf.1.part")) == 40
+
+    result = sync_blobs([blob], local_dir, prefix=PREFIX)
+    assert result['downloaded'] == [os.path.join(local_dir, "a.pdf")]
+    assert blob.starts == [None, 40]
+    assert read(os.path.join(local_dir, "a.pdf")) == blob.data
+    assert os.listdir(local_dir) == ["a.pdf"]
+
+def test_part_file_of_another_generation_is_not_resumed(local_dir):
+    os.makedirs(local_dir)
+    with open(os.path.join(local_dir, "a.pdf.1.part"), "wb") as f:
+        f.write(b"old c")
+    blob = FakeBlob("a.pdf", b"new content of a", generation=2)
+    result = sync_blobs([blob], local_dir, prefix=PREFIX)
+    assert result['downloaded'] == [os.path.join(local_dir, "a.pdf")]
+    assert blob.starts == [None]
+    assert os.listdir(local_dir) == ["a.pdf"]
+
+def test_failures_are_reported_by_blob_name(local_dir):
+    # Without a prefix both map to a.pdf, so neither is downloaded
+    first, second = FakeBlob("a.pdf", b"one"), FakeBlob("2024/a.pdf", b"two")
+    broken = FakeBlob("c.pdf", b"three", fail_after=1)
+    result = sync_blobs([first, second, broken], local_dir)
+    assert sorted(result['failed']) == sorted([first.name, second.name, broken.name])
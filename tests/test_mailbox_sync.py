@@ -0,0 +1,153 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+import gmailapi
+import quota_scheduler
+from mailstore import MailStore
+from quota_scheduler import QuotaScheduler
+
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def execute(self):
+        return self.respond()
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                response, error = request.execute(), None
+            except HttpError as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+class FakeGmail:
+    """
+    The parts of a Gmail v1 service the mailbox sync uses. History older than oldest_history_id
+    answers 404, and messages.get fails with a 503 for IDs in unavailable.
+    """
+    def __init__(self):
+        self.history_id = 100
+        self.oldest_history_id = 100
+        self.mailbox = {}
+        self.history_records = []  # (history_id, record)
+        self.unavailable = set()
+
+    def add_message(self, message_id, subject, label_ids=('INBOX',)):
+        self.history_id += 1
+        self.mailbox[message_id] = {
+            'id': message_id, 'threadId': message_id, 'labelIds': list(label_ids), 'snippet': subject,
+            'internalDate': str(self.history_id), 'payload': {'headers': [{'name': 'Subject', 'value': subject}]},
+        }
+        self.history_records.append((self.history_id, {'messagesAdded': [{'message': {'id': message_id, 'labelIds': list(label_ids)}}]}))
+
+    def delete_message(self, message_id):
+        self.history_id += 1
+        del self.mailbox[message_id]
+        self.history_records.append((self.history_id, {'messagesDeleted': [{'message': {'id': message_id}}]}))
+
+    # googleapiclient resource chain: service.users().messages().get(...), service.users().history().list(...)
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {'historyId': str(self.history_id)})
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback)
+
+    def list(self, userId, labelIds=None, q=None, maxResults=None, pageToken=None):
+        ids = [] if q else [message_id for message_id, message in self.mailbox.items() if 'INBOX' in message['labelIds']]
+        return FakeRequest(lambda: {'messages': [{'id': message_id} for message_id in ids]})
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        def respond():
+            if id in self.unavailable:
+                raise HttpError(httplib2.Response({'status': 503}), b'Backend Error')
+            if id not in self.mailbox:
+                raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+            return self.mailbox[id]
+        return FakeRequest(respond)
+
+class FakeHistory:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId, startHistoryId, pageToken=None, historyTypes=None):
+        def respond():
+            if int(startHistoryId) < self.gmail.oldest_history_id:
+                raise HttpError(httplib2.Response({'status': 404}), b'Requested entity was not found.')
+            records = [record for history_id, record in self.gmail.history_records if history_id > int(startHistoryId)]
+            return {'history': records, 'historyId': str(self.gmail.history_id)}
+        return FakeRequest(respond)
+
+@pytest.fixture
+def gmail(tmp_path, monkeypatch):
+    fake = FakeGmail()
+    monkeypatch.setattr(gmailapi, "mail_store", MailStore(str(tmp_path / "mail.db")))
+    monkeypatch.setattr(gmailapi, "get_service", lambda *args: fake)
+    monkeypatch.setattr(gmailapi, "scheduler", QuotaScheduler(budgets={'gmail': 1e6}))
+    monkeypatch.setattr(quota_scheduler, "backoff_delay", lambda attempt: 0)
+    return fake
+
+def stored_subjects():
+    return sorted(message['subject'] for message in gmailapi.get_mail_store().search_messages(limit=100))
+
+def test_history_gap_falls_back_to_a_full_sync(gmail):
+    gmail.add_message("m1", "first")
+    gmailapi.sync_mailbox_sync(None)
+    assert stored_subjects() == ["first"]
+
+    gmail.add_message("m2", "second")
+    gmail.delete_message("m1")
+    # The server dropped the history since the stored historyId
+    gmail.oldest_history_id = gmail.history_id
+    gmailapi.sync_mailbox_sync(None)
+    assert stored_subjects() == ["second"]
+    assert gmailapi.get_mail_store().get_history_id() == str(gmail.history_id)
+
+def test_messages_that_failed_to_fetch_are_retried_by_the_next_sync(gmail):
+    gmail.add_message("m1", "first")
+    gmailapi.sync_mailbox_sync(None)
+
+    gmail.add_message("m2", "second")
+    gmail.add_message("m3", "third")
+    gmail.unavailable.add("m3")
+    gmailapi.sync_mailbox_sync(None)
+    store = gmailapi.get_mail_store()
+    assert stored_subjects() == ["first", "second"]
+    assert store.get_pending_ids() == ["m3"]
+    assert store.get_history_id() == str(gmail.history_id)
+
+    # No new history, but the pending message is fetched again
+    gmail.unavailable.clear()
+    gmailapi.sync_mailbox_sync(None)
+    assert stored_subjects() == ["first", "second", "third"]
+    assert store.get_pending_ids() == []
+
+def test_pending_message_deleted_meanwhile_is_dropped(gmail):
+    gmail.add_message("m1", "first")
+    gmailapi.sync_mailbox_sync(None)
+    gmail.add_message("m2", "second")
+    gmail.unavailable.add("m2")
+    gmailapi.sync_mailbox_sync(None)
+    assert gmailapi.get_mail_store().get_pending_ids() == ["m2"]
+
+    gmail.delete_message("m2")
+    gmailapi.sync_mailbox_sync(None)
+    assert stored_subjects() == ["first"]
+    assert gmailapi.get_mail_store().get_pending_ids() == []
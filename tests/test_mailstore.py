@@ -0,0 +1,29 @@
+import os
+import pytest
+from mailstore import MailStore
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "mailbox.json")
+
+@pytest.fixture
+def store(tmp_path):
+    store = MailStore(str(tmp_path / "mail.db"))
+    store.load_fixture(FIXTURE)
+    return store
+
+def ids(messages):
+    return [message['id'] for message in messages]
+
+def test_full_text_search_matches_every_word(store):
+    assert ids(store.search_messages(text="clearance")) == ["m3", "m2", "m1"]
+    assert ids(store.search_messages(text="clearance furniture")) == ["m1"]
+    assert ids(store.search_messages(text="pricing", label_id="SENT")) == ["m4"]
+    assert store.search_messages(text='"unbalanced') == []
+
+def test_exclude_replies(store):
+    assert ids(store.search_messages(text="clearance", exclude_replies=True)) == ["m3", "m1"]
+
+def test_sender_domain_is_matched_at_the_end_of_the_address(store):
+    # m3 comes from kohls.com.example.org, which only starts like kohls.com
+    assert ids(store.search_messages(sender_domains=["kohls.com"])) == ["m2", "m1"]
+    assert ids(store.query_messages(label_id="INBOX", sender_domains=["kohls.com"], exclude_replies=True)) == ["m1"]
+    assert ids(store.search_messages(sender_domains=["kohls.com.example.org", "example.com"])) == ["m4", "m3"]
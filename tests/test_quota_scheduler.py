@@ -0,0 +1,83 @@
+import time
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+import quota_scheduler
+from quota_scheduler import QuotaScheduler, AdaptiveLimiter, TokenBucket, CONCURRENCY_INCREASE_AFTER
+
+def http_error(status, reason=None):
+    content = f'{{"error": {{"errors": [{{"reason": "{reason}"}}]}}}}'.encode() if reason else b''
+    return HttpError(httplib2.Response({'status': status}), content)
+
+class FlakyCall:
+    """Raises the given errors on its first calls, then returns 'ok'."""
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(quota_scheduler, "backoff_delay", lambda attempt: 0)
+    return QuotaScheduler(budgets={'gmail': 1000})
+
+def concurrency_limit(scheduler):
+    return scheduler.metrics()['gmail']['concurrency_limit']
+
+@pytest.mark.parametrize("error", [http_error(429), http_error(403, "rateLimitExceeded"), http_error(403, "userRateLimitExceeded")])
+def test_rate_limit_errors_halve_concurrency(scheduler, error):
+    initial = concurrency_limit(scheduler)
+    call = FlakyCall(error)
+    assert scheduler.call(call, 'gmail') == 'ok'
+    assert call.calls == 2
+    assert concurrency_limit(scheduler) == initial // 2
+    assert scheduler.metrics()['gmail']['rate_limited'] == 1
+
+@pytest.mark.parametrize("error", [http_error(500), http_error(503), http_error(403, "quotaExceeded")])
+def test_other_retryable_errors_keep_concurrency(scheduler, error):
+    initial = concurrency_limit(scheduler)
+    call = FlakyCall(error, error)
+    assert scheduler.call(call, 'gmail') == 'ok'
+    assert call.calls == 3
+    assert concurrency_limit(scheduler) == initial
+    metrics = scheduler.metrics()['gmail']
+    assert metrics['retries'] == 2 and metrics['rate_limited'] == 0
+
+def test_errors_that_are_not_retryable_are_raised_at_once(scheduler):
+    call = FlakyCall(http_error(404))
+    with pytest.raises(HttpError):
+        scheduler.call(call, 'gmail')
+    assert call.calls == 1
+    assert scheduler.metrics()['gmail']['failures'] == 1
+
+def test_retries_stop_after_max_retries(scheduler):
+    call = FlakyCall(*[http_error(503)] * (quota_scheduler.MAX_RETRIES + 1))
+    with pytest.raises(HttpError):
+        scheduler.call(call, 'gmail')
+    assert call.calls == quota_scheduler.MAX_RETRIES + 1
+
+def test_limiter_grows_after_a_run_of_successes():
+    limiter = AdaptiveLimiter(limit=2, max_limit=3)
+    for _ in range(CONCURRENCY_INCREASE_AFTER * 2):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 3
+    limiter.acquire()
+    limiter.release(rate_limited=True)
+    assert limiter.limit == 1
+    for _ in range(CONCURRENCY_INCREASE_AFTER * 2):
+        limiter.acquire()
+        limiter.release(succeeded=False)
+    assert limiter.limit == 1
+
+def test_token_bucket_spaces_calls_beyond_its_capacity():
+    bucket = TokenBucket(rate=100, capacity=10)
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(5) == pytest.approx(0.05, abs=0.01)
+    time.sleep(0.1)
+    assert bucket.reserve(1) == 0
@@ -0,0 +1,213 @@
+import os
+import time
+import types
+import asyncio
+import pytest
+import vector_ingest
+from vector_ingest import ingest_files, stream_blobs_to_vector_store
+from ingest_manifest import IngestManifest
+from ingest_jobs import IngestJournal, UPLOADED, ATTACHED, INDEXED, FAILED
+
+VECTOR_STORE = "vs_test"
+
+class FakeOpenAI:
+    """
+    The parts of AsyncOpenAI the ingestion pipeline uses. Uploads whose name is in fail_uploads
+    always fail, as does indexing those in fail_indexing; batches finish indexing poll_seconds
+    after they are created or polled.
+    """
+    def __init__(self, fail_uploads=(), poll_seconds=0.0, fail_indexing=()):
+        self.fail_uploads = set(fail_uploads)
+        self.fail_indexing = set(fail_indexing)
+        self.names = {}  # file ID -> uploaded name
+        self.poll_seconds = poll_seconds
+        self.uploads = []  # (name, monotonic time)
+        self.attached = []  # file IDs, in attach order
+        self.batches = {}  # batch_id -> {file_id: status}
+        self.polls_finished = []
+        self.files = types.SimpleNamespace(create=self.create_file)
+        file_batches = types.SimpleNamespace(create=self.create_batch, poll=self.poll_batch, list_files=self.list_batch_files)
+        files = types.SimpleNamespace(create_and_poll=self.attach_file, poll=self.poll_file)
+        self.beta = types.SimpleNamespace(vector_stores=types.SimpleNamespace(file_batches=file_batches, files=files))
+
+    async def create_file(self, file, purpose):
+        name = file[0] if isinstance(file, tuple) else os.path.basename(file.name)
+        if name in self.fail_uploads:
+            raise IOError(f"upload of {name} rejected")
+        self.uploads.append((name, time.monotonic()))
+        file_id = f"file_{len(self.uploads)}"
+        self.names[file_id] = name
+        return types.SimpleNamespace(id=file_id)
+
+    async def create_batch(self, vector_store_id, file_ids):
+        batch_id = f"batch_{len(self.batches) + 1}"
+        self.batches[batch_id] = {file_id: "failed" if self.names.get(file_id) in self.fail_indexing else "completed" for file_id in file_ids}
+        self.attached.extend(file_ids)
+        return types.SimpleNamespace(id=batch_id)
+
+    async def poll_batch(self, batch_id, vector_store_id):
+        if batch_id not in self.batches:
+            raise LookupError(f"No batch {batch_id}")
+        await asyncio.sleep(self.poll_seconds)
+        self.polls_finished.append(time.monotonic())
+        failed = sum(status == "failed" for status in self.batches[batch_id].values())
+        return types.SimpleNamespace(id=batch_id, file_counts=types.SimpleNamespace(failed=failed))
+
+    async def list_batch_files(self, vector_store_id, batch_id, filter):
+        for file_id, status in self.batches[batch_id].items():
+            if status == filter:
+                yield types.SimpleNamespace(id=file_id)
+
+    async def poll_file(self, file_id, vector_store_id):
+        await asyncio.sleep(self.poll_seconds)
+        self.polls_finished.append(time.monotonic())
+        return types.SimpleNamespace(id=file_id, status="completed")
+
+    async def attach_file(self, vector_store_id, file_id):
+        self.attached.append(file_id)
+        if self.names.get(file_id) in self.fail_indexing:
+            return types.SimpleNamespace(status="failed", last_error="unsupported file")
+        return types.SimpleNamespace(status="completed", last_error=None)
+
+class FakeBlob:
+    def __init__(self, name, data, generation=1):
+        self.name = f"drumbeatpdfs/Pricing/{name}"
+        self.data = data
+        self.size = len(data)
+        self.generation = generation
+        self.crc32c = f"crc-{name}-{generation}"
+        self.md5_hash = None
+        self.bucket = types.SimpleNamespace(name="bucket")
+
+    def download_as_bytes(self):
+        return self.data
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_ingest, "INGEST_FILE_RETRIES", 0)
+    monkeypatch.setattr(vector_ingest, "backoff_delay", lambda attempt: 0)
+    files = tmp_path / "files"
+    files.mkdir()
+    paths = []
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        (files / name).write_bytes(f"content of {name}".encode())
+        paths.append(str(files / name))
+    return types.SimpleNamespace(
+        paths=paths,
+        manifest=lambda: IngestManifest(str(tmp_path / "manifest.json")),
+        journal=IngestJournal(str(tmp_path / "jobs.db")),
+    )
+
+def ingest(client, store, paths=None, manifest=None):
+    return asyncio.run(ingest_files(client, paths or store.paths, VECTOR_STORE, manifest=manifest or store.manifest(), journal=store.journal))
+
+def states(store):
+    return sorted(job['state'] for job in store.journal.jobs(VECTOR_STORE))
+
+def test_second_run_skips_everything(store):
+    client = FakeOpenAI()
+    summary = ingest(client, store)
+    assert len(summary['uploaded']) == 3
+    assert states(store) == [INDEXED] * 3
+
+    summary = ingest(client, store)
+    assert len(summary['skipped']) == 3
+    assert len(client.uploads) == 3
+
+def test_changed_file_is_ingested_again(store):
+    client = FakeOpenAI()
+    ingest(client, store)
+    with open(store.paths[0], "ab") as f:
+        f.write(b" and more")
+
+    summary = ingest(client, store)
+    assert summary['uploaded'] == [store.paths[0]]
+    assert len(summary['skipped']) == 2
+    assert states(store) == [INDEXED] * 3
+
+def test_upload_before_manifest_save_is_not_repeated(store):
+    # An earlier run uploaded a.pdf and was killed before attaching it or saving the manifest
+    sources = [(os.path.abspath(path), vector_ingest.file_version(path)) for path in store.paths]
+    job = store.journal.discover(VECTOR_STORE, sources[:1])[sources[0][0]]
+    manifest = store.manifest()
+    store.journal.advance(job['id'], UPLOADED, sha256=manifest.hash_file(store.paths[0]), file_id="file_earlier", bytes=10)
+
+    client = FakeOpenAI()
+    summary = ingest(client, store, manifest=manifest)
+    assert summary['resumed'] == [store.paths[0]]
+    assert sorted(name for name, _ in client.uploads) == ["b.pdf", "c.pdf"]
+    assert "file_earlier" in client.attached
+    assert VECTOR_STORE in store.manifest().lookup(manifest.hash_file(store.paths[0]))['vector_stores']
+
+def test_partial_batch_resumes_only_unindexed_files(store):
+    # An earlier run's batch indexed a.pdf but not b.pdf before the run was killed
+    client = FakeOpenAI()
+    manifest = store.manifest()
+    sources = [(os.path.abspath(path), vector_ingest.file_version(path)) for path in store.paths[:2]]
+    jobs = store.journal.discover(VECTOR_STORE, sources)
+    client.batches["batch_earlier"] = {"file_a": "completed", "file_b": "failed"}
+    for (source, _), path, file_id in zip(sources, store.paths, ("file_a", "file_b")):
+        store.journal.advance(jobs[source]['id'], ATTACHED, sha256=manifest.hash_file(path), file_id=file_id, batch_id="batch_earlier", bytes=10)
+
+    summary = ingest(client, store, paths=store.paths[:2], manifest=manifest)
+    assert sorted(summary['resumed']) == store.paths[:2]
+    assert client.uploads == []
+    assert client.attached == ["file_b"]
+    assert states(store) == [INDEXED] * 2
+
+def test_failed_file_is_retried_up_to_max_attempts(store):
+    client = FakeOpenAI(fail_uploads={"a.pdf"})
+    for _ in range(7):
+        summary = ingest(client, store)
+        assert summary['failed'] == [store.paths[0]]
+    job = next(job for job in store.journal.jobs(VECTOR_STORE) if job['state'] == FAILED)
+    assert job['attempts'] == 5
+
+    with open(store.paths[0], "ab") as f:
+        f.write(b" fixed")
+    client.fail_uploads.clear()
+    summary = ingest(client, store)
+    assert summary['uploaded'] == [store.paths[0]]
+
+def test_resumed_batches_do_not_hold_up_new_downloads(store):
+    client = FakeOpenAI(poll_seconds=0.5)
+    blobs = [FakeBlob(f"{name}.pdf", f"content of {name}".encode()) for name in ("a", "b", "c", "d")]
+    sources = [(f"gs://bucket/{blob.name}", str(blob.generation)) for blob in blobs]
+    jobs = store.journal.discover(VECTOR_STORE, sources)
+    client.batches["batch_earlier"] = {"file_a": "completed", "file_b": "completed"}
+    for source, file_id in zip(sources[:2], ("file_a", "file_b")):
+        store.journal.advance(jobs[source[0]]['id'], ATTACHED, sha256=f"sha-{file_id}", file_id=file_id, batch_id="batch_earlier", bytes=10)
+
+    summary = asyncio.run(stream_blobs_to_vector_store(client, blobs, VECTOR_STORE, manifest=store.manifest(), journal=store.journal))
+    assert len(summary['resumed']) == 2 and len(summary['uploaded']) == 2
+    assert sorted(name for name, _ in client.uploads) == ["c.pdf", "d.pdf"]
+    # Both new files were uploaded while the earlier batch was still being polled
+    assert max(uploaded_at for _, uploaded_at in client.uploads) < min(client.polls_finished)
+    assert states(store) == [INDEXED] * 4
+
+def test_cache_is_keyed_by_blob_name_and_generation(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    pricing, legal = FakeBlob("a.pdf", b"pricing"), FakeBlob("a.pdf", b"legal!!")
+    legal.name = "drumbeatpdfs/Legal/a.pdf"
+    for blob in (pricing, legal):
+        blob.crc32c = None  # size alone decides whether a cached copy is current
+        vector_ingest.write_cached_blob(blob, cache_dir, blob.data)
+    assert vector_ingest.read_cached_blob(pricing, cache_dir) == b"pricing"
+    assert vector_ingest.read_cached_blob(legal, cache_dir) == b"legal!!"
+
+    pricing.generation = 2
+    assert vector_ingest.read_cached_blob(pricing, cache_dir) is None
+    vector_ingest.write_cached_blob(pricing, cache_dir, b"pricin2")
+    assert os.listdir(tmp_path / "cache" / "drumbeatpdfs" / "Pricing") == ["a.pdf#2"]
+
+def test_failed_indexing_is_retried_without_a_final_backoff(store, monkeypatch):
+    monkeypatch.setattr(vector_ingest, "INGEST_FILE_RETRIES", 3)
+    delays = []
+    monkeypatch.setattr(vector_ingest, "backoff_delay", lambda attempt: delays.append(attempt) or 0)
+    client = FakeOpenAI(fail_indexing={"b.pdf"})
+    summary = ingest(client, store)
+    assert summary['failed'] == [store.paths[1]]
+    failing_id = next(file_id for file_id, name in client.names.items() if name == "b.pdf")
+    # The batch attach, then three attempts of its own with a backoff between each
+    assert client.attached.count(failing_id) == 4
+    assert delays == [0, 1]
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from logger_config import logger
+from atomic_write import write_atomic
+
+MAX_SESSIONS = int(os.getenv("ASSISTANT_MAX_SESSIONS", "1000"))
+SESSION_TTL_SECONDS = int(os.getenv("ASSISTANT_SESSION_TTL", str(24 * 3600)))
+
+class ThreadSessionManager:
+    """
+    Maps a session or user key to its own assistant thread.
+
+    Sessions are evicted least-recently-used past max_sessions and after ttl_seconds idle.
+    Each session has a run lock, so concurrent messages to one session queue up instead of
+    colliding with the thread's active run. With persist_path set, the mapping survives restarts.
+    """
+    def __init__(self, create_thread, max_sessions=MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS, persist_path=None):
+        self.create_thread = create_thread
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self._sessions = OrderedDict()  # key -> {'thread_id': ..., 'last_used': ...}
+        self._locks = {}
+        self._load()
+
+    @asynccontextmanager
+    async def session(self, key):
+        """Holds the session's run lock and yields its thread ID, creating the thread on first use."""
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            self._evict()
+            entry = self._sessions.get(key)
+            if entry is None:
+                thread = await self.create_thread()
+                entry = {'thread_id': thread.id, 'last_used': time.time()}
+                self._sessions[key] = entry
+                logger.debug(f"New thread created with ID: {thread.id} for session {key}")
+            self._sessions.move_to_end(key)
+            try:
+                yield entry['thread_id']
+            finally:
+                entry['last_used'] = time.time()
+                self._save()
+
+    def forget(self, key):
+        self._sessions.pop(key, None)
+        self._save()
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl_seconds
+        for key in [key for key, entry in self._sessions.items() if entry['last_used'] < cutoff and not self._in_use(key)]:
+            logger.debug(f"Session {key} expired.")
+            del self._sessions[key]
+            self._locks.pop(key, None)
+        for key in list(self._sessions):
+            if len(self._sessions) < self.max_sessions:
+                break
+            if not self._in_use(key):
+                logger.debug(f"Session {key} evicted.")
+                del self._sessions[key]
+                self._locks.pop(key, None)
+
+    def _in_use(self, key):
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def _load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path) as f:
+                sessions = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load assistant sessions: {e}")
+            return
+        for key, entry in sorted(sessions.items(), key=lambda item: item[1]['last_used']):
+            self._sessions[key] = entry
+        logger.debug(f"Loaded {len(self._sessions)} assistant sessions.")
+
+    def _save(self):
+        if not self.persist_path:
+            return
+        try:
+            write_atomic(self.persist_path, json.dumps(self._sessions))
+        except Exception as e:
+            logger.error(f"Failed to save assistant sessions: {e}")
@@ -0,0 +1,127 @@
+import os
+import json
+import uuid
+import threading
+from logger_config import logger
+from ttl_cache import TTLCache, MISSING
+
+# Largest tool output sent back to the assistant in one submit_tool_outputs call
+TOOL_OUTPUT_MAX_BYTES = int(os.getenv("TOOL_OUTPUT_MAX_BYTES", "8000"))
+# Longer strings (snippets, event descriptions) are cut to this many characters
+TOOL_OUTPUT_MAX_FIELD_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_FIELD_CHARS", "500"))
+# Shortest a field is cut to when a single result still does not fit the byte budget
+MIN_FIELD_CHARS = 40
+# Seconds the rest of a paginated result stays available to fetch_more_results
+CURSOR_TTL_SECONDS = 900
+TRUNCATION_MARK = "…"
+CONTINUATION_NOTE = "Call fetch_more_results with next_cursor for the remaining items."
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def size(value):
+    return len(dumps(value).encode('utf-8'))
+
+def project(result, fields):
+    """Keeps only the given keys of a dict result, or of every dict in a list result. Error results pass through."""
+    if not fields:
+        return result
+    if isinstance(result, list):
+        return [project(item, fields) for item in result]
+    if isinstance(result, dict) and result.get("status") != "error":
+        return {key: value for key, value in result.items() if key in fields}
+    return result
+
+def truncate(value, max_chars):
+    """Cuts every string nested in value to max_chars characters."""
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars] + TRUNCATION_MARK
+    if isinstance(value, list):
+        return [truncate(item, max_chars) for item in value]
+    if isinstance(value, dict):
+        return {key: truncate(item, max_chars) for key, item in value.items()}
+    return value
+
+class OutputShaper:
+    """
+    Turns tool results into compact JSON for submit_tool_outputs: projects the fields a tool
+    declares, truncates long strings and, when a list still exceeds the byte budget, sends
+    the first page with a cursor the assistant passes to fetch_more_results for the rest.
+    """
+    def __init__(self, max_bytes=TOOL_OUTPUT_MAX_BYTES, max_field_chars=TOOL_OUTPUT_MAX_FIELD_CHARS):
+        self.max_bytes = max_bytes
+        self.max_field_chars = max_field_chars
+        self._pages = TTLCache(max_entries=256, default_ttl=CURSOR_TTL_SECONDS)
+        self._lock = threading.Lock()
+        self.stats = {}  # tool name -> byte counters, see record()
+
+    def shape(self, name, result, fields=None):
+        """Returns the JSON string to send for one tool result."""
+        raw_bytes = size(result)
+        shaped = truncate(project(result, fields), self.max_field_chars)
+        deferred_bytes = 0
+        if isinstance(shaped, list):
+            shaped, rest = self.paginate(shaped)
+            deferred_bytes = size(rest) if rest else 0
+        else:
+            shaped = self.fit(shaped)
+        output = dumps(shaped)
+        self.record(name, raw_bytes, len(output.encode('utf-8')), deferred_bytes)
+        return output
+
+    def paginate(self, items):
+        """Returns the page to send and the items kept back under a continuation cursor."""
+        if size(items) <= self.max_bytes:
+            return items, []
+        cursor = uuid.uuid4().hex
+        page, used = [], size(self.page_envelope([], cursor, len(items)))
+        for item in items:
+            item = self.fit(item, self.max_bytes - used)
+            item_bytes = size(item) + 1
+            if page and used + item_bytes > self.max_bytes:
+                break
+            page.append(item)
+            used += item_bytes
+        rest = items[len(page):]
+        if not rest:
+            return page, []
+        self._pages.set(cursor, rest)
+        return self.page_envelope(page, cursor, len(rest)), rest
+
+    @staticmethod
+    def page_envelope(page, cursor, remaining):
+        return {"items": page, "next_cursor": cursor, "remaining": remaining, "note": CONTINUATION_NOTE}
+
+    def fit(self, value, max_bytes=None):
+        """Shortens the strings in a single value until it fits max_bytes, down to MIN_FIELD_CHARS."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_chars = self.max_field_chars
+        while size(value) > max_bytes and max_chars > MIN_FIELD_CHARS:
+            max_chars = max(max_chars // 2, MIN_FIELD_CHARS)
+            value = truncate(value, max_chars)
+        return value
+
+    def next_page(self, cursor):
+        """Items stored under a cursor, or None if it is unknown or expired. A cursor can be used once."""
+        items = self._pages.get(cursor)
+        if items is MISSING:
+            return None
+        self._pages.invalidate(lambda key: key == cursor)
+        return items
+
+    def record(self, name, bytes_in, bytes_out, bytes_deferred):
+        """Counts bytes per tool; bytes deferred to a later page are not counted as saved."""
+        saved = max(bytes_in - bytes_out - bytes_deferred, 0)
+        with self._lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'bytes_in': 0, 'bytes_out': 0, 'bytes_deferred': 0, 'bytes_saved': 0, 'paginated': 0})
+            stats['calls'] += 1
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            stats['bytes_deferred'] += bytes_deferred
+            stats['bytes_saved'] += saved
+            stats['paginated'] += bytes_deferred > 0
+        logger.debug(f"Tool output for {name}: {bytes_in} bytes shaped to {bytes_out} ({saved} saved, {bytes_deferred} deferred).")
+
+    def metrics(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
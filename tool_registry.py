@@ -0,0 +1,255 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import threading
+import weakref
+from logger_config import logger
+from ttl_cache import TTLCache, MISSING
+from tool_output import OutputShaper
+
+DEFAULT_TOOL_TIMEOUT = 60
+DEFAULT_TOOL_CONCURRENCY = 4
+
+# JSON schema type -> accepted Python types
+SCHEMA_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'array': (list,),
+    'object': (dict,),
+}
+
+def error_result(message):
+    return {"status": "error", "message": message}
+
+def is_error_result(result):
+    return result is None or (isinstance(result, dict) and result.get("status") == "error")
+
+class ToolStats:
+    """Call, cache and latency counters for one tool. Latency and in_flight include calls waiting for a free slot."""
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self, seconds, error=False, timed_out=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.errors += error
+            self.timeouts += timed_out
+
+    def cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'cache_hits': self.cache_hits,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'avg_seconds': self.total_seconds / self.calls if self.calls else 0.0,
+                'max_seconds': self.max_seconds,
+            }
+
+class Tool:
+    """
+    One function the assistant can call.
+    Args:
+        name (str): Function name the assistant uses.
+        handler (coroutine function): Called with the validated arguments as keywords.
+        description (str): Shown to the model in the function definition.
+        parameters (dict): JSON schema of the arguments object.
+        writes (bool): The tool changes state; its results are never cached.
+        timeout (float): Seconds a call may take, including waiting for a free slot.
+        max_concurrency (int): Calls of this tool allowed to run at once.
+        cache_ttl (float): Seconds a read tool's result is reused for the same arguments and user.
+        invalidates (list): Read tools whose cached results this tool makes stale.
+        requires_auth (bool): Wait for the registry's authorize() before running.
+        output_fields (list): Keys kept from a dict result, or from each dict in a list result,
+            when the output is sent back to the assistant; None keeps everything.
+    """
+    def __init__(self, name, handler, description, parameters=None, writes=False, timeout=DEFAULT_TOOL_TIMEOUT,
+                 max_concurrency=DEFAULT_TOOL_CONCURRENCY, cache_ttl=None, invalidates=(), requires_auth=False, output_fields=None):
+        self.name = name
+        self.handler = handler
+        self.description = description
+        self.parameters = parameters or {"type": "object", "properties": {}}
+        self.writes = writes
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.cache_ttl = None if writes else cache_ttl
+        self.invalidates = list(invalidates)
+        self.requires_auth = requires_auth
+        self.output_fields = output_fields
+        self.stats = ToolStats()
+        # Semaphores are bound to the loop they are used on
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def definition(self):
+        """Function tool definition for the Assistants API."""
+        return {
+            "type": "function",
+            "function": {"name": self.name, "description": self.description, "parameters": self.parameters},
+        }
+
+    def validate(self, arguments):
+        """Checks arguments against the schema; returns them without unknown keys, or raises ValueError."""
+        if not isinstance(arguments, dict):
+            raise ValueError("arguments must be an object")
+        properties = self.parameters.get("properties", {})
+        missing = [name for name in self.parameters.get("required", []) if arguments.get(name) is None]
+        if missing:
+            raise ValueError(f"missing required arguments: {', '.join(missing)}")
+        validated = {}
+        for name, value in arguments.items():
+            schema = properties.get(name)
+            if schema is None:
+                logger.debug(f"Ignoring unknown argument {name} for {self.name}.")
+                continue
+            if value is None:
+                continue
+            expected = SCHEMA_TYPES.get(schema.get("type"))
+            if expected and (not isinstance(value, expected) or (isinstance(value, bool) and bool not in expected)):
+                raise ValueError(f"{name} must be of type {schema['type']}")
+            if "enum" in schema and value not in schema["enum"]:
+                raise ValueError(f"{name} must be one of {schema['enum']}")
+            validated[name] = value
+        return validated
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+class ToolRegistry:
+    """
+    The assistant's tools by name. Dispatch is a dict lookup followed by argument validation,
+    authorization, the result cache for read tools, and the tool's concurrency limit and timeout.
+    Cached results of tools that require authorization are scoped to the account returned by
+    account(), so every session of one account shares them and a write invalidates them all;
+    other results are scoped to the caller.
+    """
+    def __init__(self, authorize=None, cache_entries=int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "256")), shaper=None, account=None):
+        self.authorize = authorize
+        self.account = account
+        self.cache = TTLCache(max_entries=cache_entries)
+        self.shaper = shaper or OutputShaper()
+        self._tools = {}
+
+    def register(self, tool):
+        self._tools[tool.name] = tool
+        return tool
+
+    def get(self, name):
+        return self._tools.get(name)
+
+    def function_definitions(self):
+        return [tool.definition() for tool in self._tools.values()]
+
+    def metrics(self):
+        output_stats = self.shaper.metrics()
+        return {name: dict(tool.stats.snapshot(), output=output_stats.get(name)) for name, tool in self._tools.items()}
+
+    def format_output(self, name, result):
+        """JSON for submit_tool_outputs: projected to the tool's output_fields and kept within the byte budget."""
+        tool = self._tools.get(name)
+        return self.shaper.shape(name, result, tool.output_fields if tool else None)
+
+    async def fetch_more(self, cursor):
+        """Handler for the continuation tool: the items left over from a paginated output."""
+        items = self.shaper.next_page(cursor)
+        if items is None:
+            return error_result("Unknown or expired cursor")
+        return items
+
+    async def call(self, name, arguments, from_user=None):
+        """
+        Runs a tool and returns its result, or an error result the assistant can read.
+        from_user identifies the caller, e.g. a user or chat session.
+        """
+        tool = self._tools.get(name)
+        if tool is None:
+            logger.error(f"Function not recognized: {name}")
+            return error_result("Function not recognized")
+        try:
+            arguments = tool.validate(arguments)
+        except ValueError as e:
+            logger.error(f"Invalid arguments for {name}: {e}")
+            return error_result(f"Invalid arguments: {e}")
+
+        # Outside the timeout, which is meant for the handler and not for an interactive OAuth consent
+        if tool.requires_auth and self.authorize is not None:
+            try:
+                authorized = await self.authorize()
+            except Exception as e:
+                logger.error(f"Authorization for {name} failed: {e}")
+                authorized = False
+            if not authorized:
+                logger.error("Failed to obtain valid access token.")
+                return error_result("Failed to obtain valid access token.")
+
+        scope = from_user
+        if tool.requires_auth and self.account is not None:
+            scope = await self.account() or from_user
+        if tool.cache_ttl:
+            key = self.cache_key(name, arguments, scope)
+            cached = self.cache.get(key)
+            if cached is not MISSING:
+                tool.stats.cache_hit()
+                logger.debug(f"Tool cache hit for {name}.")
+                return copy.deepcopy(cached)
+
+        tool.stats.started()
+        started = time.monotonic()
+        result, timed_out = None, False
+        try:
+            result = await asyncio.wait_for(self._run(tool, arguments), timeout=tool.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Function {name} timed out after {tool.timeout} seconds.")
+            result, timed_out = error_result(f"{name} timed out after {tool.timeout} seconds"), True
+        except Exception as e:
+            logger.error(f"Error executing function {name}: {e}")
+            result = error_result(str(e))
+        finally:
+            tool.stats.finished(time.monotonic() - started, error=is_error_result(result), timed_out=timed_out)
+
+        if not is_error_result(result):
+            if tool.cache_ttl:
+                self.cache.set(key, copy.deepcopy(result), tool.cache_ttl)
+            if tool.invalidates:
+                dropped = self.cache.invalidate(lambda cached_key: cached_key[0] in tool.invalidates and cached_key[2] == scope)
+                logger.debug(f"{name} invalidated {dropped} cached tool results.")
+        return result
+
+    async def _run(self, tool, arguments):
+        async with tool.semaphore():
+            logger.debug(f"Executing function: {tool.name} with arguments: {arguments}")
+            return await tool.handler(**arguments)
+
+    @staticmethod
+    def cache_key(name, arguments, scope):
+        return (name, json.dumps(arguments, sort_keys=True, default=str), scope)
@@ -0,0 +1,468 @@
+import os
+import glob
+import time
+import asyncio
+import hashlib
+import contextlib
+from logger_config import logger
+from async_executor import run_in_executor
+from quota_scheduler import backoff_delay
+from ingest_manifest import get_manifest
+from ingest_jobs import get_journal, DOWNLOADED, UPLOADED, ATTACHED, INDEXED, FAILED
+from gcs_sync import GCS_DOWNLOAD_WORKERS, matches_blob
+from atomic_write import write_atomic
+
+# Bytes of downloaded-but-not-yet-uploaded blob content held in memory by the streaming pipeline
+STREAM_BUFFER_BYTES = int(os.getenv("INGEST_STREAM_BUFFER_MB", "64")) * 1024 * 1024
+# Concurrent files.create uploads
+INGEST_UPLOAD_WORKERS = int(os.getenv("INGEST_UPLOAD_WORKERS", "4"))
+# Uploaded files are attached to the vector store in batches of this many, with at most
+# INGEST_MAX_BATCHES batches being indexed at once
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "100"))
+INGEST_MAX_BATCHES = int(os.getenv("INGEST_MAX_BATCHES", "2"))
+# Further attempts for a single file whose upload or indexing failed
+INGEST_FILE_RETRIES = int(os.getenv("INGEST_FILE_RETRIES", "3"))
+
+def summary_text(summary):
+    return (f"Uploaded {len(summary['uploaded'])}, reused {len(summary['reused'])} existing files, "
+            f"resumed {len(summary['resumed'])} from an earlier run, "
+            f"skipped {len(summary['skipped'])} unchanged, {len(summary['failed'])} failed.")
+
+def new_summary():
+    return {'uploaded': [], 'reused': [], 'resumed': [], 'skipped': [], 'failed': []}
+
+async def with_retries(description, func, *args, **kwargs):
+    """Awaits func, retrying with jittered backoff up to INGEST_FILE_RETRIES times."""
+    for attempt in range(INGEST_FILE_RETRIES + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt == INGEST_FILE_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{description} failed: {e}. Retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+class BatchAttacher:
+    """
+    Attaches uploaded files to a vector store in batches as they arrive, so indexing starts while
+    later files are still uploading. At most max_batches batches are polled at once; files that
+    fail in a batch are retried one at a time, and each batch logs its progress and throughput.
+    Every file's job moves to attached when its batch is created and to indexed or failed after.
+    """
+    def __init__(self, client, manifest, journal, vector_store_id, summary, batch_size=INGEST_BATCH_SIZE, max_batches=INGEST_MAX_BATCHES):
+        self.client = client
+        self.manifest = manifest
+        self.journal = journal
+        self.vector_store_id = vector_store_id
+        self.summary = summary
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(max_batches)
+        self._pending = {}  # file_id -> [(sha256, name, bytes, job_id), ...]
+        self._resumed = {}  # batch_id -> pending entries of an earlier run's batch
+        self._tasks = []
+        self._resume_tasks = []
+        self.batches = 0
+        self.files_indexed = 0
+        self.bytes_indexed = 0
+        self.started = time.monotonic()
+
+    def add(self, file_id, sha256, name, size, job_id):
+        self._pending.setdefault(file_id, []).append((sha256, name, size, job_id))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def resume(self, job, name):
+        """
+        Picks up a job an earlier run left uploaded or attached, without uploading it again.
+        Attached jobs are checked once per batch in the background, so resuming holds up no new work.
+        """
+        self.summary['resumed'].append(name)
+        entry = (job['sha256'], name, job['bytes'] or 0, job['id'])
+        if job['state'] != ATTACHED or not job['batch_id']:
+            self.add(job['file_id'], *entry)
+            return
+        if job['batch_id'] not in self._resumed:
+            self._resumed[job['batch_id']] = {}
+            self._resume_tasks.append(asyncio.create_task(self._resume_batch(job['batch_id'])))
+        self._resumed[job['batch_id']].setdefault(job['file_id'], []).append(entry)
+
+    async def _resume_batch(self, batch_id):
+        """Waits for an earlier run's batch; its indexed files are recorded and the rest attached again."""
+        completed = set()
+        try:
+            await self.client.beta.vector_stores.file_batches.poll(batch_id, vector_store_id=self.vector_store_id)
+            async for vector_store_file in self.client.beta.vector_stores.file_batches.list_files(
+                vector_store_id=self.vector_store_id, batch_id=batch_id, filter="completed"
+            ):
+                completed.add(vector_store_file.id)
+        except Exception as e:
+            logger.debug(f"Batch {batch_id} not found in vector store {self.vector_store_id}, attaching its files again: {e}")
+        batch = self._resumed.pop(batch_id)
+        indexed = {file_id: files for file_id, files in batch.items() if file_id in completed}
+        self._record(indexed, set())
+        self.files_indexed += len(indexed)
+        for file_id, files in batch.items():
+            if file_id not in indexed:
+                for entry in files:
+                    self.add(file_id, *entry)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self.batches += 1
+        self._tasks.append(asyncio.create_task(self._attach(self.batches, batch)))
+
+    async def finish(self):
+        """Attaches whatever is left, waits for every batch and saves the manifest."""
+        await asyncio.gather(*self._resume_tasks)
+        self._flush()
+        await asyncio.gather(*self._tasks)
+        self.manifest.save()
+        elapsed = time.monotonic() - self.started
+        logger.info(f"Vector store {self.vector_store_id}: {summary_text(self.summary)} "
+                    f"{self.files_indexed} files in {self.batches} batches, {elapsed:.1f}s.")
+        for name in self.summary['skipped']:
+            logger.debug(f"Skipped unchanged file {name}")
+
+    async def _attach(self, number, batch):
+        async with self._semaphore:
+            started = time.monotonic()
+            failed_ids = set()
+            try:
+                file_batch = await self.client.beta.vector_stores.file_batches.create(
+                    vector_store_id=self.vector_store_id, file_ids=list(batch)
+                )
+                self.journal.advance([entry[3] for files in batch.values() for entry in files], ATTACHED, batch_id=file_batch.id)
+                file_batch = await self.client.beta.vector_stores.file_batches.poll(file_batch.id, vector_store_id=self.vector_store_id)
+                if file_batch.file_counts.failed:
+                    async for vector_store_file in self.client.beta.vector_stores.file_batches.list_files(
+                        vector_store_id=self.vector_store_id, batch_id=file_batch.id, filter="failed"
+                    ):
+                        failed_ids.add(vector_store_file.id)
+            except Exception as e:
+                logger.error(f"Batch {number} for vector store {self.vector_store_id} failed: {e}")
+                failed_ids = set(batch)
+            for file_id in list(failed_ids):
+                if await self._attach_one(file_id):
+                    failed_ids.discard(file_id)
+            self._record(batch, failed_ids)
+            self.manifest.save()
+
+            elapsed = time.monotonic() - started
+            indexed = [file_id for file_id in batch if file_id not in failed_ids]
+            size = sum(entry[2] for file_id in indexed for entry in batch[file_id][:1])
+            self.files_indexed += len(indexed)
+            self.bytes_indexed += size
+            logger.info(f"Batch {number}: {len(indexed)}/{len(batch)} files indexed in {elapsed:.1f}s "
+                        f"({len(indexed) / elapsed if elapsed else 0:.1f} files/s, {size / 1e6 / elapsed if elapsed else 0:.2f} MB/s). "
+                        f"Total indexed: {self.files_indexed} files, {self.bytes_indexed / 1e6:.1f} MB.")
+
+    async def _attach_one(self, file_id):
+        for attempt in range(INGEST_FILE_RETRIES):
+            try:
+                vector_store_file = await self.client.beta.vector_stores.files.create_and_poll(
+                    vector_store_id=self.vector_store_id, file_id=file_id
+                )
+                if vector_store_file.status == "completed":
+                    return True
+                logger.warning(f"Indexing {file_id} ended with status {vector_store_file.status}: {vector_store_file.last_error}")
+            except Exception as e:
+                logger.warning(f"Attaching {file_id} failed: {e}")
+            if attempt + 1 < INGEST_FILE_RETRIES:
+                await asyncio.sleep(backoff_delay(attempt))
+        return False
+
+    def _record(self, batch, failed_ids):
+        for file_id, files in batch.items():
+            for sha256, name, size, job_id in files:
+                if file_id in failed_ids:
+                    if name in self.summary['reused']:
+                        # The earlier upload may have been deleted; upload it afresh next time
+                        self.summary['reused'].remove(name)
+                        self.manifest.forget(sha256)
+                    else:
+                        for outcome in ('uploaded', 'resumed'):
+                            if name in self.summary[outcome]:
+                                self.summary[outcome].remove(name)
+                    self.summary['failed'].append(name)
+                    self.journal.fail(job_id, f"Indexing {file_id} failed")
+                else:
+                    if self.manifest.lookup(sha256) is None:  # uploaded by a run that stopped before saving
+                        self.manifest.record_upload(sha256, file_id, os.path.basename(name), size)
+                    self.manifest.record_membership(sha256, self.vector_store_id)
+                    self.journal.advance(job_id, INDEXED)
+
+def file_version(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+async def ingest_files(client, file_paths, vector_store_id, manifest=None, journal=None, upload_workers=INGEST_UPLOAD_WORKERS,
+                       batch_size=INGEST_BATCH_SIZE, max_batches=INGEST_MAX_BATCHES):
+    """
+    Adds local files to a vector store, uploading only content the manifest has not seen.
+    Uploads run upload_workers at a time, each file opened only while it uploads, and are attached
+    in batches as they finish (see BatchAttacher). Progress is journaled per file, so after an
+    interruption files already uploaded or attached are not uploaded again.
+    Args:
+        client (AsyncOpenAI): OpenAI client for the current event loop.
+        file_paths (list): Local files to ingest.
+        vector_store_id (str): Target vector store.
+        manifest (IngestManifest): Defaults to the shared manifest file.
+        journal (IngestJournal): Defaults to the shared job journal.
+        upload_workers (int): Concurrent uploads.
+        batch_size (int): Files per vector store file batch.
+        max_batches (int): File batches indexed at once.
+
+    Returns:
+        dict: Paths by outcome: 'uploaded' (new content), 'reused' (file_id already uploaded for
+            another store), 'resumed' (uploaded by an interrupted run), 'skipped' (already in
+            this store) and 'failed'.
+    """
+    manifest = manifest or get_manifest()
+    journal = journal or get_journal()
+    summary = new_summary()
+    attacher = BatchAttacher(client, manifest, journal, vector_store_id, summary, batch_size, max_batches)
+    semaphore = asyncio.Semaphore(upload_workers)
+    sources = {}
+    for path in file_paths:
+        try:
+            sources[path] = (os.path.abspath(path), file_version(path))
+        except OSError as e:
+            logger.error(f"Cannot read {path}: {e}")
+            summary['failed'].append(path)
+    jobs = journal.discover(vector_store_id, list(sources.values()))
+
+    async def upload(path):
+        with open(path, "rb") as f:
+            return await client.files.create(file=f, purpose="assistants")
+
+    async def ingest(path, job):
+        try:
+            if job['state'] == INDEXED:
+                summary['skipped'].append(path)
+                return
+            if job['state'] in (UPLOADED, ATTACHED):
+                attacher.resume(job, path)
+                return
+            if job['state'] == FAILED:
+                logger.warning(f"Not retrying {path}, which failed {job['attempts']} times: {job['error']}")
+                summary['failed'].append(path)
+                return
+            sha256 = await run_in_executor(manifest.hash_file, path)
+            size = os.path.getsize(path)
+            journal.advance(job['id'], DOWNLOADED, sha256=sha256, bytes=size)
+            entry = manifest.lookup(sha256)
+            if entry and vector_store_id in entry['vector_stores']:
+                summary['skipped'].append(path)
+                journal.advance(job['id'], INDEXED, file_id=entry['file_id'])
+                return
+            if entry:
+                summary['reused'].append(path)
+                journal.advance(job['id'], UPLOADED, file_id=entry['file_id'])
+                attacher.add(entry['file_id'], sha256, path, size, job['id'])
+                return
+            async with semaphore:
+                file = await with_retries(f"Uploading {path}", upload, path)
+            manifest.record_upload(sha256, file.id, os.path.basename(path), size)
+            journal.advance(job['id'], UPLOADED, file_id=file.id)
+            summary['uploaded'].append(path)
+            logger.debug(f"Uploaded {path} as {file.id}")
+            attacher.add(file.id, sha256, path, size, job['id'])
+        except Exception as e:
+            logger.error(f"Failed to upload {path}: {e}")
+            summary['failed'].append(path)
+            journal.fail(job['id'], e)
+
+    await asyncio.gather(*(ingest(path, jobs[source]) for path, (source, _) in sources.items()))
+    await attacher.finish()
+    return summary
+
+class ByteBudget:
+    """Caps the bytes held in memory between pipeline stages; acquire waits until enough is released."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.available = capacity
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        # A file larger than the whole budget is admitted once everything else has drained
+        size = min(size, self.capacity)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.available >= size)
+            self.available -= size
+        return size
+
+    async def release(self, size):
+        async with self._condition:
+            self.available += size
+            self._condition.notify_all()
+
+def blob_key(blob):
+    return f"gs://{blob.bucket.name}/{blob.name}#{blob.generation}"
+
+def blob_checksum(blob):
+    return blob.crc32c or blob.md5_hash
+
+def cache_path(blob, cache_dir):
+    """Where a blob generation is cached: its full name below cache_dir, as gcs_sync.local_path lays it out, tagged with the generation."""
+    path = os.path.normpath(os.path.join(cache_dir, *blob.name.split("/")))
+    if os.path.commonpath([os.path.abspath(path), os.path.abspath(cache_dir)]) != os.path.abspath(cache_dir):
+        raise ValueError(f"{blob.name} would be cached outside {cache_dir}")
+    return f"{path}#{blob.generation}"
+
+def read_cached_blob(blob, cache_dir):
+    """Content of the blob's copy in cache_dir if it is current, else None."""
+    path = cache_path(blob, cache_dir)
+    if not matches_blob(blob, path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def write_cached_blob(blob, cache_dir, data):
+    """Caches this generation of the blob and drops the copies of its earlier generations."""
+    path = cache_path(blob, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, data)
+    for stale in glob.glob(glob.escape(path.rsplit("#", 1)[0]) + "#*"):
+        if stale != path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(stale)
+
+def blob_source(blob):
+    return f"gs://{blob.bucket.name}/{blob.name}"
+
+async def stream_blobs_to_vector_store(client, blobs, vector_store_id, manifest=None, journal=None, cache_dir=None,
+                                       download_workers=GCS_DOWNLOAD_WORKERS, upload_workers=INGEST_UPLOAD_WORKERS,
+                                       buffer_bytes=STREAM_BUFFER_BYTES, batch_size=INGEST_BATCH_SIZE, max_batches=INGEST_MAX_BATCHES,
+                                       limiter=None, budget=None):
+    """
+    Ingests GCS blobs into a vector store without staging them on disk: downloads and uploads
+    overlap, and at most buffer_bytes of content waits in memory between them, so slow uploads
+    hold back further downloads. Blobs whose generation the manifest already knows are not downloaded,
+    and blobs an interrupted run already uploaded resume from the job journal.
+    Args:
+        client (AsyncOpenAI): OpenAI client for the current event loop.
+        blobs (list): Blobs from gcs_sync.list_blobs.
+        vector_store_id (str): Target vector store.
+        manifest (IngestManifest): Defaults to the shared manifest file.
+        journal (IngestJournal): Defaults to the shared job journal.
+        cache_dir (str): Opt-in disk cache, laid out by blob name and generation; current copies
+            there are read instead of downloaded, and downloads are written there.
+        download_workers (int): Concurrent blob downloads.
+        upload_workers (int): Concurrent file uploads.
+        buffer_bytes (int): Memory budget between the two stages.
+        batch_size (int): Files per vector store file batch.
+        max_batches (int): File batches indexed at once.
+        limiter (asyncio.Semaphore): Optional limit on downloads and uploads in flight, shared
+            with other pipelines running at the same time.
+        budget (ByteBudget): Optional memory budget shared with other pipelines; replaces buffer_bytes.
+
+    Returns:
+        dict: Blob names by outcome, as for ingest_files.
+    """
+    manifest = manifest or get_manifest()
+    journal = journal or get_journal()
+    summary = new_summary()
+    attacher = BatchAttacher(client, manifest, journal, vector_store_id, summary, batch_size, max_batches)
+    budget = budget or ByteBudget(buffer_bytes)
+    jobs = journal.discover(vector_store_id, [(blob_source(blob), str(blob.generation)) for blob in blobs])
+    pending = asyncio.Queue()
+    for blob in blobs:
+        job = jobs[blob_source(blob)]
+        if job['state'] == INDEXED:
+            summary['skipped'].append(blob.name)
+        elif job['state'] in (UPLOADED, ATTACHED):
+            attacher.resume(job, blob.name)
+        elif job['state'] == FAILED:
+            logger.warning(f"Not retrying {blob.name}, which failed {job['attempts']} times: {job['error']}")
+            summary['failed'].append(blob.name)
+        else:
+            pending.put_nowait((blob, job))
+    uploads = asyncio.Queue(maxsize=upload_workers * 2)
+
+    def use_existing(blob, job, sha256):
+        """Returns True if the content needs no upload, recording it as skipped or reused."""
+        entry = manifest.lookup(sha256)
+        if entry and vector_store_id in entry['vector_stores']:
+            summary['skipped'].append(blob.name)
+            journal.advance(job['id'], INDEXED, sha256=sha256, file_id=entry['file_id'])
+            return True
+        if entry:
+            summary['reused'].append(blob.name)
+            journal.advance(job['id'], UPLOADED, sha256=sha256, file_id=entry['file_id'], bytes=entry['bytes'])
+            attacher.add(entry['file_id'], sha256, blob.name, entry['bytes'], job['id'])
+            return True
+        return False
+
+    async def download_worker():
+        while not pending.empty():
+            blob, job = pending.get_nowait()
+            reserved = 0
+            try:
+                known_hash = manifest.blob_hash(blob_key(blob), blob_checksum(blob))
+                if known_hash and use_existing(blob, job, known_hash):
+                    continue
+                reserved = await budget.acquire(blob.size or 0)
+                data = await run_in_executor(read_cached_blob, blob, cache_dir) if cache_dir else None
+                if data is None:
+                    async with limiter or contextlib.nullcontext():
+                        data = await run_in_executor(blob.download_as_bytes)
+                    if cache_dir:
+                        await run_in_executor(write_cached_blob, blob, cache_dir, data)
+                sha256 = hashlib.sha256(data).hexdigest()
+                manifest.record_blob(blob_key(blob), blob_checksum(blob), sha256)
+                journal.advance(job['id'], DOWNLOADED, sha256=sha256, bytes=len(data))
+                if use_existing(blob, job, sha256):
+                    await budget.release(reserved)
+                    continue
+                await uploads.put((blob, job, data, sha256, reserved))
+            except Exception as e:
+                # The reservation only passes to the upload worker once the item is queued
+                await budget.release(reserved)
+                logger.error(f"Failed to download {blob.name}: {e}")
+                summary['failed'].append(blob.name)
+                journal.fail(job['id'], e)
+
+    async def upload_worker():
+        while True:
+            item = await uploads.get()
+            if item is None:
+                return
+            blob, job, data, sha256, reserved = item
+            try:
+                entry = manifest.lookup(sha256)  # a duplicate may have been uploaded meanwhile
+                if entry:
+                    file_id = entry['file_id']
+                    summary['reused'].append(blob.name)
+                else:
+                    filename = blob.name.split("/")[-1]
+                    async with limiter or contextlib.nullcontext():
+                        file = await with_retries(f"Uploading {blob.name}", client.files.create, file=(filename, data), purpose="assistants")
+                    file_id = file.id
+                    manifest.record_upload(sha256, file_id, filename, len(data))
+                    summary['uploaded'].append(blob.name)
+                    logger.debug(f"Streamed {blob.name} as {file_id}")
+                journal.advance(job['id'], UPLOADED, file_id=file_id)
+                attacher.add(file_id, sha256, blob.name, len(data), job['id'])
+            except Exception as e:
+                logger.error(f"Failed to upload {blob.name}: {e}")
+                summary['failed'].append(blob.name)
+                journal.fail(job['id'], e)
+            finally:
+                del data
+                await budget.release(reserved)
+
+    uploaders = [asyncio.create_task(upload_worker()) for _ in range(upload_workers)]
+    try:
+        await asyncio.gather(*(download_worker() for _ in range(download_workers)))
+        for _ in uploaders:
+            await uploads.put(None)
+        await asyncio.gather(*uploaders)
+    finally:
+        for task in uploaders:
+            task.cancel()
+
+    await attacher.finish()
+    return summary
@@ -1,7 +1,20 @@
 import os
+import sys
+import time
+import asyncio
+import argparse
 import openai
 from google.cloud import storage
 from loguru import logger
+from http_pool import get_async_http_client
+from async_executor import run_in_executor
+from gcs_sync import list_blobs, folder_prefix, SUB_FOLDERS
+from vector_ingest import stream_blobs_to_vector_store, ByteBudget, STREAM_BUFFER_BYTES
+
+GCS_BUCKET_DOCS = "openai-418007-me-bucket"
+GCS_CREDENTIALS_FILE = "openai-418007-e93119e8b4d3.json"
+# Downloads and uploads in flight across every folder of a sync run
+SYNC_CONCURRENCY = int(os.getenv("VECTOR_SYNC_CONCURRENCY", "16"))
 
 def authenticate_gcs(credentials_path):
     try:
@@ -12,91 +25,142 @@ def authenticate_gcs(credentials_path):
         logger.error(f"GCS authentication failed: {e}")
         return None
 
-def download_pdfs_from_gcs(storage_client, bucket_name, sub_folder, local_dir):
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=f"drumbeatpdfs/{sub_folder}/")
-    for blob in blobs:
-        if blob.name.endswith(".pdf"):
-            destination_file = os.path.join(local_dir, blob.name.split("/")[-1])
-            logger.info(f"Downloading {blob.name} to {destination_file}")
-            blob.download_to_filename(destination_file)
-            logger.info(f"Downloaded {blob.name} to {destination_file}")
-
-def create_and_upload_to_vector_store(file_paths, vector_store_name):
-    try:
-        vector_store = openai.Client().beta.vector_stores.create(name=vector_store_name)
-        logger.info(f"Created vector store: {vector_store.id}")
-
-        for file_path in file_paths:
-            with open(file_path, "rb") as f:
-                file = openai.Client().files.create(file=f, purpose="assistants")
-                openai.Client().beta.vector_stores.files.create_and_poll(
-                    vector_store_id=vector_store.id, file_id=file.id
-                )
-                logger.info(f"Uploaded {file_path} to vector store")
-
-        return vector_store.id
-    except Exception as e:
-        logger.error(f"Error creating or uploading to vector store: {e}")
-        return None
-
-def update_assistant_with_vector_store(assistant_id, vector_store_id):
-    try:
-        openai.Client().beta.assistants.update(
-            assistant_id=assistant_id,
-            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}}
-        )
-        logger.success("Assistant updated with vector store")
-    except Exception as e:
-        logger.error(f"Failed to update assistant: {e}")
-
 def main():
     PROJECT_ID = "openai-418007"
     LOCATION = "us-central1"
-    GCS_BUCKET_DOCS = "openai-418007-me-bucket"
     logger.debug(f"Project ID: {PROJECT_ID}, Location: {LOCATION}, GCS Bucket: {GCS_BUCKET_DOCS}")
     # Set your Google Cloud API key
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "openai-418007-e93119e8b4d3.json"
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCS_CREDENTIALS_FILE
     logger.info("Google Cloud API key set successfully")
     assistant_id = "asst_a9OH5oxmowHxHO3c6oUxamQn"  # Replace with your assistant ID
-    # Authenticate with GCS
-    storage_client = authenticate_gcs(credentials_path="openai-418007-e93119e8b4d3.json")
-    if not storage_client:
-        return  # Exit if authentication fails
-    # Define sub-folders within the GCS bucket
-    sub_folders = [
-        "Cobrand",
-        "Cohesive_Infrastructure",
-        "Data_Center_Transformation",
-        "Infrastructure",
-        "Next_Generation_Payments",
-        "Price_Value",
-        "Pricing",
-        "Shared_Services",
-        "Stores_Digital_Marketing_EPS_Customer_Service",
-        "Stores_Digital_Marketing_ETCC",
-        "Supply_Chain_Merch",
-        "Technical_Project_Management_Stores_and_Infra",
-    ]
-    logger.info("Sub-folders defined for processing")
     # Sub-folder Selection
     print("Select the folder to process documents for:")
-    for i, folder in enumerate(sub_folders, 1):
+    for i, folder in enumerate(SUB_FOLDERS, 1):
         print(f"[{i}] {folder.replace('_', ' ')}")
     folder_choice = int(input("Enter your choice: ")) - 1
-    selected_folder = sub_folders[folder_choice]
+    selected_folder = SUB_FOLDERS[folder_choice]
+
+    # Stream the folder into drumbeat_<folder> through the same resumable pipeline as sync(),
+    # caching the downloaded blobs under downloaded_pdfs/
+    asyncio.run(sync([selected_folder], assistant_id=assistant_id, cache_dir="downloaded_pdfs"))
+
+def resolve_folders(names):
+    """Maps folder arguments ('all', or names with spaces or underscores, any case) to SUB_FOLDERS entries."""
+    if any(name.lower() == "all" for name in names):
+        return list(SUB_FOLDERS)
+    by_key = {folder.lower(): folder for folder in SUB_FOLDERS}
+    folders = []
+    for name in names:
+        folder = by_key.get(name.replace(" ", "_").lower())
+        if folder is None:
+            raise ValueError(f"Unknown folder {name!r}. Choose from: {', '.join(SUB_FOLDERS)} or 'all'.")
+        if folder not in folders:
+            folders.append(folder)
+    return folders
+
+async def find_or_create_vector_store(async_client, name_or_id):
+    """Returns the ID of the vector store with this ID or name, creating it by name if there is none."""
+    if name_or_id.startswith("vs_"):
+        return name_or_id
+    async for vector_store in async_client.beta.vector_stores.list(limit=100):
+        if vector_store.name == name_or_id:
+            logger.info(f"Using vector store {name_or_id}: {vector_store.id}")
+            return vector_store.id
+    vector_store = await async_client.beta.vector_stores.create(name=name_or_id)
+    logger.info(f"Created vector store {name_or_id}: {vector_store.id}")
+    return vector_store.id
+
+async def sync_folder(async_client, storage_client, bucket_name, folder, vector_store_id, limiter, budget, cache_dir=None):
+    """Streams one folder into its vector store and returns its report row."""
+    started = time.monotonic()
+    report = {'folder': folder, 'vector_store_id': vector_store_id, 'files': 0, 'bytes': 0, 'summary': None, 'error': None}
+    try:
+        async with limiter:
+            blobs = await run_in_executor(list_blobs, storage_client, bucket_name, folder_prefix(folder))
+        report['files'] = len(blobs)
+        summary = await stream_blobs_to_vector_store(
+            async_client, blobs, vector_store_id,
+            cache_dir=cache_dir, limiter=limiter, budget=budget,
+        )
+        # Only new uploads move content; reused and resumed files are attached by file_id
+        uploaded = set(summary['uploaded'])
+        report['bytes'] = sum(blob.size or 0 for blob in blobs if blob.name in uploaded)
+        report['summary'] = summary
+    except Exception as e:
+        logger.error(f"Sync of {folder} failed: {e}")
+        report['error'] = str(e)
+    report['seconds'] = time.monotonic() - started
+    return report
+
+def print_report(reports, elapsed):
+    """Per-folder outcome counts, with MB and MB/s counting uploaded content only."""
+    print(f"{'Folder':<48} {'Files':>6} {'New':>5} {'Reused':>6} {'Resumed':>7} {'Skip':>5} {'Fail':>5} {'MB':>8} {'Secs':>7} {'MB/s':>6}")
+    for report in reports:
+        summary = report['summary'] or {}
+        uploaded, reused, resumed, skipped, failed = (len(summary.get(outcome, [])) for outcome in ('uploaded', 'reused', 'resumed', 'skipped', 'failed'))
+        megabytes = report['bytes'] / 1e6
+        rate = megabytes / report['seconds'] if report['seconds'] else 0.0
+        print(f"{report['folder']:<48} {report['files']:>6} {uploaded:>5} {reused:>6} {resumed:>7} {skipped:>5} {failed:>5} "
+              f"{megabytes:>8.1f} {report['seconds']:>7.1f} {rate:>6.2f}" + (f"  ERROR: {report['error']}" if report['error'] else ""))
+    total_megabytes = sum(report['bytes'] for report in reports) / 1e6
+    print(f"Total: {len(reports)} folders, {sum(report['files'] for report in reports)} files, {total_megabytes:.1f} MB "
+          f"in {elapsed:.1f}s ({total_megabytes / elapsed if elapsed else 0.0:.2f} MB/s).")
+
+async def sync(folders, shared_store=None, assistant_id=None, concurrency=SYNC_CONCURRENCY, bucket_name=GCS_BUCKET_DOCS,
+               credentials_path=GCS_CREDENTIALS_FILE, cache_dir=None):
+    """
+    Syncs several drumbeat folders concurrently, each into drumbeat_<folder> or all into shared_store.
+    Returns the per-folder reports.
+    """
+    storage_client = authenticate_gcs(credentials_path=credentials_path)
+    if not storage_client:
+        return []
+    async_client = openai.AsyncOpenAI(http_client=get_async_http_client())
+    if shared_store:
+        shared_id = await find_or_create_vector_store(async_client, shared_store)
+        store_ids = {folder: shared_id for folder in folders}
+    else:
+        store_ids = {folder: await find_or_create_vector_store(async_client, f"drumbeat_{folder}") for folder in folders}
+    # Network calls and buffered content are limited across all folders, not per folder
+    limiter = asyncio.Semaphore(concurrency)
+    budget = ByteBudget(STREAM_BUFFER_BYTES)
+
+    started = time.monotonic()
+    reports = await asyncio.gather(*(
+        sync_folder(async_client, storage_client, bucket_name, folder, store_ids[folder], limiter, budget, cache_dir) for folder in folders
+    ))
+    print_report(reports, time.monotonic() - started)
 
-    # Download PDFs from GCS
-    local_dir = "downloaded_pdfs"
-    os.makedirs(local_dir, exist_ok=True)
-    download_pdfs_from_gcs(storage_client, GCS_BUCKET_DOCS, selected_folder, local_dir)
+    if assistant_id:
+        distinct_ids = set(store_ids.values())
+        if len(distinct_ids) == 1:
+            await async_client.beta.assistants.update(
+                assistant_id=assistant_id, tool_resources={"file_search": {"vector_store_ids": list(distinct_ids)}}
+            )
+            logger.success("Assistant updated with vector store")
+        else:
+            logger.error("An assistant can use only one vector store; pass --shared-store to attach the synced folders.")
+    return reports
 
-    # Create and Upload to Vector Store 
-    file_paths = [os.path.join(local_dir, f) for f in os.listdir(local_dir) if f.endswith(".pdf")]
-    vector_store_name = f"drumbeat_{selected_folder}" 
-    vector_store_id = create_and_upload_to_vector_store(file_paths, vector_store_name) 
-    if not vector_store_id:
-        return  # Exit if vector store creation or upload fails 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Sync drumbeat PDF folders from GCS into OpenAI vector stores.")
+    parser.add_argument("folders", nargs="+", help=f"Folders to sync, or 'all'. Known folders: {', '.join(SUB_FOLDERS)}.")
+    parser.add_argument("--shared-store", metavar="NAME_OR_ID",
+                        help="Put every folder into this vector store (an ID, or a name to find or create) instead of one drumbeat_<folder> store each.")
+    parser.add_argument("--assistant-id", help="Attach the synced vector store to this assistant; needs a single store.")
+    parser.add_argument("--concurrency", type=int, default=SYNC_CONCURRENCY, help="Downloads and uploads in flight across all folders.")
+    parser.add_argument("--bucket", default=GCS_BUCKET_DOCS, help="GCS bucket holding drumbeatpdfs/.")
+    parser.add_argument("--credentials", default=GCS_CREDENTIALS_FILE, help="GCS service account JSON.")
+    parser.add_argument("--cache-dir", default=os.getenv("INGEST_CACHE_DIR"), help="Also cache the downloaded blobs here, by blob name and generation.")
+    return parser.parse_args(argv)
 
-    # Update Assistant with Vector Store
-    update_assistant_with_vector_store(assistant_id, vector_store_id) 
\ No newline at end of file
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        args = parse_args(sys.argv[1:])
+        try:
+            folders = resolve_folders(args.folders)
+        except ValueError as e:
+            sys.exit(str(e))
+        reports = asyncio.run(sync(folders, args.shared_store, args.assistant_id, args.concurrency, args.bucket, args.credentials, args.cache_dir))
+        sys.exit(1 if not reports or any(report['error'] or (report['summary'] and report['summary']['failed']) for report in reports) else 0)
+    main()